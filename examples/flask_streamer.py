@@ -56,6 +56,8 @@ if __name__ == '__main__':
         cap_dev = context.find_device()
         cap_dev.open()
         cap_dev.start_streaming()
+        # restart the stream if frames stop arriving
+        cap_dev.start_watchdog(stall_timeout=2.0)
         app.run(host='0.0.0.0', debug=False, threaded=True)
         print("Exiting...")
         cap_dev.stop_streaming()
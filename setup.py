@@ -5,13 +5,6 @@
 from setuptools import setup, find_packages
 from codecs import open
 from os import path
-import sys
-
-# Python versions less than 3.4 require enum34 backport
-if sys.version_info[0] == 2 or sys.version_info[1] < 4:
-    requirements = ['enum34',]
-else:
-    requirements = []
 
 here = path.abspath(path.dirname(__file__))
 
@@ -32,15 +25,18 @@ setup(
         'Intended Audience :: Developers',
         'Topic :: Multimedia :: Video :: Capture',
         'License :: OSI Approved :: Apache Software License',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.6'
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.8'
     ],
     keywords='libuvc uvc video capture',
     packages=find_packages(exclude=['examples']),
 
-    # Python < 3.4 requires Enum backport
-    install_requires=requirements
+    # multiprocessing.shared_memory
+    python_requires='>=3.8',
+
+    # camera probe and benchmark, also runs as python -m uvclite
+    entry_points={
+        'console_scripts': ['uvclite=uvclite.__main__:main']
+    }
 )
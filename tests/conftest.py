@@ -0,0 +1,93 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Test fixtures
+
+The tests run against the stand-in libuvc in standin.py.  libuvc.py
+loads libuvc with ctypes.CDLL when uvclite is first imported, so CDLL
+hands out the stand-in for that import only.  Frames are delivered at
+four times the negotiated rate to keep the tests short.
+
+Worker processes only inherit the stand-in when they are forked, so
+tests of multiprocessing code use the 'fork' start method.
+"""
+
+import ctypes
+import time
+
+import pytest
+
+from standin import StandIn
+
+STANDIN = StandIn(devices=2, speed=4)
+
+
+def _load_uvclite():
+    real_cdll = ctypes.CDLL
+
+    def _cdll(name, *args, **kwargs):
+        if name is not None and 'uvc' in name:
+            return STANDIN
+        return real_cdll(name, *args, **kwargs)
+
+    ctypes.CDLL = _cdll
+    try:
+        import uvclite.libuvc
+    finally:
+        ctypes.CDLL = real_cdll
+    if uvclite.libuvc._libuvc is not STANDIN:
+        raise RuntimeError("uvclite was imported before the stand-in was installed")
+
+
+_load_uvclite()
+
+from uvclite import UVCContext, UVCFrameFormat
+
+YUYV = UVCFrameFormat.UVC_FRAME_FORMAT_YUYV
+MJPEG = UVCFrameFormat.UVC_FRAME_FORMAT_MJPEG
+
+# YUYV 320x240
+FRAME_SIZE = 320 * 240 * 2
+
+
+def wait_until(condition, timeout=5.0, interval=0.01):
+    """
+    Polls condition until it returns True, and returns its last result.
+    """
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return condition()
+        time.sleep(interval)
+    return True
+
+
+@pytest.fixture
+def standin():
+    return STANDIN
+
+
+@pytest.fixture
+def context(standin):
+    with UVCContext() as ctx:
+        yield ctx
+
+
+@pytest.fixture
+def device(context):
+    dev = context.find_device()
+    dev.open()
+    dev.set_stream_format(YUYV, 320, 240, 30)
+    yield dev
+    dev.close()
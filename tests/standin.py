@@ -0,0 +1,603 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" A pure Python stand-in for libuvc
+
+conftest.py hands a StandIn to libuvc.py in place of libuvc.so when
+uvclite is first imported.  It emulates a few cameras, with YUYV and
+MJPEG descriptors, streams delivering frames from a thread or to
+uvc_stream_get_frame(), and the reference counting of devices, device
+lists, handles, streams and descriptors.  get_counts() reports what is
+held, so leaks of any of them can be found without hardware.
+
+The frames carry no picture, every byte is the low byte of the frame
+sequence number.
+"""
+
+from collections import deque
+from ctypes import addressof, c_uint32, c_void_p, cast, create_string_buffer, \
+    memset, pointer, POINTER, sizeof
+import sys
+import threading
+import time
+
+__author__ = 'Eric Callahan'
+
+_SUCCESS = 0
+_ERROR_INVALID_PARAM = -2
+_ERROR_NO_DEVICE = -4
+_ERROR_BUSY = -6
+_ERROR_TIMEOUT = -7
+_ERROR_NOT_SUPPORTED = -12
+_ERROR_INVALID_MODE = -51
+
+# subtype, fourcc, uvc_frame_format value, bytes per pixel (0 for
+# compressed), frames as (width, height, frame rates)
+DEFAULT_FORMATS = (
+    (0x04, b'YUY2', 3, 2, ((640, 480, (30, 15)), (320, 240, (30, 15, 5)))),
+    (0x06, b'MJPG', 7, 0, ((1280, 720, (30,)), (640, 480, (30, 15))))
+)
+
+_FORMAT_ANY = 0
+_FORMAT_UNCOMPRESSED = 1
+_FORMAT_COMPRESSED = 2
+
+
+class _Function(object):
+    # a libuvc function, with the argtypes and restype attributes
+    # libuvc.py sets on ctypes functions
+    def __init__(self, func):
+        self._func = func
+        self.argtypes = None
+        self.restype = None
+
+    def __call__(self, *args):
+        return self._func(*args)
+
+
+def _target(arg):
+    # the object a byref() argument points to
+    return getattr(arg, '_obj', arg)
+
+
+def _value(arg):
+    # the address held by a c_void_p, byref(c_void_p) or int argument
+    arg = _target(arg)
+    return getattr(arg, 'value', arg)
+
+
+class _Stream(object):
+    def __init__(self, handle, mode, interval, size):
+        self.handle = handle
+        self.mode = mode
+        self.interval = interval
+        self.size = size
+        self.step = 0
+        self.buffer = create_string_buffer(size)
+        self.frame = None
+        self.sequence = 0
+        self.running = False
+        self.callback = None
+        self.user = None
+        self.thread = None
+        self.wake = threading.Event()
+        self.next_frame = None
+
+
+class StandIn(object):
+    """
+    Emulates libuvc for uvclite.libuvc.  Functions are looked up as
+    attributes, as on a CDLL, and every uvc_* function libuvc.py binds
+    is available; controls and power modes report
+    UVC_ERROR_NOT_SUPPORTED.
+
+    Params:
+    devices - number of cameras, with serial numbers STANDIN0, ...
+    speed   - frames are delivered speed times faster than the
+              negotiated frame rate
+    formats - descriptors, see DEFAULT_FORMATS
+    """
+    def __init__(self, devices=2, speed=1.0, formats=DEFAULT_FORMATS):
+        self.devices = devices
+        self.speed = speed
+        self.formats = formats
+        self._lock = threading.RLock()
+        self._next_id = 0x1000
+        self._refs = dict((index + 1, 0) for index in range(devices))
+        self._contexts = set()
+        self._lists = {}
+        self._handles = {}
+        self._streams = {}
+        self._descriptors = {}
+        self._format_descs = None
+        self._keep = []
+        self._counts = {
+            'ref_calls': 0,
+            'unref_calls': 0,
+            'frames': 0,
+            'violations': 0
+        }
+        self.violation_log = deque(maxlen=32)
+
+    def __getattr__(self, name):
+        if not name.startswith('uvc_'):
+            raise AttributeError(name)
+        func = _Function(getattr(self, '_' + name, self._not_supported))
+        self.__dict__[name] = func
+        return func
+
+    def _new_id(self):
+        with self._lock:
+            self._next_id += 1
+            return self._next_id
+
+    def _violation(self, message):
+        with self._lock:
+            self._counts['violations'] += 1
+            self.violation_log.append(message)
+
+    def get_counts(self):
+        """
+        Returns a dict of what is currently held: contexts, device_refs
+        (the sum over every device), device_lists, handles, streams,
+        running streams and descriptors, along with the number of
+        ref_calls, unref_calls, frames delivered and violations, calls
+        that released something not held or used a freed object.  See
+        violation_log for the latest of those.
+        """
+        with self._lock:
+            counts = dict(self._counts)
+            counts.update({
+                'contexts': len(self._contexts),
+                'device_refs': sum(self._refs.values()),
+                'device_lists': len(self._lists),
+                'handles': len(self._handles),
+                'streams': len(self._streams),
+                'running': sum(1 for s in self._streams.values() if s.running),
+                'descriptors': len(self._descriptors)
+            })
+        return counts
+
+    def stall(self, duration=None):
+        """
+        Stops frames on every running stream for duration seconds, or
+        until the stream is restarted if duration is None, as a camera
+        that stops sending would.
+        """
+        resume = time.monotonic() + (1e9 if duration is None else duration)
+        with self._lock:
+            for stream in self._streams.values():
+                if stream.running:
+                    stream.next_frame = resume
+
+    # contexts and devices
+
+    def _uvc_init(self, ctx, usb_ctx):
+        ctx_id = self._new_id()
+        with self._lock:
+            self._contexts.add(ctx_id)
+        _target(ctx).value = ctx_id
+        return _SUCCESS
+
+    def _uvc_exit(self, ctx):
+        ctx_id = _value(ctx)
+        with self._lock:
+            if ctx_id not in self._contexts:
+                self._violation("uvc_exit of unknown context %r" % ctx_id)
+                return
+            self._contexts.discard(ctx_id)
+
+    def _ref(self, dev):
+        with self._lock:
+            if dev not in self._refs:
+                self._violation("reference to unknown device %r" % dev)
+                return
+            self._refs[dev] += 1
+            self._counts['ref_calls'] += 1
+
+    def _unref(self, dev):
+        with self._lock:
+            if not self._refs.get(dev):
+                self._violation("uvc_unref_device of device %r with no references" % dev)
+                return
+            self._refs[dev] -= 1
+            self._counts['unref_calls'] += 1
+
+    def _uvc_ref_device(self, dev):
+        self._ref(_value(dev))
+
+    def _uvc_unref_device(self, dev):
+        self._unref(_value(dev))
+
+    def _serial(self, dev):
+        return b'STANDIN%d' % (dev - 1)
+
+    def _uvc_find_device(self, ctx, dev_pp, vendor_id, product_id, serial):
+        for dev in sorted(self._refs):
+            if vendor_id and vendor_id != 0x1d6b:
+                continue
+            if product_id and product_id != 0x0102:
+                continue
+            if serial and serial != self._serial(dev):
+                continue
+            self._ref(dev)
+            _target(dev_pp).value = dev
+            return _SUCCESS
+        return _ERROR_NO_DEVICE
+
+    def _uvc_get_device_list(self, ctx, list_pp):
+        devices = sorted(self._refs)
+        array = (c_void_p * (len(devices) + 1))(*(devices + [None]))
+        with self._lock:
+            self._lists[addressof(array)] = array
+        for dev in devices:
+            self._ref(dev)
+        _target(list_pp).contents = c_void_p.from_buffer(array)
+        return _SUCCESS
+
+    def _uvc_free_device_list(self, list_p, unref_devices):
+        address = addressof(list_p.contents)
+        with self._lock:
+            array = self._lists.pop(address, None)
+        if array is None:
+            self._violation("uvc_free_device_list of unknown list 0x%x" % address)
+            return
+        if unref_devices:
+            for dev in array:
+                if dev:
+                    self._unref(dev)
+
+    def _uvc_get_bus_number(self, dev):
+        return 1
+
+    def _uvc_get_device_address(self, dev):
+        return _value(dev) + 1
+
+    def _uvc_get_device_descriptor(self, dev, desc_pp):
+        from uvclite import libuvc
+        dev = _value(dev)
+        desc = libuvc.uvc_device_descriptor()
+        desc.idVendor = 0x1d6b
+        desc.idProduct = 0x0102
+        desc.bcdUVC = 0x0100
+        desc.serialNumber = self._serial(dev)
+        desc.manufacturer = b'uvclite'
+        desc.product = b'Stand-in camera %d' % (dev - 1)
+        with self._lock:
+            self._descriptors[addressof(desc)] = desc
+        _target(desc_pp).contents = desc
+        return _SUCCESS
+
+    def _uvc_free_device_descriptor(self, desc_p):
+        address = addressof(desc_p.contents)
+        with self._lock:
+            if self._descriptors.pop(address, None) is None:
+                self._violation("uvc_free_device_descriptor of unknown descriptor 0x%x"
+                                % address)
+
+    # handles
+
+    def _uvc_open(self, dev, handle_pp):
+        dev = _value(dev)
+        if dev not in self._refs:
+            return _ERROR_NO_DEVICE
+        handle = self._new_id()
+        # libuvc holds a device reference for every open handle
+        self._ref(dev)
+        with self._lock:
+            self._handles[handle] = dev
+        _target(handle_pp).value = handle
+        return _SUCCESS
+
+    def _uvc_close(self, handle):
+        handle = _value(handle)
+        with self._lock:
+            dev = self._handles.pop(handle, None)
+            streams = [s for s, stream in self._streams.items() if stream.handle == handle]
+        if dev is None:
+            self._violation("uvc_close of unknown handle %r" % handle)
+            return
+        for stream in streams:
+            self._uvc_stream_close(stream)
+        self._unref(dev)
+
+    def _uvc_get_device(self, handle):
+        return self._handles.get(_value(handle))
+
+    def _uvc_get_libusb_handle(self, handle):
+        return None
+
+    def _uvc_print_diag(self, handle, stream):
+        sys.stderr.write("uvclite stand-in camera, handle %r\n" % _value(handle))
+
+    def _uvc_strerror(self, err):
+        from uvclite import libuvc
+        try:
+            message = libuvc.str_error_map[libuvc.uvc_error(err)]
+        except (KeyError, ValueError):
+            message = 'Unknown Error'
+        return message.encode('utf8')
+
+    def _not_supported(self, *args):     # pylint: disable=unused-argument
+        return _ERROR_NOT_SUPPORTED
+
+    # descriptors and negotiation
+
+    def _uvc_get_format_descs(self, handle):
+        from uvclite import libuvc
+        with self._lock:
+            if self._format_descs is None:
+                self._format_descs = self._build_descs(libuvc)
+        return self._format_descs
+
+    def _build_descs(self, libuvc):
+        interface = libuvc.uvc_streaming_interface()
+        interface.bInterfaceNumber = 1
+        self._keep.append(interface)
+        first = previous = None
+        for index, (subtype, fourcc, _, _, frames) in enumerate(self.formats):
+            format_desc = libuvc.uvc_format_desc()
+            format_desc.parent = addressof(interface)
+            format_desc.bDescriptorSubtype = subtype
+            format_desc.bFormatIndex = index + 1
+            format_desc.bNumFrameDescriptors = len(frames)
+            format_desc.bDefaultFrameIndex = 1
+            for i, char in enumerate(bytearray(fourcc)):
+                format_desc.fourccFormat[i] = char
+            self._keep.append(format_desc)
+            previous_frame = None
+            for frame_index, (width, height, rates) in enumerate(frames):
+                frame_desc = libuvc.uvc_frame_desc()
+                frame_desc.parent = pointer(format_desc)
+                frame_desc.bDescriptorSubtype = subtype + 1
+                frame_desc.bFrameIndex = frame_index + 1
+                frame_desc.wWidth = width
+                frame_desc.wHeight = height
+                frame_desc.dwMaxVideoFrameBufferSize = self._max_size(index, width, height)
+                intervals = (c_uint32 * (len(rates) + 1))(
+                    *([10000000 // rate for rate in rates] + [0]))
+                frame_desc.bFrameIntervalType = len(rates)
+                frame_desc.dwDefaultFrameInterval = intervals[0]
+                frame_desc.intervals = cast(intervals, POINTER(c_uint32))
+                self._keep.extend((frame_desc, intervals))
+                if previous_frame is None:
+                    format_desc.frame_descs = pointer(frame_desc)
+                else:
+                    previous_frame.next = pointer(frame_desc)
+                previous_frame = frame_desc
+            if previous is None:
+                first = pointer(format_desc)
+            else:
+                previous.next = pointer(format_desc)
+            previous = format_desc
+        interface.format_descs = first
+        return first
+
+    def _max_size(self, format_index, width, height):
+        bpp = self.formats[format_index][3]
+        # compressed frames are at most a quarter of YUYV
+        return width * height * bpp if bpp else width * height // 2
+
+    def _find_mode(self, frame_format, width, height, frame_rate):
+        for index, (subtype, _, value, bpp, frames) in enumerate(self.formats):
+            if frame_format == _FORMAT_UNCOMPRESSED:
+                match = bool(bpp)
+            elif frame_format == _FORMAT_COMPRESSED:
+                match = not bpp
+            else:
+                match = frame_format in (_FORMAT_ANY, value)
+            if not match:
+                continue
+            for frame_index, (frame_width, frame_height, rates) in enumerate(frames):
+                if (frame_width, frame_height) == (width, height) and frame_rate in rates:
+                    return index, frame_index, subtype
+        return None
+
+    def _fill_ctrl(self, ctrl, format_index, frame_index, interval):
+        width, height = self.formats[format_index][4][frame_index][:2]
+        ctrl.bmHint = 1
+        ctrl.bFormatIndex = format_index + 1
+        ctrl.bFrameIndex = frame_index + 1
+        ctrl.dwFrameInterval = interval
+        ctrl.dwMaxVideoFrameSize = self._max_size(format_index, width, height)
+        ctrl.dwMaxPayloadTransferSize = 3072
+        ctrl.dwClockFrequency = 48000000
+        ctrl.bInterfaceNumber = 1
+
+    def _uvc_get_stream_ctrl_format_size(self, handle, ctrl_p, frame_format, width,
+                                         height, frame_rate):
+        if _value(handle) not in self._handles:
+            return _ERROR_INVALID_PARAM
+        found = self._find_mode(frame_format, width, height, frame_rate)
+        if found is None:
+            return _ERROR_INVALID_MODE
+        memset(addressof(_target(ctrl_p)), 0, sizeof(_target(ctrl_p)))
+        self._fill_ctrl(_target(ctrl_p), found[0], found[1], 10000000 // frame_rate)
+        return _SUCCESS
+
+    def _ctrl_mode(self, ctrl):
+        # (format index, frame index, interval) of a stream control
+        format_index, frame_index = ctrl.bFormatIndex - 1, ctrl.bFrameIndex - 1
+        if not 0 <= format_index < len(self.formats):
+            return None
+        frames = self.formats[format_index][4]
+        if not 0 <= frame_index < len(frames):
+            return None
+        intervals = [10000000 // rate for rate in frames[frame_index][2]]
+        interval = ctrl.dwFrameInterval
+        if interval not in intervals:
+            interval = min(intervals, key=lambda i: abs(i - interval))
+        return format_index, frame_index, interval
+
+    def _uvc_probe_stream_ctrl(self, handle, ctrl_p):
+        ctrl = _target(ctrl_p)
+        mode = self._ctrl_mode(ctrl)
+        if mode is None:
+            return _ERROR_INVALID_MODE
+        self._fill_ctrl(ctrl, *mode)
+        return _SUCCESS
+
+    # streams
+
+    def _configure(self, stream, ctrl):
+        mode = self._ctrl_mode(ctrl)
+        if mode is None:
+            return False
+        format_index, frame_index, interval = mode
+        width, height = self.formats[format_index][4][frame_index][:2]
+        stream.mode = (self.formats[format_index][2], width, height)
+        stream.step = width * self.formats[format_index][3]
+        stream.interval = interval / 10000000.0
+        stream.size = self._max_size(format_index, width, height)
+        if len(stream.buffer) < stream.size:
+            stream.buffer = create_string_buffer(stream.size)
+        return True
+
+    def _uvc_stream_open_ctrl(self, handle, stream_pp, ctrl_p):
+        handle = _value(handle)
+        with self._lock:
+            if handle not in self._handles:
+                return _ERROR_INVALID_PARAM
+            # one streaming interface per device
+            if any(s.handle == handle for s in self._streams.values()):
+                return _ERROR_BUSY
+            stream = _Stream(handle, None, None, 0)
+            if not self._configure(stream, _target(ctrl_p)):
+                return _ERROR_INVALID_MODE
+            stream_id = self._new_id()
+            self._streams[stream_id] = stream
+        _target(stream_pp).value = stream_id
+        return _SUCCESS
+
+    def _get_stream(self, stream_p):
+        stream = self._streams.get(_value(stream_p))
+        if stream is None:
+            self._violation("use of unknown stream %r" % _value(stream_p))
+        return stream
+
+    def _uvc_stream_ctrl(self, stream_p, ctrl_p):
+        stream = self._get_stream(stream_p)
+        if stream is None:
+            return _ERROR_INVALID_PARAM
+        if stream.running:
+            return _ERROR_BUSY
+        return _SUCCESS if self._configure(stream, _target(ctrl_p)) else _ERROR_INVALID_MODE
+
+    def _next_frame(self, stream):
+        from uvclite import libuvc
+        stream.sequence += 1
+        memset(stream.buffer, stream.sequence & 0xff, stream.size)
+        now = time.time()
+        # libuvc hands out the same frame struct for every frame
+        stream.frame = libuvc.uvc_frame(
+            addressof(stream.buffer), stream.size, stream.mode[1], stream.mode[2],
+            stream.mode[0], stream.step,
+            stream.sequence, libuvc._timeval(int(now), int((now % 1) * 1000000)),
+            None, 1)
+        with self._lock:
+            self._counts['frames'] += 1
+        return stream.frame
+
+    def _wait_frame(self, stream, timeout=None):
+        # sleeps until the next frame is due, False on timeout or stop
+        period = stream.interval / self.speed
+        now = time.monotonic()
+        if stream.next_frame is None or stream.next_frame < now - period:
+            stream.next_frame = now
+        delay = stream.next_frame - now
+        if timeout is not None and delay > timeout:
+            stream.wake.wait(timeout)
+            return False
+        if delay > 0 and stream.wake.wait(delay):
+            return False
+        stream.next_frame += period
+        return stream.running
+
+    def _deliver(self, stream):
+        while stream.running:
+            if self._wait_frame(stream):
+                stream.callback(pointer(self._next_frame(stream)), stream.user)
+
+    def _uvc_stream_start(self, stream_p, callback, user, flags):
+        stream = self._get_stream(stream_p)
+        if stream is None:
+            return _ERROR_INVALID_PARAM
+        if stream.running:
+            return _ERROR_BUSY
+        stream.running = True
+        stream.wake.clear()
+        stream.next_frame = None
+        stream.callback = callback if callback else None
+        stream.user = user
+        if stream.callback is not None:
+            stream.thread = threading.Thread(target=self._deliver, args=(stream,),
+                                             name='uvclite-standin-stream')
+            stream.thread.daemon = True
+            stream.thread.start()
+        return _SUCCESS
+
+    def _uvc_stream_get_frame(self, stream_p, frame_pp, timeout_us):
+        stream = self._get_stream(stream_p)
+        if stream is None or not stream.running or stream.callback is not None:
+            return _ERROR_INVALID_PARAM
+        if timeout_us < 0:
+            timeout = 0.0
+        else:
+            timeout = timeout_us / 1000000.0 if timeout_us else None
+        if not self._wait_frame(stream, timeout):
+            if timeout_us < 0:
+                frame_p = _target(frame_pp)
+                memset(addressof(frame_p), 0, sizeof(frame_p))
+                return _SUCCESS
+            return _ERROR_TIMEOUT
+        _target(frame_pp).contents = self._next_frame(stream)
+        return _SUCCESS
+
+    def _uvc_stream_stop(self, stream_p):
+        stream = self._get_stream(stream_p)
+        if stream is None or not stream.running:
+            return _ERROR_INVALID_PARAM
+        stream.running = False
+        stream.wake.set()
+        thread, stream.thread = stream.thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        return _SUCCESS
+
+    def _uvc_stream_close(self, stream_p):
+        stream = self._get_stream(stream_p)
+        if stream is None:
+            return
+        if stream.running:
+            self._uvc_stream_stop(stream_p)
+        with self._lock:
+            self._streams.pop(_value(stream_p), None)
+
+    def _uvc_start_streaming(self, handle, ctrl_p, callback, user, flags):
+        stream_p = c_void_p()
+        ret = self._uvc_stream_open_ctrl(handle, stream_p, ctrl_p)
+        if ret == _SUCCESS:
+            ret = self._uvc_stream_start(stream_p, callback, user, flags)
+            if ret != _SUCCESS:
+                self._uvc_stream_close(stream_p)
+        return ret
+
+    def _uvc_stop_streaming(self, handle):
+        handle = _value(handle)
+        with self._lock:
+            streams = [s for s, stream in self._streams.items() if stream.handle == handle]
+        for stream in streams:
+            self._uvc_stream_close(stream)
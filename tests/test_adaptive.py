@@ -0,0 +1,100 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import queue
+
+import pytest
+
+from uvclite import UVCMode
+from uvclite.adaptive import AdaptiveController
+
+from conftest import MJPEG, YUYV, wait_until
+
+
+def test_modes_are_ordered_repeatably(device):
+    modes = [UVCMode(YUYV, 320, 240, 30, 0), UVCMode(YUYV, 640, 480, 15, 0),
+             UVCMode(MJPEG, 640, 480, 30, 0), UVCMode(YUYV, 640, 240, 15, 0)]
+    first = AdaptiveController(device, modes=modes).modes
+    second = AdaptiveController(device, modes=list(reversed(modes))).modes
+    assert first == second
+    # equal cost, the larger frame first
+    assert first.index(UVCMode(YUYV, 640, 240, 15, 0)) < \
+        first.index(UVCMode(YUYV, 320, 240, 30, 0))
+
+
+def test_put_requires_a_queue(device):
+    with pytest.raises(ValueError):
+        AdaptiveController(device).put(object())
+
+
+def test_polling_switch_waits_for_get_frame(device):
+    device.set_stream_format(YUYV, 640, 480, 30)
+    controller = AdaptiveController(device, queue.Queue(2), min_dwell=0)
+    device.start_streaming()
+    try:
+        device.get_frame()
+        controller.frame_dropped()
+        assert controller.evaluate() is None
+        # nothing happens until the polling thread reads a frame
+        assert device._format_args[1:] == (640, 480, 30)
+        assert not controller.decisions
+        frame = device.get_frame()
+        assert device._format_args[1:] == (640, 480, 15)
+        assert (frame.width, frame.height) == (640, 480)
+        assert controller.mode.frame_rate == 15
+        assert controller.decisions[-1][-1]
+    finally:
+        device.stop_streaming()
+
+
+def test_callback_switch_is_immediate(device):
+    device.set_stream_format(YUYV, 640, 480, 30)
+    frames = queue.Queue(2)
+    controller = AdaptiveController(device, frames, min_dwell=0)
+    device.set_callback(lambda frame, user: controller.put(frame))
+    device.start_streaming()
+    try:
+        assert wait_until(frames.full)
+        mode = controller.evaluate()
+        assert mode is not None
+        assert device._format_args == (mode.frame_format, mode.width, mode.height,
+                                       mode.frame_rate)
+        assert controller.decisions[-1][-1]
+    finally:
+        device.stop_streaming()
+
+
+def test_polling_switch_abandoned_when_streaming_stops(device):
+    device.set_stream_format(YUYV, 640, 480, 30)
+    controller = AdaptiveController(device, queue.Queue(2), min_dwell=0)
+    device.start_streaming()
+    try:
+        device.get_frame()
+        controller.frame_dropped()
+        assert controller.evaluate() is None
+    finally:
+        device.stop_streaming()
+    assert device._deferred_switch is None
+    assert not controller.decisions[-1][-1]
+    assert device._format_args[1:] == (640, 480, 30)
+    # the controller is no longer waiting on the polling thread
+    device.start_streaming()
+    try:
+        device.get_frame()
+        controller.frame_dropped()
+        assert controller.evaluate() is None
+        assert device._deferred_switch is not None
+    finally:
+        device.stop_streaming()
@@ -0,0 +1,78 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import pytest
+
+from uvclite.bandwidth import BandwidthPlanner, ModeEstimate
+
+
+@pytest.fixture
+def devices(context):
+    devices = list(context.get_device_list())
+    for device in devices:
+        device.open()
+    yield devices
+    for device in devices:
+        device.close()
+
+
+def _fake_estimates(planner, monkeypatch):
+    # the stand-in reports the same payload size for every mode, so
+    # reservations are made to follow the frame rate instead
+    def _estimate(name, mode):
+        reserved = mode.frame_rate * 100
+        return ModeEstimate(mode, reserved, mode.max_frame_size, reserved,
+                            mode.max_frame_size * mode.frame_rate, True)
+    monkeypatch.setattr(planner, 'estimate', _estimate)
+
+
+def test_devices_on_separate_buses_fit(devices):
+    planner = BandwidthPlanner()
+    for bus, device in enumerate(devices):
+        planner.add_device(device, bus=bus)
+    plan = planner.plan()
+    assert plan.fits
+    assert not plan.unplaced
+    for report in plan.buses.values():
+        assert report['reserved'] <= report['budget']
+
+
+def test_largest_reservation_steps_down(devices, monkeypatch):
+    planner = BandwidthPlanner(bus_budget=4500)
+    _fake_estimates(planner, monkeypatch)
+    first = planner.add_device(devices[0], bus=1)
+    second = planner.add_device(devices[1], bus=1)
+    plan = planner.plan()
+    assert plan.fits
+    assert plan.buses[1]['reserved'] <= 4500
+    rates = sorted([plan.assignments[first].mode.frame_rate,
+                    plan.assignments[second].mode.frame_rate])
+    assert rates == [15, 30]
+
+
+def test_unplaced_device_does_not_fit(devices):
+    planner = BandwidthPlanner()
+    placed = planner.add_device(devices[0], bus=1)
+    unplaced = planner.add_device(devices[1], bus=2, modes=[])
+    plan = planner.plan()
+    assert plan.assignments[placed] is not None
+    assert plan.unplaced == [unplaced]
+    assert not plan.fits
+    assert plan.as_dict()['unplaced'] == [unplaced]
+    # apply() still sets the devices that were placed
+    plan.apply()
+    assert devices[0]._format_set
+    assert not devices[1]._format_set
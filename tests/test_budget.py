@@ -0,0 +1,95 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from uvclite.budget import BudgetedQueue, DROP_OLDEST, FrameBudget
+
+from conftest import FRAME_SIZE
+
+
+def test_drop_oldest_evicts_from_queue(device):
+    budget = FrameBudget(3 * FRAME_SIZE, policy=DROP_OLDEST)
+    name = budget.add_device(device)
+    frames = BudgetedQueue(budget, 'consumer')
+    device.start_streaming()
+    try:
+        for _ in range(3):
+            frames.put(device.get_frame())
+        assert budget.usage()['devices'][name]['consumers'] == {'consumer': 3 * FRAME_SIZE}
+        # held here, so the evicted frame is not collected
+        oldest = frames.queue[0]
+        frames.put(device.get_frame())
+    finally:
+        device.stop_streaming()
+    assert frames.evicted == 1
+    assert frames.qsize() == 3
+    assert frames.queue[0].sequence > oldest.sequence
+    assert budget.get_stats()['evicted'] == 1
+    assert budget.get_stats()['held'] == 3 * FRAME_SIZE
+    budget.remove_device(device)
+
+
+def test_released_frames_return_their_charge(device):
+    budget = FrameBudget(3 * FRAME_SIZE)
+    budget.add_device(device)
+    device.start_streaming()
+    try:
+        frame = device.get_frame()
+        assert budget.get_stats()['held'] == FRAME_SIZE
+        del frame
+        assert budget.get_stats()['held'] == 0
+    finally:
+        device.stop_streaming()
+        budget.remove_device(device)
+
+
+def test_remove_device_not_under_budget(device):
+    budget = FrameBudget(FRAME_SIZE)
+    budget.remove_device(device)
+    budget.add_device(device)
+    budget.remove_device(device)
+    budget.remove_device(device)
+    assert device.budget is None
+
+
+def test_readded_device_keeps_its_account(device):
+    budget = FrameBudget(3 * FRAME_SIZE)
+    name = budget.add_device(device)
+    device.start_streaming()
+    try:
+        frame = device.get_frame()
+    finally:
+        device.stop_streaming()
+    budget.remove_device(device)
+    assert budget.add_device(device) == name
+    assert budget.usage()['devices'][name]['held'] == FRAME_SIZE
+    del frame
+    assert budget.usage()['devices'][name]['held'] == 0
+    assert budget.get_stats()['held'] == 0
+    budget.remove_device(device)
+    assert budget.usage()['devices'] == {}
+
+
+def test_removed_device_account_dropped_with_last_frame(device):
+    budget = FrameBudget(3 * FRAME_SIZE)
+    name = budget.add_device(device)
+    device.start_streaming()
+    try:
+        frame = device.get_frame()
+    finally:
+        device.stop_streaming()
+    budget.remove_device(device)
+    assert name in budget.usage()['devices']
+    del frame
+    assert budget.usage() == {'limit': 3 * FRAME_SIZE, 'held': 0, 'devices': {}}
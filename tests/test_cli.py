@@ -0,0 +1,68 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+
+from uvclite.__main__ import main, parse_mode
+
+from conftest import FRAME_SIZE, MJPEG, YUYV
+
+
+def _run(capsys, *argv):
+    code = main(list(argv))
+    return code, capsys.readouterr()
+
+
+def test_parse_mode():
+    assert parse_mode('yuyv:320x240@30') == (YUYV, 320, 240, 30)
+    assert parse_mode('MJPEG:1280x720@30') == (MJPEG, 1280, 720, 30)
+
+
+def test_list(standin, capsys):
+    code, out = _run(capsys, 'list', '--json')
+    assert code == 0
+    devices = json.loads(out.out)
+    assert [d['serial'] for d in devices] == ['STANDIN0', 'STANDIN1']
+
+
+def test_formats(standin, capsys):
+    code, out = _run(capsys, 'formats', '--device', 'STANDIN1', '--json')
+    assert code == 0
+    formats = json.loads(out.out)
+    assert [f['fourcc'] for f in formats] == ['YUY2', 'MJPG']
+    assert formats[0]['frames'][1]['frame_rates'] == [30.0, 15.0, 5.0]
+
+
+def test_bench(standin, capsys):
+    code, out = _run(capsys, 'bench', '--mode', 'YUYV:320x240@30', '--duration', '0.5')
+    assert code == 0
+    result, = json.loads(out.out)
+    assert result['error'] is None
+    assert result['frames'] > 1
+    assert result['bytes'] == result['frames'] * FRAME_SIZE
+    # the first frame starts the clock and counts for neither rate
+    assert abs(result['bytes_per_sec'] - result['fps'] * FRAME_SIZE) < 1.0
+
+
+def test_bench_invalid_mode(standin, capsys):
+    code, out = _run(capsys, 'bench', '--mode', 'YUYV:123x45@30', '--duration', '0.1')
+    assert code == 1
+    assert json.loads(out.out)[0]['error'] == 'Invalid mode'
+
+
+def test_unknown_device(standin, capsys):
+    code, out = _run(capsys, 'formats', '--device', 'NOPE')
+    assert code == 1
+    assert 'No such device' in out.err
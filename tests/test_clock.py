@@ -0,0 +1,77 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import random
+
+import pytest
+
+from uvclite.clock import ClockSync
+
+
+def _feed(clock, count, rate=1.0, offset=100.0, jitter=0.0, start=0.0):
+    mapped = None
+    for i in range(count):
+        capture = start + i / 30.0
+        arrival = offset + capture * rate + random.random() * jitter
+        mapped = clock.update(capture, arrival)
+    return mapped
+
+
+def test_fit_follows_offset_and_drift():
+    clock = ClockSync(forgetting=1.0, wall_clock=False)
+    _feed(clock, 300, rate=1.0001)
+    assert clock.drift == pytest.approx(100, abs=1)
+    assert clock.to_host(10.0) == pytest.approx(100.0 + 10.0 * 1.0001, abs=1e-6)
+    stats = clock.get_stats()
+    assert stats['samples'] == 300
+    assert stats['latency_avg'] is None
+
+
+def test_fit_smooths_jitter():
+    random.seed(1)
+    clock = ClockSync(wall_clock=False)
+    _feed(clock, 300, jitter=0.004)
+    # the fit lies inside the arrival jitter, shifted by its mean
+    assert 100.0 <= clock.to_host(5.0) - 5.0 <= 100.004
+    assert 0 < clock.get_stats()['jitter_max'] <= 0.004
+
+
+def test_clock_step_restarts_fit():
+    clock = ClockSync(step_threshold=0.5, wall_clock=False)
+    _feed(clock, 50)
+    mapped = _feed(clock, 50, offset=200.0, start=50 / 30.0)
+    assert clock.resets == 1
+    assert clock.get_stats()['samples'] == 50
+    assert mapped == pytest.approx(200.0 + 99 / 30.0)
+
+
+def test_unfitted_clock_maps_nothing():
+    clock = ClockSync()
+    assert clock.to_host(1.0) is None
+    assert clock.offset is None
+
+
+def test_frames_carry_host_time(device):
+    device.start_streaming()
+    try:
+        frames = [device.get_frame() for _ in range(5)]
+    finally:
+        device.stop_streaming()
+    for frame in frames:
+        assert frame.arrival_time is not None
+        assert frame.host_time is not None
+    times = [frame.host_time for frame in frames]
+    assert times == sorted(times)
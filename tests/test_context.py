@@ -0,0 +1,43 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import pytest
+
+from conftest import YUYV
+
+
+def test_start_devices(context):
+    devices = list(context.get_device_list())
+    assert len(devices) == 2
+    formats = [(YUYV, 320, 240, 30), None]
+    reports = context.start_devices(devices, formats, frame_timeout=2.0)
+    try:
+        assert [r.device for r in reports] == devices
+        for report in reports:
+            assert report.ok, report.error
+            assert report.first_frame_time <= report.total_time
+            assert report.device.is_streaming
+    finally:
+        for device in devices:
+            device.stop_streaming()
+            device.close()
+
+
+def test_start_devices_checks_formats(context):
+    devices = list(context.get_device_list())
+    with pytest.raises(ValueError):
+        context.start_devices(devices, [(YUYV, 320, 240, 30)])
+    assert not any(device._handle_p for device in devices)
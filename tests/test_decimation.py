@@ -0,0 +1,62 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import time
+
+from uvclite import _every_interval, _every_nth
+
+
+def test_every_nth_accepts_first_frame():
+    decimate = _every_nth(3)
+    assert [decimate(0.0) for _ in range(7)] == [True, False, False, True,
+                                                 False, False, True]
+
+
+def test_every_interval_stays_on_grid():
+    decimate = _every_interval(0.1)
+    accepted = [now for now in (0.0, 0.05, 0.1, 0.12, 0.21, 0.5, 0.55, 0.6)
+                if decimate(now)]
+    # 0.21 is late for 0.2 but keeps the grid, 0.5 fell behind it
+    assert accepted == [0.0, 0.1, 0.21, 0.5, 0.6]
+
+
+def test_polling_decimation(device):
+    device.set_decimation(every=3)
+    device.start_streaming()
+    try:
+        frames = [device.get_frame() for _ in range(4)]
+    finally:
+        device.stop_streaming()
+    gaps = [b.sequence - a.sequence for a, b in zip(frames, frames[1:])]
+    assert all(gap >= 3 for gap in gaps)
+    assert device.get_stats()['decimated'] >= 6
+
+
+def test_latest_only_delivers_requested_frames(device):
+    frames = []
+    device.set_callback(lambda frame, user: frames.append(frame))
+    device.set_decimation(latest=True)
+    device.start_streaming()
+    try:
+        assert device.wait_for_frame(2.0)
+        time.sleep(0.1)
+        assert not frames
+        frame = device.get_latest_frame(timeout=2.0)
+        assert frame is not None
+        assert frames == [frame]
+    finally:
+        device.stop_streaming()
+    assert device.get_stats()['decimated'] > 0
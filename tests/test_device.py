@@ -0,0 +1,176 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+
+import pytest
+
+from uvclite import libuvc, UVCContext, UVCError
+
+from conftest import FRAME_SIZE, YUYV, wait_until
+
+
+def test_close_releases_libuvc_objects(standin):
+    before = standin.get_counts()
+    with UVCContext() as ctx:
+        dev = ctx.find_device()
+        dev.open()
+        dev.start_streaming()
+        dev.get_frame()
+        dev.stop_streaming()
+        dev.close()
+    after = standin.get_counts()
+    for key in ('contexts', 'device_refs', 'device_lists', 'handles', 'streams',
+                'descriptors'):
+        assert after[key] == before[key], key
+    assert after['violations'] == before['violations']
+
+
+def test_watchdog_recovers_callback_stream(device, standin):
+    frames = []
+    device.set_callback(lambda frame, user: frames.append(frame.sequence))
+    device.start_streaming()
+    try:
+        assert device.wait_for_frame(2.0)
+        device.start_watchdog(stall_timeout=0.3)
+        standin.stall()
+        assert wait_until(lambda: device.get_stats()['recoveries'] >= 1)
+        count = len(frames)
+        assert wait_until(lambda: len(frames) > count)
+        assert device.get_stats()['recommits'] == 1
+    finally:
+        device.stop_watchdog()
+        device.stop_streaming()
+
+
+def test_watchdog_retries_failed_recovery_after_stall_timeout(device, standin,
+                                                             monkeypatch):
+    attempts = []
+
+    def _recover():
+        attempts.append(time.time())
+        raise UVCError("recovery failed", 5)
+
+    device.set_callback(lambda frame, user: None)
+    device.start_streaming()
+    try:
+        assert device.wait_for_frame(2.0)
+        monkeypatch.setattr(device, 'recover', _recover)
+        device.start_watchdog(stall_timeout=0.2, check_interval=0.02)
+        standin.stall()
+        assert wait_until(lambda: len(attempts) >= 2)
+        time.sleep(0.5)
+        # once per stall_timeout rather than on every check
+        assert len(attempts) <= 6
+        gaps = [b - a for a, b in zip(attempts, attempts[1:])]
+        assert min(gaps) > 0.15
+    finally:
+        device.stop_watchdog()
+        device.stop_streaming()
+
+
+def test_watchdog_defers_polling_recovery(device, standin):
+    device.start_streaming()
+    try:
+        device.get_frame()
+        device.start_watchdog(stall_timeout=0.3)
+        standin.stall()
+        assert wait_until(lambda: device._recovery_pending)
+        # recovery waits for the polling thread
+        assert device.get_stats()['recoveries'] == 0
+        frame = device.get_frame(timeout=1000000)
+        assert frame.width == 320
+        assert device.get_stats()['recoveries'] == 1
+    finally:
+        device.stop_watchdog()
+        device.stop_streaming()
+
+
+def test_switch_format_while_streaming(device):
+    sizes = []
+    device.set_callback(lambda frame, user: sizes.append((frame.width, frame.height)))
+    device.start_streaming()
+    try:
+        assert device.wait_for_frame(2.0)
+        report = device.switch_format(YUYV, 640, 480, 15)
+        assert report['reused_stream']
+        assert wait_until(lambda: report['gap_time'] is not None)
+        assert sizes[-1] == (640, 480)
+        assert device.get_stats()['format_switches'] == 1
+    finally:
+        device.stop_streaming()
+
+
+def test_failed_switch_keeps_old_format(device, monkeypatch):
+    device.start_streaming()
+    try:
+        device.get_frame()
+        old_ctrl = device._stream_ctrl
+        real_start = libuvc.uvc_stream_start
+        calls = []
+
+        def _start(*args):
+            # both attempts in the new format fail
+            calls.append(args)
+            if len(calls) <= 2:
+                return libuvc.uvc_error.UVC_ERROR_IO.value
+            return real_start(*args)
+
+        monkeypatch.setattr(libuvc, 'uvc_stream_start', _start)
+        with pytest.raises(UVCError):
+            device.switch_format(YUYV, 640, 480, 15)
+        assert device._format_args == (YUYV, 320, 240, 30)
+        assert device._stream_ctrl is old_ctrl
+        assert device.is_streaming
+        frame = device.get_frame()
+        assert (frame.width, frame.height) == (320, 240)
+        assert device.get_stats()['format_switches'] == 0
+    finally:
+        device.stop_streaming()
+
+
+def test_get_frames_fills_batch_with_zero_timeout(device):
+    device.start_streaming()
+    try:
+        # 0 blocks until the batch is full, as get_frame() blocks
+        batch = device.get_frames(3, timeout=0, use_numpy=False)
+        assert batch.count == 3
+        assert batch.slot_size >= FRAME_SIZE
+    finally:
+        device.stop_streaming()
+
+
+def test_get_frames_nonblocking(device):
+    device.start_streaming()
+    try:
+        device.get_frame()
+        start = time.time()
+        batch = device.get_frames(50, timeout=-1, use_numpy=False)
+        assert time.time() - start < 0.05
+        assert batch.count < 50
+    finally:
+        device.stop_streaming()
+
+
+def test_get_frames_timeout_returns_partial_batch(device):
+    device.start_streaming()
+    try:
+        start = time.time()
+        batch = device.get_frames(1000, timeout=200000, use_numpy=False)
+        elapsed = time.time() - start
+        assert 0.15 < elapsed < 1.0
+        assert 0 < batch.count < 1000
+    finally:
+        device.stop_streaming()
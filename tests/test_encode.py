@@ -0,0 +1,81 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+
+pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+
+from uvclite.encode import JPEGEncoder
+
+from conftest import wait_until
+
+
+@pytest.fixture
+def encoder():
+    encoder = JPEGEncoder(workers=2, backend='PIL', max_in_flight=4, start_method='fork')
+    encoder.start()
+    yield encoder
+    encoder.stop()
+
+
+def test_encodes_in_order(encoder, device):
+    device.set_raw_callback(encoder.raw_callback)
+    device.start_streaming()
+    try:
+        encoded = [encoder.get(timeout=10.0) for _ in range(8)]
+    finally:
+        device.stop_streaming()
+    sequences = [e.sequence for e in encoded]
+    assert sequences == sorted(sequences)
+    assert all(e.data[:2] == b'\xff\xd8' for e in encoded)
+    assert (encoded[0].width, encoded[0].height) == (320, 240)
+
+
+def test_results_awaiting_release_count_as_in_flight(encoder, device):
+    device.set_raw_callback(encoder.raw_callback)
+    device.start_streaming()
+    try:
+        encoder.get(timeout=10.0)
+    finally:
+        device.stop_streaming()
+    assert wait_until(lambda: not encoder._pending and not encoder._done)
+    encoder._done.update((1000 + i, None) for i in range(encoder.max_in_flight))
+    try:
+        # every block is free, but the results held back fill the window
+        assert encoder._free
+        assert encoder._acquire(16) is None
+        assert encoder.get_stats()['dropped'] >= 1
+    finally:
+        encoder._done.clear()
+
+
+def test_worker_killed_during_submit(encoder, device):
+    device.start_streaming()
+    try:
+        frames = [device.get_frame() for _ in range(6)]
+    finally:
+        device.stop_streaming()
+    dead = encoder._workers[0]
+    dead.process.kill()
+    dead.process.join()
+    # the first submit goes to the dead worker, both queues being empty
+    for frame in frames:
+        encoder.submit(frame)
+    assert wait_until(lambda: dead not in encoder._workers)
+    assert wait_until(lambda: not encoder._pending and not encoder._done)
+    assert len(encoder._free) == encoder.max_in_flight
+    assert encoder.submit(frames[0])
+    assert encoder.get(timeout=10.0).data[:2] == b'\xff\xd8'
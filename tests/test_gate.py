@@ -0,0 +1,102 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+from ctypes import addressof, create_string_buffer
+
+import pytest
+
+from uvclite import gate, libuvc
+from uvclite.gate import ChangeGate
+
+from conftest import MJPEG, YUYV
+
+_buffers = []
+
+
+def _frame(data, frame_format=YUYV, width=32, height=16):
+    buf = create_string_buffer(bytes(data), len(data))
+    # kept alive for the duration of the test run
+    _buffers.append(buf)
+    frame = libuvc.uvc_frame()
+    frame.data = addressof(buf)
+    frame.data_bytes = len(data)
+    frame.width = width
+    frame.height = height
+    frame.frame_format = frame_format.value
+    frame.step = width * 2 if frame_format == YUYV else 0
+    return frame
+
+
+def _yuyv(luma):
+    return bytes([luma, 128]) * (32 * 16)
+
+
+@pytest.fixture(params=['numpy', 'python'])
+def luma_path(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(gate, 'numpy', None)
+    return request.param
+
+
+def test_raw_frames_pass_on_luma_change(luma_path):
+    change_gate = ChangeGate(threshold=4.0, step=4, keepalive=None)
+    assert change_gate.check(_frame(_yuyv(100)), 0.0)
+    assert not change_gate.check(_frame(_yuyv(102)), 0.1)
+    assert change_gate.last_score == pytest.approx(2.0)
+    # slow changes accumulate against the reference
+    assert change_gate.check(_frame(_yuyv(104)), 0.2)
+    stats = change_gate.get_stats()
+    assert (stats['checked'], stats['passed'], stats['suppressed']) == (3, 2, 1)
+
+
+def test_keepalive_passes_static_scene():
+    change_gate = ChangeGate(keepalive=1.0)
+    assert change_gate.check(_frame(_yuyv(100)), 0.0)
+    assert not change_gate.check(_frame(_yuyv(100)), 0.5)
+    assert change_gate.check(_frame(_yuyv(100)), 1.0)
+    assert change_gate.get_stats()['keepalives'] == 1
+
+
+def test_mjpeg_duplicates_and_size_changes():
+    change_gate = ChangeGate(size_threshold=0.1, keepalive=None)
+    jpeg = b'\xff\xd8' + bytes(range(256)) * 4 + b'\xff\xd9'
+    assert change_gate.check(_frame(jpeg, MJPEG), 0.0)
+    assert not change_gate.check(_frame(jpeg, MJPEG), 0.1)
+    assert change_gate.get_stats()['duplicates'] == 1
+    assert change_gate.check(_frame(jpeg + bytes(200), MJPEG), 0.2)
+
+
+def test_format_change_resets_reference():
+    change_gate = ChangeGate(keepalive=None)
+    assert change_gate.check(_frame(_yuyv(100)), 0.0)
+    assert change_gate.check(_frame(_yuyv(100)[:32 * 8 * 2], height=8), 0.1)
+
+
+def test_device_gate_drops_unchanged_frames(device):
+    # no change reaches the threshold, so only keepalives get through
+    change_gate = ChangeGate(threshold=256.0, keepalive=0.1)
+    device.set_gate(change_gate)
+    device.start_streaming()
+    try:
+        first = device.get_frame()
+        second = device.get_frame()
+    finally:
+        device.stop_streaming()
+    assert second.sequence - first.sequence > 1
+    assert device.get_stats()['gated'] >= 1
+    assert change_gate.get_stats()['keepalives'] == 1
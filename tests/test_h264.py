@@ -0,0 +1,40 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from uvclite import h264
+
+SPS = b'\x00\x00\x00\x01\x67\x42\x00\x1f'
+PPS = b'\x00\x00\x01\x68\xce\x3c\x80'
+IDR = b'\x00\x00\x01\x65\x88\x84\x00'
+SLICE = b'\x00\x00\x01\x41\x9a\x02\x00'
+
+
+def test_scan_access_unit():
+    unit = h264.scan_access_unit(SPS + PPS + IDR)
+    assert unit.keyframe
+    assert unit.parameter_sets
+    assert unit.nal_types == (h264.NAL_SPS, h264.NAL_PPS, h264.NAL_IDR)
+    unit = h264.scan_access_unit(SLICE)
+    assert not unit.keyframe
+    assert not unit.parameter_sets
+
+
+def test_is_keyframe():
+    assert h264.is_keyframe(IDR)
+    assert not h264.is_keyframe(SLICE)
+
+
+def test_does_not_shadow_inspect():
+    assert not hasattr(h264, 'inspect')
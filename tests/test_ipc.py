@@ -0,0 +1,154 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+from ctypes import addressof, create_string_buffer
+import itertools
+import multiprocessing
+import os
+
+import pytest
+
+from uvclite import libuvc
+from uvclite.ipc import FramePublisher, FrameSubscriber, Overrun
+
+from conftest import YUYV, wait_until
+
+_names = itertools.count()
+
+
+def _frame(sequence, size=256):
+    buf = create_string_buffer(bytes([sequence & 0xff]) * size, size)
+    frame = libuvc.uvc_frame()
+    frame.data = addressof(buf)
+    frame.data_bytes = size
+    frame.width = 16
+    frame.height = 8
+    frame.frame_format = YUYV.value
+    frame.sequence = sequence
+    frame._buf = buf
+    return frame
+
+
+@pytest.fixture
+def name():
+    return 'test-%d-%d' % (os.getpid(), next(_names))
+
+
+@pytest.fixture
+def publisher(name):
+    publisher = FramePublisher(name, slot_size=256, slots=4)
+    publisher.start()
+    yield publisher
+    publisher.close()
+
+
+@pytest.fixture
+def subscriber(name, publisher):
+    subscriber = FrameSubscriber(name, retry_interval=0.01)
+    # connect, frames are only announced to connected subscribers
+    assert subscriber.get(timeout=0.05) is None
+    assert wait_until(lambda: publisher.subscribers == 1)
+    yield subscriber
+    subscriber.close()
+
+
+def test_frames_are_read_in_place(publisher, subscriber):
+    for sequence in range(3):
+        publisher.raw_callback(_frame(sequence), 1.5)
+    for sequence in range(3):
+        frame = subscriber.get(timeout=1.0)
+        assert (frame.sequence, frame.index, frame.size) == (sequence, sequence, 256)
+        assert (frame.width, frame.height, frame.frame_format) == (16, 8, YUYV.value)
+        assert frame.timestamp == 1.5
+        assert frame.copy() == bytes([sequence]) * 256
+        frame.release()
+    assert publisher.get_stats()['published'] == 3
+
+
+def test_overwritten_frames_are_skipped(publisher, subscriber):
+    # a ring of 4, so the first frame is overwritten by the fifth
+    for sequence in range(5):
+        publisher.raw_callback(_frame(sequence), 0.0)
+    assert subscriber.get(timeout=1.0).sequence == 1
+    assert subscriber.get_stats()['overruns'] == 1
+
+
+def test_copy_detects_overrun(publisher, subscriber):
+    publisher.raw_callback(_frame(0), 0.0)
+    frame = subscriber.get(timeout=1.0)
+    for sequence in range(1, 5):
+        publisher.raw_callback(_frame(sequence), 0.0)
+    assert not frame.valid()
+    with pytest.raises(Overrun):
+        frame.copy()
+    frame.release()
+
+
+def test_latest_skips_older_frames(publisher, subscriber):
+    for sequence in range(3):
+        publisher.raw_callback(_frame(sequence), 0.0)
+    assert subscriber.latest().sequence == 2
+    for sequence in range(3, 6):
+        publisher.raw_callback(_frame(sequence), 0.0)
+    assert subscriber.latest().sequence == 5
+    assert subscriber.latest() is None
+    stats = subscriber.get_stats()
+    assert (stats['received'], stats['skipped'], stats['missed']) == (2, 4, 0)
+
+
+def test_subscriber_follows_publisher_restart(name, publisher, subscriber):
+    publisher.close()
+    publisher.start()
+    assert subscriber.get(timeout=0.2) is None
+    assert wait_until(lambda: publisher.subscribers == 1)
+    publisher.raw_callback(_frame(7), 0.0)
+    assert subscriber.get(timeout=1.0).copy() == bytes([7]) * 256
+    stats = subscriber.get_stats()
+    assert (stats['attaches'], stats['disconnects']) == (2, 1)
+
+
+def _subscribe(name, conn):
+    with FrameSubscriber(name, retry_interval=0.01) as subscriber:
+        subscriber.get(timeout=0.05)
+        conn.send('connected')
+        frames = [subscriber.get(timeout=5.0) for _ in range(2)]
+        conn.send([(frame.sequence, frame.copy()) for frame in frames])
+        for frame in frames:
+            frame.release()
+
+
+def test_subscriber_in_another_process(name, publisher, device):
+    parent_conn, child_conn = multiprocessing.Pipe()
+    process = multiprocessing.get_context('fork').Process(target=_subscribe,
+                                                          args=(name, child_conn))
+    process.start()
+    try:
+        assert parent_conn.poll(5.0) and parent_conn.recv() == 'connected'
+        assert wait_until(lambda: publisher.subscribers == 1)
+        device.set_raw_callback(publisher.raw_callback)
+        device.start_streaming()
+        try:
+            assert parent_conn.poll(5.0)
+            received = parent_conn.recv()
+        finally:
+            device.stop_streaming()
+    finally:
+        process.join(5.0)
+    assert [len(data) for _, data in received] == [256, 256]
+    # the stand-in fills each frame with its sequence number
+    for sequence, data in received:
+        assert data == bytes([sequence & 0xff]) * 256
+    assert publisher.get_stats()['truncated'] >= 2
@@ -0,0 +1,98 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+from ctypes import addressof, create_string_buffer
+import struct
+
+from uvclite import libuvc, mjpeg
+from uvclite.mjpeg import MJPEGValidator, validate
+
+from conftest import MJPEG
+
+
+def _segment(marker, payload):
+    return b'\xff' + bytes([marker]) + struct.pack('>H', len(payload) + 2) + payload
+
+
+def _jpeg(width=64, height=48, scan=b'\x12\x34' * 100, padding=0):
+    sof = struct.pack('>BHHB', 8, height, width, 1) + b'\x01\x11\x00'
+    sos = b'\x01\x01\x00\x00\x3f\x00'
+    return (mjpeg.SOI + _segment(0xe0, b'JFIF\x00' + bytes(9)) + _segment(0xc0, sof) +
+            _segment(0xda, sos) + scan + mjpeg.EOI + bytes(padding))
+
+
+def _frame(data, width=64, height=48):
+    buf = create_string_buffer(data, len(data))
+    frame = libuvc.uvc_frame()
+    frame.data = addressof(buf)
+    frame.data_bytes = len(data)
+    frame.width = width
+    frame.height = height
+    frame.frame_format = MJPEG.value
+    frame._buf = buf
+    return frame
+
+
+def test_valid_images():
+    assert validate(_jpeg()) is None
+    assert validate(_jpeg(padding=100)) is None
+    assert validate(_jpeg(), 64, 48) is None
+
+
+def test_structural_errors():
+    image = _jpeg()
+    assert validate(image[2:]) == mjpeg.NO_SOI
+    assert validate(image[:-2]) == mjpeg.NO_EOI
+    assert validate(image + b'\x01\x02') == mjpeg.NO_EOI
+    assert validate(image[:30]) == mjpeg.BAD_SEGMENT
+    assert validate(image, 32, 48) == mjpeg.DIMENSIONS
+    no_sof = image.replace(b'\xff\xc0', b'\xff\xe1', 1)
+    assert validate(no_sof) == mjpeg.NO_SOF
+    assert validate(mjpeg.SOI + mjpeg.EOI + bytes(2)) == mjpeg.NO_SOS
+
+
+def test_prefix_of_larger_image():
+    image = _jpeg()
+    assert validate(image[:40], size=len(image)) is None
+    assert validate(image[:10], size=len(image)) == mjpeg.TRUNCATED
+
+
+def test_validator_reads_head_and_tail_of_large_frames():
+    validator = MJPEGValidator(header_size=64, tail_size=32)
+    assert validator.check(_frame(_jpeg(scan=b'\x55' * 4096)))
+    assert validator.check(_frame(_jpeg(scan=b'\x55' * 4096, padding=200)))
+    assert not validator.check(_frame(_jpeg(scan=b'\x55' * 4096)[:-2]))
+    assert not validator.check(_frame(_jpeg(), width=32))
+    assert validator.check_bytes(_jpeg())
+    stats = validator.get_stats()
+    assert (stats['checked'], stats['valid'], stats['invalid']) == (5, 3, 2)
+    assert stats['reasons'][mjpeg.NO_EOI] == 1
+    assert stats['reasons'][mjpeg.DIMENSIONS] == 1
+
+
+def test_device_flags_invalid_frames(device):
+    # the stand-in's MJPEG frames are not JPEG images
+    validator = MJPEGValidator()
+    device.set_stream_format(MJPEG, 640, 480, 30)
+    device.set_validator(validator, drop=False)
+    device.start_streaming()
+    try:
+        frame = device.get_frame()
+    finally:
+        device.stop_streaming()
+    assert frame.valid is False
+    assert device.get_stats()['invalid'] == 1
+    assert validator.get_stats()['reasons'][mjpeg.NO_SOI] == 1
@@ -0,0 +1,89 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import random
+import time
+
+from uvclite.pipeline import Pipeline
+
+from conftest import wait_until
+
+
+def test_ordered_stage_keeps_input_order():
+    results = []
+
+    def _slow(value):
+        time.sleep(random.random() * 0.005)
+        return value * 2
+
+    pipeline = Pipeline()
+    pipeline.add_stage('double', _slow, workers=4, queue_size=64)
+    pipeline.add_stage('collect', results.append)
+    pipeline.start()
+    try:
+        for value in range(50):
+            assert pipeline.feed(value)
+    finally:
+        pipeline.stop()
+    assert results == [value * 2 for value in range(50)]
+
+
+def test_filtered_and_failed_items_are_counted():
+    results = []
+
+    def _check(value):
+        if value == 3:
+            raise ValueError(value)
+        return value if value % 2 else None
+
+    pipeline = Pipeline()
+    pipeline.add_stage('check', _check, workers=2)
+    pipeline.add_stage('collect', results.append)
+    pipeline.start()
+    try:
+        for value in range(8):
+            pipeline.feed(value)
+    finally:
+        pipeline.stop()
+    assert results == [1, 5, 7]
+    stats = pipeline.get_stats()['check']
+    assert (stats['processed'], stats['filtered'], stats['errors']) == (3, 4, 1)
+
+
+def test_source_drops_when_first_stage_is_full():
+    pipeline = Pipeline()
+    pipeline.add_stage('idle', lambda value: value, queue_size=2)
+    # not started, so nothing drains the queue
+    assert pipeline.feed(1)
+    assert pipeline.feed(2)
+    assert not pipeline.feed(3)
+    assert pipeline.get_stats()['source'] == {'captured': 2, 'dropped': 1,
+                                              'capture_errors': 0}
+
+
+def test_polling_capture_feeds_frames(device):
+    sequences = []
+    pipeline = Pipeline(device)
+    pipeline.add_stage('sequence', lambda frame: frame.sequence)
+    pipeline.add_stage('collect', sequences.append)
+    device.start_streaming()
+    pipeline.start()
+    try:
+        assert wait_until(lambda: len(sequences) >= 5)
+    finally:
+        pipeline.stop()
+        device.stop_streaming()
+    assert sequences == sorted(sequences)
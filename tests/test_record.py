@@ -0,0 +1,116 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import random
+
+import pytest
+
+from uvclite import record
+from uvclite.record import RawReader, RawRecorder
+
+from conftest import YUYV
+
+SIZE = 64 * 48 * 2
+
+
+def _frames(count, seed=1):
+    # a static scene with a few changing blocks per frame
+    rand = random.Random(seed)
+    frame = bytearray(rand.getrandbits(8) for _ in range(SIZE))
+    frames = []
+    for _ in range(count):
+        for _ in range(3):
+            pos = rand.randrange(SIZE)
+            frame[pos] = rand.getrandbits(8)
+        frames.append(bytes(frame))
+    return frames
+
+
+def _record(path, frames, **kwargs):
+    with RawRecorder(path, **kwargs) as recorder:
+        for index, data in enumerate(frames):
+            recorder.write_raw(data, YUYV.value, 64, 48, index + 1, 10.0 + index)
+    return recorder.get_stats()
+
+
+@pytest.mark.parametrize('compress_level', [None, 1])
+def test_round_trip(tmpdir, compress_level):
+    path = str(tmpdir.join('frames.uvcraw'))
+    frames = _frames(25)
+    stats = _record(path, frames, keyframe_interval=10, compress_level=compress_level)
+    assert stats['keyframes'] == 3
+    assert stats['written_bytes'] < sum(len(f) for f in frames) // 2
+    with RawReader(path) as reader:
+        assert reader.complete
+        assert len(reader) == 25
+        assert [bytes(f.data) for f in reader] == frames
+        # random access decodes from the nearest keyframe
+        assert bytes(reader.read(17).data) == frames[17]
+        assert bytes(reader.read(3).data) == frames[3]
+        frame = reader.read(-1)
+        assert (frame.sequence, frame.width, frame.height) == (25, 64, 48)
+        assert frame.frame_format == YUYV
+
+
+def test_seek_time(tmpdir):
+    path = str(tmpdir.join('frames.uvcraw'))
+    _record(path, _frames(25), keyframe_interval=10)
+    with RawReader(path) as reader:
+        assert reader.seek_time(0.0) == 0
+        assert reader.seek_time(23.5) == 13
+        assert reader.seek_time(100.0) == 24
+
+
+def test_unclosed_recording_is_scanned(tmpdir):
+    path = str(tmpdir.join('frames.uvcraw'))
+    frames = _frames(12)
+    _record(path, frames, keyframe_interval=5)
+    # cut off the index and trailer, and half of the last record
+    with RawReader(path) as reader:
+        end = reader._end
+    with open(path, 'r+b') as out:
+        out.truncate(end - 10)
+    with RawReader(path) as reader:
+        assert not reader.complete
+        assert len(reader) == 11
+        assert [bytes(f.data) for f in reader] == frames[:11]
+
+
+def test_pure_python_deltas_match(monkeypatch):
+    previous, current = _frames(2)
+    payload = record.encode_delta(previous, current)
+    monkeypatch.setattr(record, 'numpy', None)
+    assert record.encode_delta(previous, current) == payload
+    assert bytes(record.apply_delta(previous, payload)) == current
+
+
+def test_records_device_stream(tmpdir, device):
+    path = str(tmpdir.join('device.uvcraw'))
+    recorder = RawRecorder(path)
+    device.set_raw_callback(recorder.raw_callback)
+    device.start_streaming()
+    try:
+        assert device.wait_for_frame(2.0)
+    finally:
+        device.stop_streaming()
+    recorder.close()
+    assert os.path.getsize(path) > 0
+    with RawReader(path) as reader:
+        assert len(reader) >= 1
+        frame = reader.read(0)
+        assert (frame.width, frame.height) == (320, 240)
+        # the stand-in fills frames with the low byte of the sequence
+        assert set(bytearray(frame.data)) == set([frame.sequence & 0xff])
@@ -0,0 +1,104 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import pytest
+
+numpy = pytest.importorskip('numpy')
+
+from uvclite import libuvc
+from uvclite.resize import _area_weights, _synthetic_frame, frame_array, Resizer
+
+_fmt = libuvc.uvc_frame_format
+
+
+def _luma(frame):
+    # the luma plane of a YUYV frame, without the row padding
+    return frame_array(frame)[:, :frame.width * 2:2].astype(numpy.float64)
+
+
+def test_area_integer_ratio_is_exact():
+    frame = _synthetic_frame(_fmt.UVC_FRAME_FORMAT_YUYV, 64, 48)
+    out = Resizer(16, 12).resize(frame)
+    expected = _luma(frame).reshape(12, 4, 16, 4).mean(axis=(1, 3))
+    assert out.shape == (12, 16)
+    assert numpy.abs(out - expected).max() <= 0.5
+
+
+def test_area_fractional_ratio_is_close():
+    frame = _synthetic_frame(_fmt.UVC_FRAME_FORMAT_YUYV, 64, 48)
+    # a smooth scene, random noise has no neighbouring pixels alike
+    y, x = numpy.mgrid[0:48, 0:64]
+    frame_array(frame)[:, :128:2] = 128 + 100 * numpy.sin(x / 9.0) * numpy.cos(y / 7.0)
+    out = Resizer(24, 20).resize(frame)
+    luma = _luma(frame)
+    expected = _area_weights(48, 20) @ luma @ _area_weights(64, 24).T
+    error = numpy.abs(out - expected)
+    assert error.mean() < 1.0
+    assert error.max() < 3.0
+
+
+def test_nearest_picks_source_pixels():
+    frame = _synthetic_frame(_fmt.UVC_FRAME_FORMAT_GRAY8, 60, 45)
+    image = frame_array(frame)[:, :60]
+    out = Resizer(20, 15, method='nearest').resize(frame)
+    assert (out == image[::3, ::3]).all()
+    out = Resizer(25, 20, method='nearest').resize(frame)
+    rows = numpy.arange(20) * 45 // 20
+    cols = numpy.arange(25) * 60 // 25
+    assert (out == image[rows][:, cols]).all()
+
+
+def test_color_output_keeps_layout():
+    resizer = Resizer(32, 24, gray=False)
+    frame = _synthetic_frame(_fmt.UVC_FRAME_FORMAT_YUYV, 64, 48)
+    assert resizer.resize(frame).shape == (24, 16, 4)
+    assert resizer.output_shape(_fmt.UVC_FRAME_FORMAT_RGB, 64, 48) == (24, 32, 3)
+
+
+def test_rgb_to_gray():
+    frame = _synthetic_frame(_fmt.UVC_FRAME_FORMAT_RGB, 16, 8)
+    pixels = frame_array(frame)[:, :48].reshape(8, 16, 3).astype(numpy.uint32)
+    expected = (pixels[:, :, 0] * 77 + pixels[:, :, 1] * 150 + pixels[:, :, 2] * 29) >> 8
+    out = Resizer(16, 8).resize(frame)
+    assert (out == expected).all()
+
+
+def test_out_array_is_written():
+    resizer = Resizer(16, 12)
+    frame = _synthetic_frame(_fmt.UVC_FRAME_FORMAT_GRAY8, 64, 48)
+    out = numpy.zeros(resizer.output_shape(_fmt.UVC_FRAME_FORMAT_GRAY8, 64, 48),
+                      dtype=numpy.uint8)
+    result = resizer.resize(frame, out)
+    assert (out == resizer.resize(frame)).all()
+    assert result.base is out or result is out
+
+
+def test_unsupported_input():
+    with pytest.raises(ValueError):
+        Resizer(16, 12).output_shape(_fmt.UVC_FRAME_FORMAT_MJPEG, 64, 48)
+    with pytest.raises(ValueError):
+        Resizer(15, 12, gray=False).output_shape(_fmt.UVC_FRAME_FORMAT_YUYV, 64, 48)
+    with pytest.raises(ValueError):
+        Resizer(16, 12, method='cubic')
+
+
+def test_resize_captured_frame(device):
+    device.start_streaming()
+    try:
+        frame = device.get_frame()
+    finally:
+        device.stop_streaming()
+    assert Resizer(160, 120).resize(frame).shape == (120, 160)
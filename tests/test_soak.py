@@ -0,0 +1,39 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+from uvclite import UVCDevice
+from uvclite.soak import SoakHarness
+
+
+def _harness(**kwargs):
+    return SoakHarness(cycles=60, sample_every=20, stream_every=10, context_every=25,
+                       traced_limit=None, **kwargs)
+
+
+def test_clean_run_passes(standin):
+    report = _harness().run()
+    assert report.ok, report.failures
+    assert report.cycles == 60
+    assert len(report.samples) == 3
+    # counted libuvc objects are sampled when the library can count them
+    assert report.samples[0].libuvc['violations'] == standin.get_counts()['violations']
+
+
+def test_leaked_descriptors_fail(standin, monkeypatch):
+    monkeypatch.setattr(UVCDevice, 'free_device_descriptor', lambda self: None)
+    report = _harness(fail_fast=False).run()
+    assert not report.ok
+    assert any('descriptors' in failure for failure in report.failures)
+    assert report.as_dict()['ok'] is False
@@ -0,0 +1,61 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import os
+import signal
+
+import pytest
+
+from uvclite.supervisor import CameraSpec, Supervisor
+
+from conftest import YUYV, wait_until
+
+
+@pytest.fixture
+def supervisor(standin):
+    supervisor = Supervisor([CameraSpec('front', serial='STANDIN0',
+                                        mode=(YUYV, 320, 240, 30))],
+                            backoff=0.1, stats_interval=0.1, start_method='fork')
+    supervisor.start()
+    yield supervisor
+    supervisor.stop()
+
+
+def test_publishes_frames(supervisor):
+    subscriber = supervisor.subscribe('front')
+    try:
+        frame = subscriber.get(timeout=10.0)
+        assert frame is not None
+        assert (frame.width, frame.height) == (320, 240)
+    finally:
+        subscriber.close()
+    assert wait_until(lambda: supervisor.get_stats()['front']['device'].get('frames'))
+
+
+def test_restarts_killed_worker(supervisor):
+    subscriber = supervisor.subscribe('front', retry_interval=0.1)
+    try:
+        assert subscriber.get(timeout=10.0) is not None
+        pid = supervisor.get_stats()['front']['pid']
+        os.kill(pid, signal.SIGKILL)
+        assert wait_until(lambda: supervisor.get_stats()['front']['restarts'] == 1, 10.0)
+        assert wait_until(lambda: supervisor.get_stats()['front']['state'] == 'running',
+                          10.0)
+        assert supervisor.get_stats()['front']['pid'] != pid
+        # the subscriber follows the new worker's ring
+        frame = subscriber.get(timeout=10.0)
+        assert frame is not None
+    finally:
+        subscriber.close()
@@ -0,0 +1,71 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import pytest
+
+from uvclite.sync import frame_timestamp, FrameSynchronizer
+
+
+class _Frame(object):
+    def __init__(self, sequence, host_time=None, arrival_time=None):
+        self.sequence = sequence
+        self.host_time = host_time
+        self.arrival_time = arrival_time
+
+
+def test_frame_timestamp():
+    assert frame_timestamp(_Frame(1, 2.0, 3.0)) == 2.0
+    assert frame_timestamp(_Frame(1, None, 3.0)) == 3.0
+    with pytest.raises(ValueError):
+        frame_timestamp(_Frame(1))
+
+
+def test_matches_within_tolerance():
+    sync = FrameSynchronizer(['left', 'right'], tolerance=0.005)
+    assert sync.push('left', _Frame(1, 1.000)) == 0
+    assert sync.push('right', _Frame(1, 1.003)) == 1
+    frame_set = sync.get(timeout=0)
+    assert frame_set['left'].sequence == frame_set['right'].sequence == 1
+    assert frame_set.skew == pytest.approx(0.003)
+    assert frame_set.timestamp == pytest.approx(1.0015)
+
+
+def test_stale_frames_are_discarded():
+    sync = FrameSynchronizer(['left', 'right'], tolerance=0.005)
+    sync.push('left', _Frame(1, 1.000))
+    sync.push('left', _Frame(2, 1.033))
+    # right dropped its first frame, so left's first cannot match
+    assert sync.push('right', _Frame(2, 1.034)) == 1
+    assert sync.get(timeout=0)['left'].sequence == 2
+    stats = sync.get_stats()
+    assert stats['stale'] == 1
+    assert stats['stale_by_camera'] == {'left': 1, 'right': 0}
+
+
+def test_late_frames_keep_the_buffer_sorted():
+    sync = FrameSynchronizer(['left', 'right'], tolerance=0.005)
+    sync.push('left', _Frame(2, 1.033))
+    sync.push('left', _Frame(1, 1.000))
+    sync.push('right', _Frame(1, 1.001))
+    assert sync.get(timeout=0)['left'].sequence == 1
+
+
+def test_untimed_frames_are_skipped():
+    sync = FrameSynchronizer(['left', 'right'])
+    assert sync.push('left', _Frame(1)) == 0
+    stats = sync.get_stats()
+    assert stats['untimed'] == 1
+    assert stats['buffered'] == {'left': 0, 'right': 0}
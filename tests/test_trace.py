@@ -0,0 +1,104 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import pytest
+
+from uvclite import trace
+
+from conftest import wait_until
+
+
+@pytest.fixture
+def ring():
+    ring = trace.SpanRing(1000)
+    trace.add_hook(ring)
+    trace.enable()
+    yield ring
+    trace.disable()
+    trace.remove_hook(ring)
+
+
+def test_libuvc_calls_are_traced(ring, device):
+    device.start_streaming()
+    device.get_frame()
+    device.stop_streaming()
+    names = set(span.name for span in ring.recent())
+    assert 'uvc_stream_get_frame' in names
+    assert 'uvc_stream_stop' in names
+
+
+def test_raw_callbacks_are_traced(ring, device):
+    device.set_raw_callback(lambda frame, timestamp, user: None)
+    device.start_streaming()
+    try:
+        assert wait_until(lambda: ring.recent(name='frame_callback'))
+    finally:
+        device.stop_streaming()
+
+
+def test_batch_callbacks_are_traced(ring, device):
+    batches = []
+    device.set_batch_callback(lambda batch, user: batches.append(batch.count), 2,
+                              use_numpy=False)
+    device.start_streaming()
+    try:
+        assert wait_until(lambda: batches)
+    finally:
+        device.stop_streaming()
+    assert len(ring.recent(name='frame_callback')) == len(batches)
+
+
+def test_span_records_exceptions(ring):
+    metrics = trace.PrometheusMetrics()
+    trace.add_hook(metrics)
+    try:
+        with pytest.raises(KeyError):
+            with trace.span('lookup'):
+                raise KeyError('missing')
+        with trace.span('lookup'):
+            pass
+    finally:
+        trace.remove_hook(metrics)
+    failed, succeeded = ring.recent(name='lookup')
+    assert failed.error == 'KeyError'
+    assert succeeded.error is None
+    assert 'uvclite_call_errors_total{call="lookup",code="KeyError"} 1' in \
+        metrics.render()
+
+
+def test_raising_calls_are_traced(ring):
+    def _fail(*args):
+        raise TypeError('bad argument')
+    traced = trace._wrap('uvc_fail', _fail)
+    with pytest.raises(TypeError):
+        traced(1)
+    span, = ring.recent(name='uvc_fail')
+    assert span.error == 'TypeError'
+
+
+def test_hook_removed_while_spans_finish(ring):
+    class _Once(trace.TraceHook):
+        def span_finished(self, span):
+            trace.remove_hook(self)
+
+    once = _Once()
+    trace.remove_hook(ring)
+    trace.add_hook(once)
+    trace.add_hook(ring)
+    with trace.span('work'):
+        pass
+    # removing the first hook did not skip the next
+    assert len(ring.recent(name='work')) == 1
+    assert once not in trace._hooks
@@ -0,0 +1,90 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import time
+
+import pytest
+
+from uvclite import UVCError
+from uvclite import transport
+from uvclite.transport import FrameReceiver, FrameSender, parse_batch
+
+from conftest import FRAME_SIZE, YUYV, wait_until
+
+
+@pytest.fixture
+def link():
+    receiver = FrameReceiver('127.0.0.1', 0)
+    receiver.start()
+    sender = FrameSender('127.0.0.1', receiver.address[1], device_id=3, linger=0.001)
+    sender.start()
+    yield sender, receiver
+    sender.stop()
+    receiver.close()
+
+
+def _frame_header(sequence, size, capture_time=1.5, host_time=float('nan')):
+    return transport._FRAME.pack(1, YUYV.value, 4, 2, sequence, capture_time, host_time,
+                                 size)
+
+
+def test_parse_batch():
+    body = _frame_header(7, 3) + b'abc' + _frame_header(8, 2, host_time=2.5) + b'de'
+    first, second = parse_batch(body, 2, peer='peer')
+    assert (first.sequence, bytes(first.data), first.frame_format) == (7, b'abc', YUYV)
+    assert first.capture_time == 1.5
+    assert first.host_time is None
+    assert (second.sequence, bytes(second.data), second.host_time) == (8, b'de', 2.5)
+    assert second.peer == 'peer'
+
+
+def test_parse_batch_truncated():
+    body = _frame_header(7, 10) + b'abc'
+    with pytest.raises(UVCError):
+        parse_batch(body, 1)
+
+
+def test_raw_frames_carry_both_clocks(link, device):
+    sender, receiver = link
+    device.set_raw_callback(sender.raw_callback)
+    device.start_streaming()
+    try:
+        frame = receiver.get(timeout=5.0)
+    finally:
+        device.stop_streaming()
+    assert frame.device_id == 3
+    assert (frame.width, frame.height, len(frame.data)) == (320, 240, FRAME_SIZE)
+    # capture_time is always the wall clock, host_time the monotonic one
+    assert abs(frame.capture_time - time.time()) < 5.0
+    assert abs(frame.host_time - time.monotonic()) < 5.0
+
+
+def test_sent_frames_keep_capture_time(link, device):
+    sender, receiver = link
+    device.start_streaming()
+    try:
+        sent = [device.get_frame() for _ in range(5)]
+    finally:
+        device.stop_streaming()
+    for frame in sent:
+        assert sender.send(frame)
+    received = [receiver.get(timeout=5.0) for _ in sent]
+    assert [f.sequence for f in received] == [f.sequence for f in sent]
+    assert [f.capture_time for f in received] == [f.capture_time for f in sent]
+    assert [f.host_time for f in received] == [f.host_time for f in sent]
+    assert bytes(received[-1].data) == bytes(sent[-1].data)
+    assert wait_until(lambda: sender.get_stats()['sent'] == 5)
+    assert sender.get_stats()['batches'] <= 5
+
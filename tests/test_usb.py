@@ -0,0 +1,129 @@
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+
+import threading
+
+import pytest
+
+from uvclite import libuvc, usb, UVCContext, UVCError
+
+from conftest import wait_until
+
+
+class _LibUSB(object):
+    # the libusb functions USBContext uses, libusb itself not being
+    # needed to test the reference counting and event thread
+
+    def __init__(self):
+        self.contexts = set()
+        self.exits = 0
+        self._next = 0x1000
+        self._interrupt = threading.Event()
+
+    def libusb_init(self, ctx_p):
+        self._next += 1
+        ctx_p._obj.value = self._next
+        self.contexts.add(self._next)
+        return 0
+
+    def libusb_exit(self, ctx):
+        self.contexts.discard(ctx.value)
+        self.exits += 1
+
+    def libusb_handle_events_timeout_completed(self, ctx, tv, completed):
+        if self._interrupt.wait(0.01):
+            self._interrupt.clear()
+            return -4
+        return 0
+
+    def libusb_interrupt_event_handler(self, ctx):
+        self._interrupt.set()
+
+    def libusb_error_name(self, code):
+        return b'LIBUSB_ERROR_OTHER'
+
+
+@pytest.fixture
+def libusb(monkeypatch):
+    lib = _LibUSB()
+    monkeypatch.setattr(usb, '_libusb', lib)
+    monkeypatch.setattr(usb, '_shared', None)
+    return lib
+
+
+def test_last_release_closes_context(libusb):
+    ctx = usb.USBContext(event_thread=False)
+    assert ctx.acquire() is ctx
+    assert ctx.refs == 2
+    ctx.release()
+    assert not ctx.is_closed
+    ctx.release()
+    assert ctx.is_closed
+    assert libusb.exits == 1
+    assert not libusb.contexts
+    with pytest.raises(UVCError):
+        ctx.acquire()
+
+
+def test_event_thread(libusb):
+    ctx = usb.USBContext()
+    try:
+        assert ctx.event_thread_running
+        assert wait_until(lambda: ctx.get_stats()['event_loops'] > 2)
+        ctx.stop_event_thread()
+        assert not ctx.event_thread_running
+        loops = ctx.get_stats()['event_loops']
+        # an interrupt the stopped thread did not see may end this call
+        assert ctx.handle_events(0.0) in (0, -4)
+        assert ctx.get_stats()['event_loops'] == loops + 1
+    finally:
+        ctx.release()
+    assert not ctx.get_stats()['event_thread']
+
+
+def test_uvc_contexts_share_usb_context(libusb, monkeypatch):
+    handles = []
+    real_init = libuvc.uvc_init
+
+    def _init(ctx_p, usb_ctx):
+        handles.append(usb_ctx.value if usb_ctx else None)
+        return real_init(ctx_p, usb_ctx)
+
+    monkeypatch.setattr(libuvc, 'uvc_init', _init)
+    with UVCContext(shared_usb=True) as first, UVCContext(shared_usb=True) as second:
+        shared = first.usb_context
+        assert second.usb_context is shared
+        assert shared.refs == 2
+        assert handles == [shared.handle.value] * 2
+        assert second.find_device() is not None
+    assert shared.is_closed
+    assert usb._shared is None
+    assert libusb.exits == 1
+
+
+def test_uvc_context_holds_a_reference(libusb):
+    ctx = usb.USBContext(event_thread=False)
+    with UVCContext(usb_context=ctx) as uvc_context:
+        assert uvc_context.usb_context is ctx
+        assert ctx.refs == 2
+    assert ctx.refs == 1
+    ctx.release()
+    assert ctx.is_closed
+
+
+def test_default_context_owns_its_libusb():
+    with UVCContext() as context:
+        assert context.usb_context is None
@@ -18,22 +18,62 @@
 
 """
 
-from ctypes import byref, POINTER, c_void_p
-import sys
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import byref, cast, POINTER, c_void_p
+import errno
+import logging
+import threading
 from . import libuvc
-if sys.version[0] == 2:
-    from builtins import range
-
+from . import trace as _trace
+from . import h264 as _h264
+from .clock import ClockSync, monotonic as _monotonic
+from .batch import FrameBatch, batch_layout, capture_timestamp
+from .watchdog import StreamWatchdog
 
 __author__ = 'Eric Callahan'
 
 __all__ = [
-    'UVCError', 'UVCFrame', 'UVCDevice', 'UVCContext', 'UVCFrameFormat'
+    'UVCError', 'UVCFrame', 'UVCDevice', 'UVCContext', 'UVCFrameFormat',
+    'StreamWatchdog', 'UVCMode', 'BringUpReport', 'ClockSync', 'FrameBatch',
+    'FrameBasedFormat', 'FRAME_FORMAT_H264'
 ]
 
+_logger = logging.getLogger(__name__)
+
 # UVC Enums
 UVCFrameFormat = libuvc.uvc_frame_format
 
+# A streaming mode supported by a device, see UVCDevice.get_supported_modes()
+UVCMode = namedtuple('UVCMode', ['frame_format', 'width', 'height',
+                                 'frame_rate', 'max_frame_size'])
+
+# fourcc codes of uncompressed format GUIDs, as matched by libuvc
+_fourcc_formats = {
+    b'YUY2': UVCFrameFormat.UVC_FRAME_FORMAT_YUYV,
+    b'UYVY': UVCFrameFormat.UVC_FRAME_FORMAT_UYVY,
+    b'Y800': UVCFrameFormat.UVC_FRAME_FORMAT_GRAY8,
+    b'BY8 ': UVCFrameFormat.UVC_FRAME_FORMAT_BY8
+}
+
+
+class FrameBasedFormat(namedtuple('FrameBasedFormat', ['fourcc'])):
+    """
+    A frame based format such as H.264, identified by the fourcc at
+    the start of its format GUID.  uvc_frame_format has no value for
+    these, so they are negotiated from the device's format descriptors
+    instead.  May be passed anywhere a UVCFrameFormat is accepted.
+    """
+    __slots__ = ()
+    value = UVCFrameFormat.UVC_FRAME_FORMAT_COMPRESSED.value
+
+    @property
+    def name(self):
+        return 'UVC_FRAME_FORMAT_' + self.fourcc.decode('ascii').strip()
+
+
+FRAME_FORMAT_H264 = FrameBasedFormat(b'H264')
+
 class UVCError(IOError):
     """
     Exception wrapper for libuvc error codes
@@ -42,6 +82,15 @@ class UVCError(IOError):
         IOError.__init__(self, strerror, errnum)
 
 
+def _call_traced(callback, *args):
+    # user frame callbacks of every kind are traced as 'frame_callback'
+    if _trace.enabled:
+        with _trace.span('frame_callback'):
+            callback(*args)
+    else:
+        callback(*args)
+
+
 def _check_error(errcode):
     err = libuvc.uvc_error(errcode)
     if err != libuvc.uvc_error.UVC_SUCCESS:
@@ -65,14 +114,35 @@ class UVCFrame(object):
     size    - size of the frame in bytes
     width   - frame width in pixels
     height  - frame height in pixels
+    sequence - frame sequence number assigned by libuvc
+    capture_time - capture timestamp from libuvc in seconds
+    arrival_time - host monotonic time the frame was received, or
+                   None if the frame was not received by a UVCDevice
+    host_time - capture_time mapped to the host monotonic clock by
+                the device's ClockSync, or None
     data    - a Python bytearray referencing the frame bytes
+    keyframe - for frame based H.264 streams, True if the frame
+               contains an IDR slice, otherwise None
+    valid   - False if the frame failed validation and was flagged
+              rather than dropped (see UVCDevice.set_validator()),
+              otherwise None or True
     """
-    def __init__(self, frame_p):
+    def __init__(self, frame_p, clock=None, arrival_time=None):
         self.frame = frame_p.contents
         self.size = self.frame.data_bytes
         self.width = self.frame.width
         self.height = self.frame.height
+        self.sequence = self.frame.sequence
+        capture_time = self.frame.capture_time
+        self.capture_time = capture_time.tv_sec + capture_time.tv_usec / 1000000.0
+        self.arrival_time = arrival_time
+        if clock is not None and arrival_time is not None:
+            self.host_time = clock.update(self.capture_time, arrival_time)
+        else:
+            self.host_time = None
         self.data = libuvc.buffer_at(self.frame.data, self.size)
+        self.valid = None
+        self.keyframe = None
 
 
 class UVCDevice(object):
@@ -93,11 +163,88 @@ class UVCDevice(object):
         self._format_set = False
         self._frame_callback = libuvc.uvc_null_frame_callback
         self._user_id = None
+        self._format_args = None
+        self._lock = threading.RLock()
+        self._watchdog = None
+        self._recovery_pending = False
+        self._last_frame_time = None
+        self._first_frame = threading.Event()
+        self.clock = ClockSync()
+        self._decimate = None
+        self._gate = None
+        self._validator = None
+        self._drop_invalid = True
+        self._frame_valid = None
+        # see budget.FrameBudget.add_device()
+        self.budget = None
+        self.budget_name = None
+        self._budget_charge = None
+        self._latest_only = False
+        self._frame_requested = False
+        self._requested_frame = None
+        self._requested_event = threading.Event()
+        self._batch_flush = None
+        self._quarantined = False
+        self._pending_switch = None
+        self._deferred_switch = None
+        self.stop_timeout = None
+        self._stats = {
+            'frames': 0,
+            'stalls': 0,
+            'recoveries': 0,
+            'recommits': 0,
+            'restreams': 0,
+            'reopens': 0,
+            'recovery_failures': 0,
+            'recovery_latency_last': None,
+            'recovery_latency_max': 0.0,
+            'recovery_latency_total': 0.0,
+            'stops': 0,
+            'stop_timeouts': 0,
+            'stop_time_last': None,
+            'stop_time_max': 0.0,
+            'stop_time_total': 0.0,
+            'format_switches': 0,
+            'switch_time_last': None,
+            'switch_gap_last': None,
+            'decimated': 0,
+            'gated': 0,
+            'invalid': 0,
+            'budget_dropped': 0
+        }
+
+    @property
+    def is_streaming(self):
+        """
+        True if a stream is currently open on this device
+        """
+        return bool(self._stream_handle_p)
+
+    @property
+    def is_polling(self):
+        """
+        True if no frame callback has been set
+        """
+        return not self._frame_callback
+
+    @property
+    def is_quarantined(self):
+        """
+        True if stopping the stream timed out.  A quarantined device
+        cannot be used again, and its handle is deliberately leaked
+        rather than closed, as libuvc may still be blocked on it.
+        """
+        return self._quarantined
+
+    def _check_quarantine(self):
+        if self._quarantined:
+            raise UVCError("Device is quarantined", errno.EBADFD)
 
     def open(self):
         """
         Opens a UVC device and stores its Handle.
         """
+        self._check_quarantine()
         if not self._is_open:
             if self._new_ref:
                 libuvc.uvc_ref_device(self._device_p)
@@ -106,18 +253,41 @@ class UVCDevice(object):
             _check_error(ret)
             self._is_open = True
 
-    def close(self):
+    def close(self, timeout=None):
         """
         Closes the device and removes its reference.  A device
         cannot be reopened after it has been closed, you must
         request a new device from either find_device() or
         get_device_list() in the UVCContext class.
+
+        Params:
+        timeout - maximum time in seconds to wait for the stream
+                  to stop, see stop_streaming().  If the stop times
+                  out the device is quarantined, its handle is left
+                  open and a UVCError is raised.
         """
+        self.stop_watchdog()
+
+        stop_error = None
         if self._stream_handle_p:
-            self.stop_streaming()
+            try:
+                self.stop_streaming(timeout)
+            except UVCError as err:
+                if not self._quarantined:
+                    raise
+                stop_error = err
+        self._cancel_deferred()
 
         if self._dev_desc_p:
             libuvc.uvc_free_device_descriptor(self._dev_desc_p)
+            self._dev_desc_p = None
+
+        if self._quarantined:
+            # libuvc may still be blocked in the stream, so neither
+            # the handle nor the device reference can be released
+            if stop_error is None:
+                stop_error = UVCError("Device is quarantined", errno.EBADFD)
+            raise stop_error
 
         if self._is_open:
             libuvc.uvc_close(self._handle_p)
@@ -131,17 +301,195 @@ class UVCDevice(object):
 
         Params:
         frame_format - the pixel/frame format expected from the UVC Device
-                       See the enum uvc_frame_format for options
+                       See the enum uvc_frame_format for options, or
+                       pass a FrameBasedFormat such as FRAME_FORMAT_H264.
+                       Frame based frames are passed through untouched.
         width        - width of frame in pixels (int)
         height       - height of frame in pixels (int)
         frame_rate   - frame rate expected from device (int)
         """
+        self._stream_ctrl = self.probe_stream_format(frame_format, width,
+                                                     height, frame_rate)
+        self._format_set = True
+        self._format_args = (frame_format, width, height, frame_rate)
+
+    def probe_stream_format(self, frame_format=UVCFrameFormat.UVC_FRAME_FORMAT_MJPEG,
+                            width=640, height=480, frame_rate=30):
+        """
+        Negotiates the stream parameters with the device without
+        applying them, and returns the resulting uvc_stream_ctrl.
+        The parameters are the same as set_stream_format().  This
+        may be called while streaming.
+        """
+        if isinstance(frame_format, FrameBasedFormat):
+            return self._probe_frame_based(frame_format, width, height, frame_rate)
+
+        stream_ctrl = libuvc.uvc_stream_ctrl()
         ret = libuvc.uvc_get_stream_ctrl_format_size(
-            self._handle_p, byref(self._stream_ctrl), frame_format.value, width,
+            self._handle_p, byref(stream_ctrl), frame_format.value, width,
             height, frame_rate)
 
         _check_error(ret)
-        self._format_set = True
+        return stream_ctrl
+
+    def _probe_frame_based(self, frame_format, width, height, frame_rate):
+        # uvc_get_stream_ctrl_format_size only matches uvc_frame_format
+        # values, so find the mode in the descriptors and fill in the
+        # control the same way it would before probing
+        format_p = libuvc.uvc_get_format_descs(self._handle_p)
+        while format_p:
+            format_desc = format_p.contents
+            if (format_desc.bDescriptorSubtype ==
+                    libuvc.uvc_vs_des_subtype.UVC_VS_FORMAT_FRAME_BASED.value and
+                    bytes(bytearray(format_desc.fourccFormat)) == frame_format.fourcc):
+                frame_p = format_desc.frame_descs
+                while frame_p:
+                    frame_desc = frame_p.contents
+                    if frame_desc.wWidth == width and frame_desc.wHeight == height:
+                        for interval in _frame_intervals(frame_desc):
+                            if 10000000 // interval == frame_rate:
+                                return self._probe_ctrl(format_desc, frame_desc,
+                                                        interval)
+                    frame_p = frame_desc.next
+            format_p = format_desc.next
+
+        _check_error(libuvc.uvc_error.UVC_ERROR_INVALID_MODE.value)
+
+    def _probe_ctrl(self, format_desc, frame_desc, interval):
+        stream_if = cast(format_desc.parent, libuvc.uvc_streaming_interface_p)
+        stream_ctrl = libuvc.uvc_stream_ctrl()
+        stream_ctrl.bmHint = 1 << 0     # keep dwFrameInterval fixed
+        stream_ctrl.bFormatIndex = format_desc.bFormatIndex
+        stream_ctrl.bFrameIndex = frame_desc.bFrameIndex
+        stream_ctrl.dwFrameInterval = interval
+        stream_ctrl.bInterfaceNumber = stream_if.contents.bInterfaceNumber
+        ret = libuvc.uvc_probe_stream_ctrl(self._handle_p, byref(stream_ctrl))
+        _check_error(ret)
+        return stream_ctrl
+
+    def switch_format(self, frame_format=UVCFrameFormat.UVC_FRAME_FORMAT_MJPEG,
+                      width=640, height=480, frame_rate=30, timeout=None):
+        """
+        Changes the stream parameters while streaming, keeping the
+        device handle open.  The new format is negotiated before the
+        current stream is stopped, and is then committed on the
+        existing stream handle.  A new stream handle is only opened
+        if libuvc refuses the commit.  If the device is not streaming
+        this is equivalent to set_stream_format().
+
+        Params are the same as set_stream_format(), timeout is passed
+        to the stream stop (see stop_streaming()).
+
+        Returns a dict describing the switch:
+        negotiate_time - time spent negotiating the new format (seconds)
+        switch_time    - time between stopping and restarting the stream
+        reused_stream  - True if the stream handle was reused
+        gap_time       - time between the last frame in the old format
+                         and the first frame in the new one
+        gap_frames     - frames missed at the old frame rate
+
+        gap_time and gap_frames are None until the first frame in the
+        new format arrives, the dict is updated in place when it does.
+        If the stream cannot be restarted in the new format, it is
+        restarted in the old one and the UVCError is raised.
+        """
+        with self._lock:
+            self._check_quarantine()
+            start = _monotonic()
+            stream_ctrl = self.probe_stream_format(frame_format, width,
+                                                   height, frame_rate)
+            report = {
+                'negotiate_time': _monotonic() - start,
+                'switch_time': None,
+                'reused_stream': False,
+                'gap_time': None,
+                'gap_frames': None
+            }
+
+            old_ctrl, old_args = self._stream_ctrl, self._format_args
+            new_args = (frame_format, width, height, frame_rate)
+            if not self._stream_handle_p:
+                self._stream_ctrl = stream_ctrl
+                self._format_set = True
+                self._format_args = new_args
+                return report
+
+            # the new format is only kept once the stream has restarted
+            # in it, a stop that quarantines the device leaves the old one
+            last_frame = self._last_frame_time
+            switch_start = _monotonic()
+            self._stop_stream(timeout)
+            ret = libuvc.uvc_stream_ctrl_f(self._stream_handle_p, byref(stream_ctrl))
+            if ret == libuvc.uvc_error.UVC_SUCCESS.value:
+                ret = libuvc.uvc_stream_start(self._stream_handle_p, self._frame_callback,
+                                              self._user_id, 0)
+            if ret == libuvc.uvc_error.UVC_SUCCESS.value:
+                report['reused_stream'] = True
+                self._last_frame_time = _monotonic()
+            else:
+                libuvc.uvc_stream_close(self._stream_handle_p)
+                self._stream_handle_p = None
+                self._stream_ctrl = stream_ctrl
+                try:
+                    self._open_stream()
+                except UVCError:
+                    # go back to streaming in the old format
+                    self._stream_ctrl = old_ctrl
+                    try:
+                        self._open_stream()
+                    except UVCError as err:
+                        _logger.error("Could not restart the stream in its previous "
+                                      "format: %s", err)
+                    raise
+
+            self._stream_ctrl = stream_ctrl
+            self._format_set = True
+            self._format_args = new_args
+            report['switch_time'] = _monotonic() - switch_start
+            self._pending_switch = (report, last_frame or switch_start,
+                                    old_args[3] if old_args else None)
+            self._stats['format_switches'] += 1
+            self._stats['switch_time_last'] = report['switch_time']
+            return report
+
+    def _switch_deferred(self):
+        # switching from another thread would close the stream under a
+        # blocked uvc_stream_get_frame(), so polling mode switches are
+        # left for the polling thread.  done(report, error) is called
+        # with the outcome.
+        args, done = self._deferred_switch
+        self._deferred_switch = None
+        try:
+            report = self.switch_format(*args)
+        except UVCError as err:
+            done(None, err)
+        else:
+            done(report, None)
+
+    def _cancel_deferred(self):
+        # a stream stopped before the polling thread came back will not
+        # make the switch.  done() takes the caller's lock, which may be
+        # held while taking ours, so it is called without ours held.
+        deferred, self._deferred_switch = self._deferred_switch, None
+        if deferred is not None:
+            deferred[1](None, UVCError("Stream stopped before the format switch",
+                                       errno.ECANCELED))
+
+    def _frame_arrived(self):
+        now = _monotonic()
+        self._last_frame_time = now
+        self._stats['frames'] += 1
+        if not self._first_frame.is_set():
+            self._first_frame.set()
+        if self._pending_switch is not None:
+            report, last_frame, old_rate = self._pending_switch
+            self._pending_switch = None
+            gap = now - last_frame
+            report['gap_time'] = gap
+            if old_rate:
+                report['gap_frames'] = max(0, int(round(gap * old_rate)) - 1)
+            self._stats['switch_gap_last'] = gap
+        return now
 
     def set_callback(self, callback, user_id=None):
         """
@@ -157,20 +505,170 @@ class UVCDevice(object):
         user_id -   An integer that identifies the user that
                     set the callback.  Any unique integer is ok
         """
+        if not callback:
+            self._set_frame_handler(None)
+            return
+
+        def _deliver(frame, arrival_time, user):
+            new_frame = self._new_frame(frame, arrival_time)
+            if self._frame_requested:
+                self._frame_requested = False
+                self._requested_frame = new_frame
+                self._requested_event.set()
+            _call_traced(callback, new_frame, user)
+
+        self._set_frame_handler(_deliver, user_id)
+
+    def _set_frame_handler(self, handler, user_id=None):
+        # handler(frame_p, arrival_time, user) is called from the libuvc
+        # stream thread for every frame that passes decimation
         # don't set while streaming
         if not self._stream_handle_p:
-            if not callback:
+            self._batch_flush = None
+            if not handler:
                 self._frame_callback = libuvc.uvc_null_frame_callback
                 self._user_id = None
             else:
                 def _frame_cb(frame, user):
                     if frame:
-                        new_frame = UVCFrame(frame)
-                        callback(new_frame, user)
+                        arrival_time = self._frame_arrived()
+                        # skip frames before any python object is built
+                        if self._latest_only and not self._frame_requested:
+                            self._stats['decimated'] += 1
+                            return
+                        if self._accept_frame(frame, arrival_time):
+                            handler(frame, arrival_time, user)
 
                 self._frame_callback = libuvc.uvc_frame_callback(_frame_cb)
                 self._user_id = user_id
 
+    def set_raw_callback(self, callback, user_id=None):
+        """
+        Sets a callback that receives the uvc_frame struct itself, for
+        consumers that copy the frame data straight to its destination.
+        The struct and its buffer belong to libuvc and are only valid
+        until the callback returns.  Decimation, validation, gating and
+        the budget apply as for set_callback().
+
+        The callback is called as callback(frame, timestamp, user_id),
+        where timestamp is the capture time mapped to the host
+        monotonic clock (see UVCFrame.host_time).
+        """
+        if not callback:
+            self._set_frame_handler(None)
+            return
+
+        def _deliver(frame, arrival_time, user):
+            self._release_charge()
+            contents = frame.contents
+            _call_traced(callback, contents,
+                         capture_timestamp(contents, self.clock, arrival_time), user)
+
+        self._set_frame_handler(_deliver, user_id)
+
+    def set_batch_callback(self, callback, batch_size, timeout=None,
+                           user_id=None, use_numpy=True):
+        """
+        Sets a callback that receives frames in batches instead of one
+        at a time.  Frames are copied from the libuvc buffer straight
+        into the FrameBatch, no UVCFrame is built.  Like set_callback()
+        this may not be called while streaming, and the stream format
+        must be set first so the batch can be laid out.
+
+        Params:
+        callback   - called as callback(batch, user_id) with a FrameBatch
+        batch_size - frames per batch (int)
+        timeout    - deliver a partial batch when a frame arrives more
+                     than timeout seconds after the batch was started.
+                     A partial batch is also delivered when streaming
+                     stops.
+        user_id    - passed to the callback
+        use_numpy  - lay the batch out as a NumPy array if available
+        """
+        if self._stream_handle_p:
+            return
+        if not self._format_set:
+            self.set_stream_format()
+        layout = self._batch_layout()
+        state = {'batch': None, 'started': None}
+
+        def _new_batch():
+            return FrameBatch(batch_size, layout[0], layout[1], use_numpy)
+
+        def _flush(user=user_id):
+            batch = state['batch']
+            state['batch'] = None
+            if batch is not None and batch.count:
+                _call_traced(callback, batch, user)
+
+        def _collect(frame, arrival_time, user):
+            self._release_charge()
+            if state['batch'] is None:
+                state['batch'] = _new_batch()
+                state['started'] = arrival_time
+            batch = state['batch']
+            contents = frame.contents
+            batch.add(contents, capture_timestamp(contents, self.clock, arrival_time))
+            if batch.full or (timeout is not None and
+                              arrival_time - state['started'] >= timeout):
+                _flush(user)
+
+        self._set_frame_handler(_collect, user_id)
+        self._batch_flush = _flush
+
+    def _batch_layout(self):
+        frame_format, width, height = self._format_args[:3]
+        return batch_layout(frame_format, width, height,
+                            self._stream_ctrl.dwMaxVideoFrameSize)
+
+    def get_frames(self, count, timeout=1000000, use_numpy=True):
+        """
+        Polling mode only.  Retreives up to count frames into a single
+        FrameBatch, copying each frame straight from the libuvc buffer.
+
+        Timeout is in microseconds and applies to the whole batch.  If
+        it expires a partial batch is returned, check batch.count.  As
+        with get_frame(), 0 blocks until the batch is full, and -1
+        returns at once with the frames already waiting.
+        Errors other than a timeout are raised as by get_frame().
+        """
+        if self._recovery_pending:
+            self.recover()
+        if self._deferred_switch is not None:
+            self._switch_deferred()
+        if not self._format_set:
+            raise UVCError("Stream format not set", errno.EINVAL)
+
+        slot_size, shape = self._batch_layout()
+        batch = FrameBatch(count, slot_size, shape, use_numpy)
+        deadline = _monotonic() + timeout / 1000000.0 if timeout > 0 else None
+        frame = libuvc.uvc_frame_p()
+        while not batch.full:
+            if deadline is None:
+                remaining = timeout
+            else:
+                remaining = int((deadline - _monotonic()) * 1000000)
+                if remaining <= 0:
+                    break
+            ret = libuvc.uvc_stream_get_frame(self._stream_handle_p, byref(frame),
+                                              remaining)
+            if ret == libuvc.uvc_error.UVC_ERROR_TIMEOUT.value:
+                break
+            _check_error(ret)
+            if not frame:
+                if timeout < 0:
+                    # no more frames waiting
+                    break
+                continue
+
+            arrival_time = self._frame_arrived()
+            if not self._accept_frame(frame, arrival_time):
+                continue
+            self._release_charge()
+            contents = frame.contents
+            batch.add(contents, capture_timestamp(contents, self.clock, arrival_time))
+        return batch
+
     def start_streaming(self):
         """
         Start streaming video.  Video can either be polled by calling
@@ -181,30 +679,245 @@ class UVCDevice(object):
             # if the format hasn't been set, use default values
             self.set_stream_format()
 
-        # don't open a stream if we are already streaming
-        if not self._stream_handle_p:
-            # open the stream.  Polling mode if callback is not supplied
-            self._stream_handle_p = c_void_p()
-            ret = libuvc.uvc_stream_open_ctrl(self._handle_p, byref(self._stream_handle_p),
-                                              byref(self._stream_ctrl))
-
+        with self._lock:
+            self._check_quarantine()
+            # don't open a stream if we are already streaming
+            if not self._stream_handle_p:
+                self._open_stream()
+
+    def _open_stream(self):
+        # open the stream.  Polling mode if callback is not supplied
+        self._stream_handle_p = c_void_p()
+        ret = libuvc.uvc_stream_open_ctrl(self._handle_p, byref(self._stream_handle_p),
+                                          byref(self._stream_ctrl))
+        if ret != libuvc.uvc_error.UVC_SUCCESS.value:
+            self._stream_handle_p = None
             _check_error(ret)
 
-            ret = libuvc.uvc_stream_start(self._stream_handle_p, self._frame_callback,
-                                          self._user_id, 0)
+        ret = libuvc.uvc_stream_start(self._stream_handle_p, self._frame_callback,
+                                      self._user_id, 0)
+        if ret != libuvc.uvc_error.UVC_SUCCESS.value:
+            libuvc.uvc_stream_close(self._stream_handle_p)
+            self._stream_handle_p = None
             _check_error(ret)
 
-    def stop_streaming(self):
+        # measure stalls from the moment the stream starts, so a stream
+        # that never delivers a frame is detected as well
+        self._last_frame_time = _monotonic()
+        self._recovery_pending = False
+        self._first_frame.clear()
+
+    def stop_streaming(self, timeout=None):
         """
         Stops streaming video from the device and
         releases the stream handle.
+
+        libuvc can hang in uvc_stream_stop, so a timeout may be
+        given to bound the time this call can take.  The stop then
+        runs on a helper thread, and if it does not finish in time
+        the device is quarantined (see is_quarantined) and a
+        UVCError with errno ETIMEDOUT is raised.
+
+        Params:
+        timeout - maximum time to wait in seconds (float).  Defaults
+                  to the stop_timeout attribute, which is None
+                  (wait forever) unless set by the user.
+        """
+        try:
+            with self._lock:
+                # Dont close unless we are streaming
+                if self._stream_handle_p:
+                    self._stop_stream(timeout, close_stream=True)
+                    self._stream_handle_p = None
+                    self._last_frame_time = None
+                    if self._batch_flush is not None:
+                        self._batch_flush()
+        finally:
+            self._cancel_deferred()
+
+    def _stop_stream(self, timeout=None, close_stream=False):
+        if timeout is None:
+            timeout = self.stop_timeout
+
+        stream_handle_p = self._stream_handle_p
+
+        def _stop():
+            libuvc.uvc_stream_stop(stream_handle_p)
+            if close_stream:
+                libuvc.uvc_stream_close(stream_handle_p)
+
+        start = _monotonic()
+        if timeout is None:
+            _stop()
+        else:
+            stop_thread = threading.Thread(target=_stop, name='uvclite-stop')
+            stop_thread.daemon = True
+            stop_thread.start()
+            stop_thread.join(timeout)
+            if stop_thread.is_alive():
+                self._stats['stop_timeouts'] += 1
+                self._quarantined = True
+                self._stream_handle_p = None
+                self._last_frame_time = None
+                _logger.error("Stream did not stop within %.3f seconds, "
+                              "device quarantined", timeout)
+                raise UVCError("Timed out stopping stream, device quarantined",
+                               errno.ETIMEDOUT)
+
+        elapsed = _monotonic() - start
+        self._stats['stops'] += 1
+        self._stats['stop_time_last'] = elapsed
+        self._stats['stop_time_total'] += elapsed
+        if elapsed > self._stats['stop_time_max']:
+            self._stats['stop_time_max'] = elapsed
+
+    def wait_for_frame(self, timeout=None):
+        """
+        Waits until the first frame of the current stream has been
+        received, either by a callback or by get_frame().  Returns
+        False if the timeout (in seconds) expired first.
+        """
+        return self._first_frame.wait(timeout)
+
+    def recover(self):
         """
-        # Dont close unless we are streaming
+        Attempts to restart a stalled stream, starting with the
+        cheapest option:
+
+        recommit - the stream is stopped, the existing stream control
+                   is committed again on the same stream handle and
+                   the stream is restarted.
+        restream - the stream handle is closed and a new one is opened
+                   on the same device handle.
+        reopen   - the device handle is closed and reopened, the
+                   stream format renegotiated and the stream started.
+
+        Returns the name of the method that succeeded.  Raises a
+        UVCError if the device could not be recovered.  The time taken
+        is recorded in the stats returned by get_stats().
+
+        Do not call this from within a frame callback.
+        """
+        with self._lock:
+            if not self._stream_handle_p:
+                raise UVCError("Device is not streaming", errno.EINVAL)
+
+            self._recovery_pending = False
+            start = _monotonic()
+            try:
+                method = self._restart_stream()
+            except UVCError as err:
+                if self._quarantined:
+                    self._stats['recovery_failures'] += 1
+                    raise
+                _logger.warning("Stream restart failed (%s), reopening device", err)
+                try:
+                    self._reopen()
+                except UVCError:
+                    self._stats['recovery_failures'] += 1
+                    raise
+                method = 'reopen'
+
+            latency = _monotonic() - start
+            self._stats['recoveries'] += 1
+            self._stats[method + 's'] += 1
+            self._stats['recovery_latency_last'] = latency
+            self._stats['recovery_latency_total'] += latency
+            if latency > self._stats['recovery_latency_max']:
+                self._stats['recovery_latency_max'] = latency
+            _logger.info("Stream recovered by %s in %.3f seconds", method, latency)
+            return method
+
+    def _restart_stream(self):
+        self._stop_stream()
+        ret = libuvc.uvc_stream_ctrl_f(self._stream_handle_p, byref(self._stream_ctrl))
+        if ret == libuvc.uvc_error.UVC_SUCCESS.value:
+            ret = libuvc.uvc_stream_start(self._stream_handle_p, self._frame_callback,
+                                          self._user_id, 0)
+            if ret == libuvc.uvc_error.UVC_SUCCESS.value:
+                self._last_frame_time = _monotonic()
+                return 'recommit'
+
+        # fall back to a new stream handle on the same device handle
+        libuvc.uvc_stream_close(self._stream_handle_p)
+        self._stream_handle_p = None
+        self._open_stream()
+        return 'restream'
+
+    def _reopen(self):
         if self._stream_handle_p:
-            libuvc.uvc_stream_stop(self._stream_handle_p)
             libuvc.uvc_stream_close(self._stream_handle_p)
             self._stream_handle_p = None
 
+        if self._is_open:
+            libuvc.uvc_close(self._handle_p)
+            self._is_open = False
+
+        self._handle_p = c_void_p()
+        ret = libuvc.uvc_open(self._device_p, byref(self._handle_p))
+        _check_error(ret)
+        self._is_open = True
+
+        if self._format_args:
+            self.set_stream_format(*self._format_args)
+        else:
+            self.set_stream_format()
+        self._open_stream()
+
+    def start_watchdog(self, stall_timeout=2.0, check_interval=None):
+        """
+        Starts a StreamWatchdog that calls recover() when no frame
+        has been received for stall_timeout seconds.  The watchdog
+        only acts while the device is streaming.
+
+        Params:
+        stall_timeout  - maximum gap between frames in seconds (float)
+        check_interval - how often the gap is checked, defaults to
+                         a quarter of stall_timeout (float)
+
+        Returns the StreamWatchdog instance.
+        """
+        self.stop_watchdog()
+        self._watchdog = StreamWatchdog(self, stall_timeout, check_interval)
+        self._watchdog.start()
+        return self._watchdog
+
+    def stop_watchdog(self):
+        """
+        Stops the watchdog if one is running.
+        """
+        if self._watchdog:
+            self._watchdog.stop()
+            self._watchdog = None
+
+    def get_stats(self):
+        """
+        Returns a dict of counters for this device:
+
+        frames                 - frames received
+        stalls                 - stalls detected by the watchdog
+        recoveries             - successful recoveries, also broken down
+                                 into recommits, restreams and reopens
+        recovery_failures      - recoveries where every method failed
+        recovery_latency_*     - last, max and total recovery time
+                                 in seconds
+        stops                  - streams stopped, including stops
+                                 made during recovery
+        stop_timeouts          - stops that timed out
+        stop_time_*            - last, max and total time spent
+                                 stopping streams in seconds
+        format_switches        - calls to switch_format() while streaming
+        switch_time_last       - stream downtime of the last switch
+        switch_gap_last        - frame gap of the last switch in seconds
+        decimated              - frames skipped by set_decimation()
+        gated                  - frames suppressed by the gate set with
+                                 set_gate()
+        invalid                - frames that failed the validator set
+                                 with set_validator(), dropped or flagged
+        budget_dropped         - frames dropped by the device's FrameBudget
+        """
+        return dict(self._stats)
+
     def get_frame(self, timeout=1000000):
         """
         When in polling mode, retreives the next frame in the buffer.
@@ -219,16 +932,207 @@ class UVCDevice(object):
 
         If this is called when a callback has been set, a UVCError will
         be raised.
+
+        If a watchdog detected a stall since the last call, the stream
+        is recovered before waiting for the next frame.  Mode switches
+        requested by an adaptive.AdaptiveController are made here too.
         """
+        if self._recovery_pending:
+            self.recover()
+        if self._deferred_switch is not None:
+            self._switch_deferred()
 
         frame = libuvc.uvc_frame_p()
-        ret = libuvc.uvc_stream_get_frame(self._stream_handle_p, byref(frame), timeout)
-        _check_error(ret)
+        while True:
+            ret = libuvc.uvc_stream_get_frame(self._stream_handle_p, byref(frame), timeout)
+            _check_error(ret)
+
+            if not frame:
+                raise UVCError("Null Frame", 500)
+
+            arrival_time = self._frame_arrived()
+            if self._accept_frame(frame, arrival_time):
+                return self._new_frame(frame, arrival_time)
+
+    def set_decimation(self, every=None, interval=None, latest=False):
+        """
+        Only delivers a subset of the frames received.  Skipped frames
+        are dropped before a UVCFrame is built or their data copied.
+        Call with no arguments to deliver every frame again.
 
-        if frame:
-            return UVCFrame(frame)
+        Params:
+        every    - deliver one frame out of every N (int)
+        interval - deliver at most one frame per interval seconds (float)
+        latest   - callback mode only.  Deliver a frame only when one
+                   has been requested with request_frame() or
+                   get_latest_frame().  In polling mode get_frame()
+                   already returns the most recent frame.
+
+        In polling mode get_frame() keeps reading until a frame is
+        accepted, so the timeout applies to each read rather than the
+        whole call.
+        """
+        if every is not None and every > 1:
+            self._decimate = _every_nth(every)
+        elif interval:
+            self._decimate = _every_interval(interval)
         else:
-            raise UVCError("Null Frame", 500)
+            self._decimate = None
+        self._latest_only = latest
+
+    def set_gate(self, gate):
+        """
+        Sets a gate that suppresses frames before they are delivered,
+        for example a gate.ChangeGate.  The gate's check(frame, now)
+        method is called with the raw uvc_frame struct and the arrival
+        time of every frame that passes decimation, and the frame is
+        dropped if it returns False.  Like decimation, get_frame()
+        keeps reading until a frame passes.  Set to None to remove.
+        """
+        self._gate = gate
+
+    def _new_frame(self, frame, arrival_time):
+        new_frame = UVCFrame(frame, self.clock, arrival_time)
+        new_frame.valid = self._frame_valid
+        if self._budget_charge is not None:
+            self.budget.charge(new_frame, self._budget_charge)
+            self._budget_charge = None
+        if self._format_args and self._format_args[0] == FRAME_FORMAT_H264:
+            new_frame.keyframe = _h264.is_keyframe(new_frame.data)
+        return new_frame
+
+    def _release_charge(self):
+        # frames copied into batches are not charged to the budget
+        if self._budget_charge is not None:
+            self.budget.release(self._budget_charge)
+            self._budget_charge = None
+
+    def set_validator(self, validator, drop=True):
+        """
+        Sets a validator for received frames, for example a
+        mjpeg.MJPEGValidator.  Its check(frame, now) method is called
+        with the raw uvc_frame struct of every frame that passes
+        decimation, before the gate and before the frame is copied.
+        Set to None to remove.
+
+        Params:
+        validator - object with a check(frame, now) method returning
+                    False for a bad frame
+        drop      - drop bad frames.  Otherwise they are delivered with
+                    UVCFrame.valid set to False.
+        """
+        self._validator = validator
+        self._drop_invalid = drop
+        self._frame_valid = None
+
+    def _accept_frame(self, frame, arrival_time):
+        # decimation first, it is cheaper than any check
+        if self._decimate is not None and not self._decimate(arrival_time):
+            self._stats['decimated'] += 1
+            return False
+        contents = frame.contents
+        validator = self._validator
+        if validator is not None:
+            self._frame_valid = validator.check(contents, arrival_time)
+            if not self._frame_valid:
+                self._stats['invalid'] += 1
+                if self._drop_invalid:
+                    return False
+        gate = self._gate
+        # a bad frame must not become the gate's reference
+        if (gate is not None and self._frame_valid is not False and
+                not gate.check(contents, arrival_time)):
+            self._stats['gated'] += 1
+            return False
+        # last, as the reservation charges the frame to the device
+        budget = self.budget
+        if budget is not None:
+            self._budget_charge = budget.reserve(self.budget_name, contents.data_bytes)
+            if self._budget_charge is None:
+                self._stats['budget_dropped'] += 1
+                return False
+        return True
+
+    def request_frame(self):
+        """
+        Requests that the next frame received is delivered, when
+        decimating with latest set.
+        """
+        self._requested_event.clear()
+        self._frame_requested = True
+
+    def get_latest_frame(self, timeout=None):
+        """
+        Callback mode only.  Requests a frame and waits up to timeout
+        seconds for it.  The frame is returned, and also passed to the
+        callback.  Returns None on timeout.
+        """
+        self.request_frame()
+        if not self._requested_event.wait(timeout):
+            self._frame_requested = False
+            return None
+        frame, self._requested_frame = self._requested_frame, None
+        return frame
+
+    def get_bus_number(self):
+        """
+        Returns the number of the USB bus the device is attached to.
+        """
+        return libuvc.uvc_get_bus_number(self._device_p)
+
+    def get_device_address(self):
+        """
+        Returns the device's address on its USB bus.
+        """
+        return libuvc.uvc_get_device_address(self._device_p)
+
+    def get_supported_modes(self):
+        """
+        Returns a list of UVCMode tuples, one for every combination
+        of format, frame size and frame rate reported by the device's
+        format descriptors.  The device must be open.
+
+        UVCMode fields:
+        frame_format   - UVCFrameFormat of the mode, or a
+                         FrameBasedFormat for frame based formats
+        width          - frame width in pixels (int)
+        height         - frame height in pixels (int)
+        frame_rate     - frames per second, as accepted by
+                         set_stream_format() (int)
+        max_frame_size - maximum frame size in bytes (int)
+        """
+        modes = []
+        format_p = libuvc.uvc_get_format_descs(self._handle_p)
+        while format_p:
+            format_desc = format_p.contents
+            subtype = format_desc.bDescriptorSubtype
+            if subtype == libuvc.uvc_vs_des_subtype.UVC_VS_FORMAT_MJPEG.value:
+                frame_format = UVCFrameFormat.UVC_FRAME_FORMAT_MJPEG
+            elif subtype == libuvc.uvc_vs_des_subtype.UVC_VS_FORMAT_UNCOMPRESSED.value:
+                fourcc = bytes(bytearray(format_desc.fourccFormat))
+                frame_format = _fourcc_formats.get(
+                    fourcc, UVCFrameFormat.UVC_FRAME_FORMAT_UNCOMPRESSED)
+            elif subtype == libuvc.uvc_vs_des_subtype.UVC_VS_FORMAT_FRAME_BASED.value:
+                frame_format = FrameBasedFormat(bytes(bytearray(format_desc.fourccFormat)))
+            else:
+                format_p = format_desc.next
+                continue
+
+            frame_p = format_desc.frame_descs
+            while frame_p:
+                frame_desc = frame_p.contents
+                for interval in _frame_intervals(frame_desc):
+                    # frame based descriptors give no buffer size, so
+                    # bound it by the maximum bit rate
+                    max_size = (frame_desc.dwMaxVideoFrameBufferSize or
+                                frame_desc.dwMaxBitRate // 8 * interval // 10000000)
+                    modes.append(UVCMode(frame_format, frame_desc.wWidth,
+                                         frame_desc.wHeight, 10000000 // interval,
+                                         max_size))
+                frame_p = frame_desc.next
+            format_p = format_desc.next
+
+        return modes
 
     def get_device_descriptor(self):
         """
@@ -273,6 +1177,52 @@ class UVCDevice(object):
         if self._is_open:
             libuvc.uvc_print_diag(self._handle_p, None)
 
+def _every_nth(every):
+    # decimation filter accepting the first frame and every Nth after it
+    counter = [every - 1]
+
+    def _decimate(now):     # pylint: disable=unused-argument
+        counter[0] += 1
+        if counter[0] >= every:
+            counter[0] = 0
+            return True
+        return False
+    return _decimate
+
+
+def _every_interval(interval):
+    # decimation filter accepting at most one frame per interval
+    next_due = [0.0]
+
+    def _decimate(now):
+        if now < next_due[0]:
+            return False
+        # stay on the interval grid unless we fell behind it
+        next_due[0] += interval
+        if next_due[0] <= now:
+            next_due[0] = now + interval
+        return True
+    return _decimate
+
+
+def _frame_intervals(frame_desc):
+    # intervals are in 100ns units.  Discrete intervals are listed in
+    # a zero terminated array, continuous ones are given as a range
+    intervals = []
+    if frame_desc.bFrameIntervalType and frame_desc.intervals:
+        for i in range(frame_desc.bFrameIntervalType):
+            if not frame_desc.intervals[i]:
+                break
+            intervals.append(frame_desc.intervals[i])
+    else:
+        for interval in (frame_desc.dwMinFrameInterval,
+                         frame_desc.dwDefaultFrameInterval,
+                         frame_desc.dwMaxFrameInterval):
+            if interval and interval not in intervals:
+                intervals.append(interval)
+    return intervals
+
+
 class DeviceList(object):
     """
     Presents a Python List representation of a UVCDevice list.
@@ -315,15 +1265,47 @@ class UVCContext(object):
     except UVCError():
         # Handle your exception
 
+    By default libuvc creates a libusb context and event thread for
+    each UVCContext.  To share one between contexts, pass a
+    usb.USBContext, or set shared_usb to use the process wide one.
+
+    Params:
+    usb_context - a usb.USBContext to build the context on
+    shared_usb  - build the context on usb.shared_context()
     """
-    def __init__(self):
+    def __init__(self, usb_context=None, shared_usb=False):
         self._context_p = c_void_p()
         self._device_list_p = None
+        self._usb_context = None
+
+        if usb_context is not None or shared_usb:
+            from . import usb
+            if usb_context is None:
+                usb_context = usb.shared_context()
+            else:
+                usb_context.acquire()
+            self._usb_context = usb_context
 
         # Retreive uvc context.
-        ret = libuvc.uvc_init(byref(self._context_p), None)
+        ret = libuvc.uvc_init(byref(self._context_p),
+                              usb_context.handle if usb_context else None)
+        if ret != libuvc.uvc_error.UVC_SUCCESS.value:
+            self._release_usb()
         _check_error(ret)
 
+    @property
+    def usb_context(self):
+        """
+        The usb.USBContext this context is built on, or None if libuvc
+        owns its libusb context
+        """
+        return self._usb_context
+
+    def _release_usb(self):
+        if self._usb_context is not None:
+            self._usb_context.release()
+            self._usb_context = None
+
     def __enter__(self):
         return self
 
@@ -344,6 +1326,7 @@ class UVCContext(object):
         if self._context_p:
             libuvc.uvc_exit(self._context_p)
             self._context_p = None
+        self._release_usb()
 
     def find_device(self, vendor_id=0, product_id=0, serial_number=None):
         """
@@ -411,3 +1394,115 @@ class UVCContext(object):
         _check_error(ret)
 
         return DeviceList(self._device_list_p)
+
+    def start_devices(self, devices, formats=None, max_workers=None,
+                      frame_timeout=5.0):
+        """
+        Opens, negotiates and starts streaming on several devices
+        concurrently, then waits for each device's first frame.
+        libuvc calls release the GIL, so the USB negotiation of each
+        device overlaps with the others.  A failure only affects the
+        device it occurred on.
+
+        Params:
+        devices       - a list of UVCDevice objects, as returned by
+                        find_device() or get_device_list().  Callbacks
+                        should be set before calling.
+        formats       - optional (frame_format, width, height, frame_rate)
+                        tuple applied to every device, or a list with one
+                        tuple (or None for the default) per device.
+        max_workers   - size of the thread pool, defaults to one
+                        thread per device
+        frame_timeout - seconds to wait for each device's first frame.
+                        In polling mode the first frame is retreived
+                        with get_frame() and discarded.
+
+        Returns a list of BringUpReport objects in the order of devices.
+        Raises ValueError if formats is a list of a different length.
+        """
+        devices = list(devices)
+        if formats is None or isinstance(formats, tuple):
+            formats = [formats] * len(devices)
+        else:
+            formats = list(formats)
+            if len(formats) != len(devices):
+                raise ValueError("%d formats given for %d devices"
+                                 % (len(formats), len(devices)))
+        reports = [BringUpReport(dev) for dev in devices]
+        if not devices:
+            return reports
+
+        def _bring_up(report, stream_format):
+            device = report.device
+            start = _monotonic()
+            try:
+                device.open()
+                report.open_time = _monotonic() - start
+
+                mark = _monotonic()
+                if stream_format is not None:
+                    device.set_stream_format(*stream_format)
+                elif not device._format_set:
+                    device.set_stream_format()
+                report.negotiate_time = _monotonic() - mark
+
+                mark = _monotonic()
+                device.start_streaming()
+                report.start_time = _monotonic() - mark
+
+                if device.is_polling:
+                    device.get_frame(int(frame_timeout * 1000000))
+                elif not device.wait_for_frame(frame_timeout):
+                    raise UVCError("No frame received", errno.ETIMEDOUT)
+                report.first_frame_time = _monotonic() - start
+            except Exception as err:     # pylint: disable=broad-except
+                report.error = err
+                _logger.warning("Bring up failed for device: %s", err)
+            report.total_time = _monotonic() - start
+
+        pool = ThreadPoolExecutor(max_workers or len(devices))
+        try:
+            futures = [pool.submit(_bring_up, report, stream_format)
+                       for report, stream_format in zip(reports, formats)]
+            for future in futures:
+                future.result()
+        finally:
+            pool.shutdown()
+        return reports
+
+
+class BringUpReport(object):
+    """
+    Timing of a device started by UVCContext.start_devices().  All
+    times are in seconds, and are None if the step was not reached.
+
+    device           - the UVCDevice
+    error            - the exception raised, None on success
+    open_time        - time taken by open()
+    negotiate_time   - time taken by set_stream_format()
+    start_time       - time taken by start_streaming()
+    first_frame_time - time from the start of bring up to the first frame
+    total_time       - time spent on this device
+    """
+    def __init__(self, device):
+        self.device = device
+        self.error = None
+        self.open_time = None
+        self.negotiate_time = None
+        self.start_time = None
+        self.first_frame_time = None
+        self.total_time = None
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def as_dict(self):
+        return {
+            'error': str(self.error) if self.error else None,
+            'open_time': self.open_time,
+            'negotiate_time': self.negotiate_time,
+            'start_time': self.start_time,
+            'first_frame_time': self.first_frame_time,
+            'total_time': self.total_time
+        }
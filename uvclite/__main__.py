@@ -0,0 +1,287 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Command line camera probe and throughput benchmark
+
+    python -m uvclite list
+    python -m uvclite formats --device STANDIN0
+    python -m uvclite bench --device 1:4 --mode YUYV:640x480@30 --duration 10
+
+list and formats print tables, or JSON with --json.  bench streams each
+mode for a while, every supported mode unless --mode is given, and
+prints a JSON report per mode: frames received, achieved fps and bytes
+per second, frames dropped going by gaps in the sequence numbers, and
+the latency from starting the stream to the first frame.
+"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import re
+import sys
+import threading
+import time
+
+from . import libuvc, FrameBasedFormat, UVCContext, UVCError, UVCFrameFormat, \
+    _frame_intervals
+from .supervisor import CameraSpec, select_device
+from .clock import monotonic as _monotonic
+
+__author__ = 'Eric Callahan'
+
+_subtypes = libuvc.uvc_vs_des_subtype
+
+_MODE = re.compile(r'^(\w+):(\d+)x(\d+)@(\d+)$')
+
+
+def _format_name(frame_format):
+    return frame_format.name.replace('UVC_FRAME_FORMAT_', '')
+
+
+def parse_mode(text):
+    """
+    Parses a mode given as FORMAT:WIDTHxHEIGHT@FPS, where FORMAT is a
+    UVCFrameFormat name such as YUYV or MJPEG, or the fourcc of a frame
+    based format such as H264.  Returns (frame_format, width, height,
+    frame_rate).
+    """
+    match = _MODE.match(text)
+    if match is None:
+        raise ValueError("Mode %r is not FORMAT:WIDTHxHEIGHT@FPS" % text)
+    name = match.group(1).upper()
+    try:
+        frame_format = UVCFrameFormat['UVC_FRAME_FORMAT_' + name]
+    except KeyError:
+        frame_format = FrameBasedFormat(name.encode('ascii').ljust(4))
+    return (frame_format, int(match.group(2)), int(match.group(3)), int(match.group(4)))
+
+
+def _open_device(context, device):
+    # device is a serial number, BUS:ADDRESS, or None for the first one
+    if device is None:
+        found = context.find_device()
+    elif re.match(r'^\d+:\d+$', device):
+        bus, address = device.split(':')
+        found = select_device(context, CameraSpec(device, bus=int(bus), address=int(address)))
+    else:
+        found = select_device(context, CameraSpec(device, serial=device))
+    found.open()
+    return found
+
+
+def _text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf8', 'replace')
+    return value
+
+
+def list_devices(context):
+    """
+    Returns a dict per device with its bus, address and descriptor.
+    """
+    devices = []
+    for device in context.get_device_list():
+        desc = device.get_device_descriptor()
+        devices.append({
+            'bus': device.get_bus_number(),
+            'address': device.get_device_address(),
+            'vendor_id': desc.idVendor,
+            'product_id': desc.idProduct,
+            'uvc_version': '%x.%02x' % (desc.bcdUVC >> 8, desc.bcdUVC & 0xff),
+            'serial': _text(desc.serialNumber),
+            'manufacturer': _text(desc.manufacturer),
+            'product': _text(desc.product)
+        })
+        device.free_device_descriptor()
+    return devices
+
+
+def list_formats(device):
+    """
+    Returns the format descriptors of an open device, each a dict with
+    its frame descriptors and their frame intervals.
+    """
+    formats = []
+    format_p = libuvc.uvc_get_format_descs(device._handle_p)   # pylint: disable=protected-access
+    while format_p:
+        format_desc = format_p.contents
+        try:
+            subtype = _subtypes(format_desc.bDescriptorSubtype).name.replace('UVC_VS_', '')
+        except ValueError:
+            subtype = format_desc.bDescriptorSubtype
+        frames = []
+        frame_p = format_desc.frame_descs
+        while frame_p:
+            frame_desc = frame_p.contents
+            intervals = _frame_intervals(frame_desc)
+            frames.append({
+                'index': frame_desc.bFrameIndex,
+                'width': frame_desc.wWidth,
+                'height': frame_desc.wHeight,
+                'max_frame_size': frame_desc.dwMaxVideoFrameBufferSize,
+                'default_interval': frame_desc.dwDefaultFrameInterval,
+                'intervals': intervals,
+                'frame_rates': [round(10000000.0 / i, 3) for i in intervals]
+            })
+            frame_p = frame_desc.next
+        formats.append({
+            'index': format_desc.bFormatIndex,
+            'subtype': subtype,
+            'fourcc': _text(bytes(bytearray(format_desc.fourccFormat))),
+            'bits_per_pixel': format_desc.bBitsPerPixel,
+            'default_frame': format_desc.bDefaultFrameIndex,
+            'frames': frames
+        })
+        format_p = format_desc.next
+    return formats
+
+
+def bench_mode(device, mode, duration, frame_timeout=5.0):
+    """
+    Streams one mode for duration seconds and returns a dict of what
+    was received.
+    """
+    frame_format, width, height, frame_rate = mode
+    result = {
+        'format': _format_name(frame_format),
+        'width': width,
+        'height': height,
+        'frame_rate': frame_rate,
+        'frames': 0,
+        'bytes': 0,
+        'dropped': 0,
+        'fps': None,
+        'bytes_per_sec': None,
+        'first_frame_latency': None,
+        'error': None
+    }
+    state = {'first': None, 'first_bytes': 0, 'last_sequence': None}
+    lock = threading.Lock()
+
+    def _count(frame, timestamp, user):     # pylint: disable=unused-argument
+        now = _monotonic()
+        with lock:
+            if state['first'] is None:
+                state['first'] = now
+                state['first_bytes'] = frame.data_bytes
+            elif frame.sequence > state['last_sequence']:
+                result['dropped'] += frame.sequence - state['last_sequence'] - 1
+            state['last_sequence'] = frame.sequence
+            result['frames'] += 1
+            result['bytes'] += frame.data_bytes
+
+    try:
+        device.set_stream_format(frame_format, width, height, frame_rate)
+        device.set_raw_callback(_count)
+        start = _monotonic()
+        device.start_streaming()
+        try:
+            if not device.wait_for_frame(frame_timeout):
+                raise UVCError("No frame within %.1f seconds" % frame_timeout)
+            time.sleep(duration)
+        finally:
+            device.stop_streaming()
+            device.set_raw_callback(None)
+    except UVCError as err:
+        result['error'] = err.args[0]
+        return result
+
+    with lock:
+        if state['first'] is not None:
+            result['first_frame_latency'] = state['first'] - start
+            # rates are measured from the first frame on, so that frame
+            # counts for neither
+            elapsed = _monotonic() - state['first']
+            if elapsed > 0 and result['frames'] > 1:
+                result['fps'] = (result['frames'] - 1) / elapsed
+                result['bytes_per_sec'] = (result['bytes'] - state['first_bytes']) / elapsed
+    return result
+
+
+def _print_devices(devices):
+    for dev in devices:
+        print("%03d:%03d  %04x:%04x  UVC %s  %-20s %s %s" % (
+            dev['bus'], dev['address'], dev['vendor_id'], dev['product_id'],
+            dev['uvc_version'], dev['serial'] or '-', dev['manufacturer'] or '',
+            dev['product'] or ''))
+
+
+def _print_formats(formats):
+    for fmt in formats:
+        print("Format %d: %s %s, %d bpp" % (fmt['index'], fmt['subtype'], fmt['fourcc'],
+                                           fmt['bits_per_pixel']))
+        for frame in fmt['frames']:
+            print("  Frame %d: %dx%d, max %d bytes, fps %s" % (
+                frame['index'], frame['width'], frame['height'], frame['max_frame_size'],
+                ', '.join('%g' % rate for rate in frame['frame_rates'])))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='uvclite', description="Probe and benchmark UVC cameras")
+    commands = parser.add_subparsers(dest='command')
+    list_parser = commands.add_parser('list', help="list devices")
+    list_parser.add_argument('--json', action='store_true')
+    formats_parser = commands.add_parser('formats', help="show format descriptors")
+    formats_parser.add_argument('--device', help="serial number or BUS:ADDRESS")
+    formats_parser.add_argument('--json', action='store_true')
+    bench_parser = commands.add_parser('bench', help="measure capture throughput")
+    bench_parser.add_argument('--device', help="serial number or BUS:ADDRESS")
+    bench_parser.add_argument('--mode', action='append', type=parse_mode,
+                              help="FORMAT:WIDTHxHEIGHT@FPS, may be repeated, "
+                                   "defaults to every supported mode")
+    bench_parser.add_argument('--duration', type=float, default=5.0,
+                              help="seconds to stream each mode")
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+
+    try:
+        with UVCContext() as context:
+            if args.command == 'list':
+                devices = list_devices(context)
+                if args.json:
+                    print(json.dumps(devices, indent=2))
+                else:
+                    _print_devices(devices)
+                return 0
+
+            device = _open_device(context, args.device)
+            try:
+                if args.command == 'formats':
+                    formats = list_formats(device)
+                    if args.json:
+                        print(json.dumps(formats, indent=2))
+                    else:
+                        _print_formats(formats)
+                    return 0
+
+                modes = args.mode or [mode[:4] for mode in device.get_supported_modes()]
+                results = []
+                for mode in modes:
+                    results.append(bench_mode(device, mode, args.duration))
+                print(json.dumps(results, indent=2))
+                return 0 if all(r['error'] is None for r in results) else 1
+            finally:
+                device.close()
+    except UVCError as err:
+        print("uvclite: %s" % err.args[0], file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,311 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Adaptive stream mode selection driven by consumer backpressure
+
+"""
+
+from collections import deque
+import logging
+import queue
+import threading
+
+from . import libuvc, UVCMode, FRAME_FORMAT_H264
+from .clock import monotonic as _monotonic
+
+__author__ = 'Eric Callahan'
+
+_logger = logging.getLogger(__name__)
+
+_fmt = libuvc.uvc_frame_format
+
+# Approximate bytes per pixel used to rank modes by cost.  MJPEG and
+# H.264 vary with the scene, typical compression ratios are assumed.
+_bytes_per_pixel = {
+    _fmt.UVC_FRAME_FORMAT_YUYV: 2.0,
+    _fmt.UVC_FRAME_FORMAT_UYVY: 2.0,
+    _fmt.UVC_FRAME_FORMAT_RGB: 3.0,
+    _fmt.UVC_FRAME_FORMAT_BGR: 3.0,
+    _fmt.UVC_FRAME_FORMAT_GRAY8: 1.0,
+    _fmt.UVC_FRAME_FORMAT_BY8: 1.0,
+    _fmt.UVC_FRAME_FORMAT_MJPEG: 0.3,
+    FRAME_FORMAT_H264: 0.05
+}
+
+
+def mode_cost(mode):
+    """
+    Returns the estimated bandwidth of a UVCMode in bytes per second.
+    """
+    bpp = _bytes_per_pixel.get(mode.frame_format, 2.0)
+    return mode.width * mode.height * mode.frame_rate * bpp
+
+
+class AdaptiveController(object):
+    """
+    Steps a streaming UVCDevice down to cheaper modes when its
+    consumers fall behind, and back up when the backlog clears.
+
+    Consumers report deliveries and drops, either by handing frames to
+    put(), which offers them to a bounded queue without blocking, or by
+    calling frame_delivered() and frame_dropped() themselves.  Every
+    window seconds the drop rate and queue fill level are evaluated:
+
+    - if drops exceed max_drop_rate or the queue is fuller than
+      high_water for downshift_after consecutive windows, the device
+      switches to the next cheaper mode.
+    - if there were no drops and the queue stayed below low_water for
+      upshift_after consecutive windows, the device switches back to
+      the next more expensive mode.
+
+    No switch is made within min_dwell seconds of the previous one.
+    Switching a device in polling mode from the controller thread could
+    close the stream under a blocked get_frame(), so in polling mode
+    the switch is made by the next get_frame() call instead.
+    If streaming stops first, the switch is abandoned and recorded as
+    failed.
+    The available modes default to every supported mode of the device
+    that is no more expensive than the mode it is streaming in, see
+    UVCDevice.get_supported_modes().  Decisions are logged and kept in
+    the decisions attribute.
+
+    Usage:
+
+    controller = AdaptiveController(device, frame_queue)
+    controller.start()
+
+    def frame_callback(frame, user):
+        controller.put(frame)
+    """
+    def __init__(self, device, frame_queue=None, modes=None, window=2.0,
+                 max_drop_rate=0.05, high_water=0.75, low_water=0.25,
+                 downshift_after=1, upshift_after=5, min_dwell=5.0,
+                 history=100):
+        self._device = device
+        self.frame_queue = frame_queue
+        self.window = window
+        self.max_drop_rate = max_drop_rate
+        self.high_water = high_water
+        self.low_water = low_water
+        self.downshift_after = downshift_after
+        self.upshift_after = upshift_after
+        self.min_dwell = min_dwell
+        self.decisions = deque(maxlen=history)
+
+        if modes is None:
+            modes = device.get_supported_modes()
+            current = device._format_args
+            if current is not None:
+                limit = mode_cost(UVCMode(*(tuple(current) + (0,))))
+                modes = [m for m in modes if mode_cost(m) <= limit]
+        # most expensive first, ties broken so the order is repeatable
+        self.modes = sorted(set(modes), key=_rank, reverse=True)
+        self._index = self._current_index()
+
+        self._delivered = 0
+        self._dropped = 0
+        self._max_fill = 0.0
+        self._pressure_windows = 0
+        self._idle_windows = 0
+        self._last_switch = None
+        self._deferred = None
+        self._lock = threading.Lock()
+        self._count_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def mode(self):
+        """
+        The mode the controller believes the device is streaming in
+        """
+        if not self.modes:
+            return None
+        return self.modes[self._index]
+
+    def _current_index(self):
+        current = self._device._format_args
+        if current is not None:
+            for i, mode in enumerate(self.modes):
+                if _same_mode(mode, current):
+                    return i
+        return 0
+
+    def frame_delivered(self):
+        """
+        Records a frame accepted by the consumer.
+        """
+        with self._count_lock:
+            self._delivered += 1
+
+    def frame_dropped(self):
+        """
+        Records a frame the consumer could not accept.
+        """
+        with self._count_lock:
+            self._dropped += 1
+
+    def put(self, frame):
+        """
+        Offers a frame to frame_queue without blocking.  Returns True
+        if the frame was queued, False if it was dropped.
+        """
+        if self.frame_queue is None:
+            raise ValueError("put() requires a frame_queue, report frames with "
+                             "frame_delivered() and frame_dropped() instead")
+        try:
+            self.frame_queue.put_nowait(frame)
+        except queue.Full:
+            with self._count_lock:
+                self._dropped += 1
+            return False
+        fill = self._queue_fill()
+        with self._count_lock:
+            self._delivered += 1
+            if fill > self._max_fill:
+                self._max_fill = fill
+        return True
+
+    def _queue_fill(self):
+        frame_queue = self.frame_queue
+        if frame_queue is None or frame_queue.maxsize <= 0:
+            return 0.0
+        return float(frame_queue.qsize()) / frame_queue.maxsize
+
+    def evaluate(self):
+        """
+        Evaluates the counters gathered since the last call and
+        switches modes if required.  Called by the controller thread
+        every window seconds, but may be called directly instead of
+        using start().  Returns the new UVCMode if a switch was made,
+        otherwise None.
+
+        A device in polling mode is switched by the thread calling
+        get_frame(), so None is returned and the switch is recorded
+        in decisions once it has been made.
+        """
+        with self._lock:
+            with self._count_lock:
+                delivered, dropped = self._delivered, self._dropped
+                self._delivered = self._dropped = 0
+                fill = self._max_fill
+                self._max_fill = 0.0
+            fill = max(fill, self._queue_fill())
+            if self._deferred is not None:
+                # still waiting on the polling thread
+                return None
+
+            total = delivered + dropped
+            drop_rate = float(dropped) / total if total else 0.0
+
+            if drop_rate > self.max_drop_rate or fill > self.high_water:
+                self._pressure_windows += 1
+                self._idle_windows = 0
+            elif dropped == 0 and fill < self.low_water:
+                self._idle_windows += 1
+                self._pressure_windows = 0
+            else:
+                self._pressure_windows = self._idle_windows = 0
+
+            now = _monotonic()
+            if self._last_switch is not None and now - self._last_switch < self.min_dwell:
+                return None
+
+            reason = "drop rate %.3f, queue fill %.2f" % (drop_rate, fill)
+            if (self._pressure_windows >= self.downshift_after and
+                    self._index + 1 < len(self.modes)):
+                return self._switch(self._index + 1, 'down', reason)
+            if self._idle_windows >= self.upshift_after and self._index > 0:
+                return self._switch(self._index - 1, 'up', reason)
+            return None
+
+    def _switch(self, index, direction, reason):
+        new_mode = self.modes[index]
+        self._pressure_windows = self._idle_windows = 0
+        self._last_switch = _monotonic()
+        decision = (self._last_switch, index, direction, self.modes[self._index],
+                    new_mode, reason)
+        _logger.info("Shifting %s from %s to %s (%s)", direction,
+                     _describe(decision[3]), _describe(new_mode), reason)
+        args = (new_mode.frame_format, new_mode.width, new_mode.height,
+                new_mode.frame_rate)
+        if self._device.is_polling:
+            self._deferred = decision
+            self._device._deferred_switch = (args, self._deferred_done)
+            return None
+        try:
+            self._device.switch_format(*args)
+        except Exception as err:     # pylint: disable=broad-except
+            self._record(decision, err)
+            return None
+        self._record(decision, None)
+        return new_mode
+
+    def _deferred_done(self, report, error):    # pylint: disable=unused-argument
+        # called by the polling thread once it has made the switch
+        with self._lock:
+            decision, self._deferred = self._deferred, None
+            if decision is not None:
+                self._record(decision, error)
+
+    def _record(self, decision, error):
+        when, index, direction, old_mode, new_mode, reason = decision
+        if error is not None:
+            _logger.error("Mode switch to %s failed: %s", _describe(new_mode), error)
+        else:
+            self._index = index
+        self.decisions.append((when, direction, old_mode, new_mode, reason,
+                               error is None))
+
+    def start(self):
+        """
+        Starts a thread that calls evaluate() every window seconds.
+        """
+        if self._thread is None:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='uvclite-adaptive')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops the controller thread.
+        """
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop_event.wait(self.window):
+            if self._device.is_streaming:
+                self.evaluate()
+
+
+def _rank(mode):
+    return (mode_cost(mode), mode.width * mode.height, mode.frame_rate,
+            _describe(mode))
+
+
+def _same_mode(mode, format_args):
+    return (mode.frame_format, mode.width, mode.height,
+            mode.frame_rate) == tuple(format_args)
+
+
+def _describe(mode):
+    return "%s %dx%d@%d" % (mode.frame_format.name.replace('UVC_FRAME_FORMAT_', ''),
+                            mode.width, mode.height, mode.frame_rate)
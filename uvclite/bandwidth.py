@@ -0,0 +1,267 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" USB bandwidth planning for several cameras sharing a bus
+
+Isochronous UVC streams reserve a fixed number of bytes in every USB
+microframe, given by the dwMaxPayloadTransferSize the device reports
+for the negotiated mode.  A high speed bus may dedicate at most 80% of
+each 7500 byte microframe to periodic transfers, and a single endpoint
+may move at most 3 x 1024 bytes per microframe.  When the reservations
+of the cameras on one bus exceed that, uvc_stream_start fails with a
+no space error, or frames arrive torn.
+
+The planner negotiates candidate modes with each device (a probe only,
+nothing is committed), estimates their reservations and picks the
+highest quality combination that fits on every bus.
+"""
+
+from collections import namedtuple
+import logging
+
+from . import libuvc, UVCError, FrameBasedFormat
+
+__author__ = 'Eric Callahan'
+
+_logger = logging.getLogger(__name__)
+
+# bytes per 125us microframe on a USB 2.0 high speed bus
+HIGH_SPEED_MICROFRAME = 7500
+HIGH_SPEED_PERIODIC_BUDGET = HIGH_SPEED_MICROFRAME * 8 // 10
+MICROFRAMES_PER_SECOND = 8000
+MAX_ISO_PACKET = 3 * 1024
+
+# A negotiated mode and its bandwidth estimate.
+#   mode            - the UVCMode
+#   payload_size    - dwMaxPayloadTransferSize from the device
+#   max_frame_size  - dwMaxVideoFrameSize from the device
+#   reserved        - bytes reserved per microframe
+#   data_rate       - worst case bytes per second of the stream
+#   sufficient      - False if the reservation cannot carry data_rate.
+#                     Always True for MJPEG and frame based formats,
+#                     whose dwMaxVideoFrameSize is far above the
+#                     typical frame size.
+ModeEstimate = namedtuple('ModeEstimate', ['mode', 'payload_size', 'max_frame_size',
+                                           'reserved', 'data_rate', 'sufficient'])
+
+
+def _compressed(mode):
+    return (mode.frame_format == libuvc.uvc_frame_format.UVC_FRAME_FORMAT_MJPEG or
+            isinstance(mode.frame_format, FrameBasedFormat))
+
+
+def default_quality(mode):
+    """
+    Ranks modes by pixel rate, preferring uncompressed formats when
+    the pixel rate is equal.
+    """
+    return (mode.width * mode.height * mode.frame_rate, not _compressed(mode))
+
+
+class BandwidthPlan(object):
+    """
+    The result of BandwidthPlanner.plan().
+
+    fits        - True if every device has a mode and every bus is
+                  within its budget
+    assignments - dict of device name to the chosen ModeEstimate, or
+                  None if no candidate mode could be negotiated
+    unplaced    - sorted names of the devices assigned None
+    buses       - dict of bus number to a dict with the 'budget', the
+                  'reserved' bytes per microframe and the 'devices' on it
+    """
+    def __init__(self, fits, assignments, buses, devices):
+        self.fits = fits
+        self.assignments = assignments
+        self.unplaced = sorted(n for n, e in assignments.items() if e is None)
+        self.buses = buses
+        self._devices = devices
+
+    def apply(self):
+        """
+        Sets the planned stream format on every device.  Call before
+        start_streaming().
+        """
+        for name, estimate in self.assignments.items():
+            if estimate is None:
+                continue
+            mode = estimate.mode
+            self._devices[name].set_stream_format(mode.frame_format, mode.width,
+                                                  mode.height, mode.frame_rate)
+
+    def as_dict(self):
+        assignments = {}
+        for name, estimate in self.assignments.items():
+            if estimate is None:
+                assignments[name] = None
+                continue
+            mode = estimate.mode
+            assignments[name] = {
+                'format': mode.frame_format.name,
+                'width': mode.width,
+                'height': mode.height,
+                'frame_rate': mode.frame_rate,
+                'reserved': estimate.reserved,
+                'data_rate': estimate.data_rate,
+                'sufficient': estimate.sufficient
+            }
+        return {'fits': self.fits, 'assignments': assignments, 'unplaced': self.unplaced,
+                'buses': self.buses}
+
+
+class BandwidthPlanner(object):
+    """
+    Plans stream modes for a set of open devices so the isochronous
+    reservations on each USB bus stay within budget.
+
+    Usage:
+
+    planner = BandwidthPlanner()
+    for dev in devices:
+        dev.open()
+        planner.add_device(dev)
+    plan = planner.plan()
+    if plan.fits:
+        plan.apply()
+
+    Params:
+    bus_budget     - periodic bytes per microframe available on each bus
+    max_packet     - maximum bytes per microframe for one endpoint
+    quality        - key function ranking UVCModes, highest is best
+    """
+    def __init__(self, bus_budget=HIGH_SPEED_PERIODIC_BUDGET,
+                 max_packet=MAX_ISO_PACKET, quality=default_quality):
+        self.bus_budget = bus_budget
+        self.max_packet = max_packet
+        self.quality = quality
+        self._devices = {}
+        self._candidates = {}
+        self._buses = {}
+        self._estimates = {}
+
+    def add_device(self, device, modes=None, name=None, bus=None):
+        """
+        Adds an open device to the plan.
+
+        Params:
+        device - an open UVCDevice
+        modes  - acceptable UVCModes, defaults to every supported mode
+        name   - key used in the plan, defaults to "bus-address"
+        bus    - bus number, defaults to the bus the device is on
+
+        Returns the name.
+        """
+        if bus is None:
+            bus = device.get_bus_number()
+        if name is None:
+            name = '%d-%d' % (bus, device.get_device_address())
+        if modes is None:
+            modes = device.get_supported_modes()
+        self._devices[name] = device
+        self._candidates[name] = sorted(set(modes), key=self.quality, reverse=True)
+        self._buses[name] = bus
+        return name
+
+    def estimate(self, name, mode):
+        """
+        Negotiates mode with the named device and returns its
+        ModeEstimate, or None if the device rejected the mode.
+        Results are cached.
+        """
+        key = (name, mode)
+        if key in self._estimates:
+            return self._estimates[key]
+
+        try:
+            ctrl = self._devices[name].probe_stream_format(
+                mode.frame_format, mode.width, mode.height, mode.frame_rate)
+        except UVCError as err:
+            _logger.debug("Device %s rejected %s: %s", name, mode, err)
+            estimate = None
+        else:
+            reserved = min(ctrl.dwMaxPayloadTransferSize, self.max_packet)
+            data_rate = ctrl.dwMaxVideoFrameSize * mode.frame_rate
+            sufficient = (_compressed(mode) or
+                          reserved * MICROFRAMES_PER_SECOND >= data_rate)
+            estimate = ModeEstimate(mode, ctrl.dwMaxPayloadTransferSize,
+                                    ctrl.dwMaxVideoFrameSize, reserved, data_rate,
+                                    sufficient)
+        self._estimates[key] = estimate
+        return estimate
+
+    def _next_estimate(self, name, start):
+        # the first usable candidate at or after index start
+        candidates = self._candidates[name]
+        for index in range(start, len(candidates)):
+            estimate = self.estimate(name, candidates[index])
+            if estimate is not None and estimate.sufficient:
+                return index, estimate
+        return None, None
+
+    def plan(self):
+        """
+        Chooses a mode for every device.  Each device starts at its
+        best mode, and while a bus is over budget the device on it with
+        the largest reservation is stepped down to its next mode that
+        reserves less.  Returns a BandwidthPlan, which does not fit if
+        a device has no usable mode.
+        """
+        positions = {}
+        assignments = {}
+        for name in self._devices:
+            positions[name], assignments[name] = self._next_estimate(name, 0)
+            if assignments[name] is None:
+                _logger.warning("No usable mode for device %s", name)
+
+        buses = {}
+        for name, bus in self._buses.items():
+            buses.setdefault(bus, []).append(name)
+
+        fits = all(estimate is not None for estimate in assignments.values())
+        report = {}
+        for bus, names in buses.items():
+            while True:
+                reserved = sum(assignments[n].reserved for n in names
+                               if assignments[n] is not None)
+                if reserved <= self.bus_budget:
+                    break
+                if not self._step_down(names, positions, assignments):
+                    fits = False
+                    break
+            report[bus] = {
+                'budget': self.bus_budget,
+                'reserved': reserved,
+                'devices': sorted(names)
+            }
+
+        return BandwidthPlan(fits, assignments, report, dict(self._devices))
+
+    def _step_down(self, names, positions, assignments):
+        # largest reservation first, among devices that can reserve less
+        ranked = sorted((n for n in names if assignments[n] is not None),
+                        key=lambda n: assignments[n].reserved, reverse=True)
+        for name in ranked:
+            current = assignments[name].reserved
+            index = positions[name] + 1
+            while True:
+                index, estimate = self._next_estimate(name, index)
+                if estimate is None:
+                    break
+                if estimate.reserved < current:
+                    positions[name], assignments[name] = index, estimate
+                    return True
+                index += 1
+        return False
@@ -0,0 +1,151 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Contiguous frame batches filled straight from libuvc frame buffers
+
+"""
+
+from array import array
+from ctypes import addressof, c_char, memmove
+
+from . import libuvc
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__author__ = 'Eric Callahan'
+
+_fmt = libuvc.uvc_frame_format
+
+# bytes per pixel of the raw layouts, compressed formats are absent
+FORMAT_CHANNELS = {
+    _fmt.UVC_FRAME_FORMAT_YUYV.value: 2,
+    _fmt.UVC_FRAME_FORMAT_UYVY.value: 2,
+    _fmt.UVC_FRAME_FORMAT_RGB.value: 3,
+    _fmt.UVC_FRAME_FORMAT_BGR.value: 3,
+    _fmt.UVC_FRAME_FORMAT_GRAY8.value: 1,
+    _fmt.UVC_FRAME_FORMAT_BY8.value: 1
+}
+
+
+class FrameBatch(object):
+    """
+    A batch of up to capacity frames copied into one preallocated,
+    contiguous buffer, one fixed size slot per frame.
+
+    data       - the buffer.  With NumPy it is a uint8 array shaped
+                 (capacity, height, width, channels) for raw formats,
+                 or (capacity, slot_size) for compressed formats.
+                 Without NumPy it is a bytearray.
+    count      - number of frames in the batch
+    sequences  - libuvc sequence number of each frame
+    timestamps - host monotonic timestamp of each frame (see
+                 UVCFrame.host_time)
+    sizes      - number of bytes of each frame
+
+    The metadata are NumPy arrays with NumPy, array.array otherwise,
+    and only the first count entries of each are valid.
+    """
+    def __init__(self, capacity, slot_size, shape=None, use_numpy=True):
+        self.capacity = capacity
+        self.slot_size = slot_size
+        self.count = 0
+        self.truncated = 0
+        if use_numpy and numpy is not None:
+            if shape is None:
+                shape = (slot_size,)
+            self.data = numpy.empty((capacity,) + tuple(shape), dtype=numpy.uint8)
+            self._address = self.data.ctypes.data
+            self.sequences = numpy.zeros(capacity, dtype=numpy.uint32)
+            self.timestamps = numpy.zeros(capacity, dtype=numpy.float64)
+            self.sizes = numpy.zeros(capacity, dtype=numpy.uint32)
+        else:
+            self.data = bytearray(capacity * slot_size)
+            self._address = addressof((c_char * len(self.data)).from_buffer(self.data))
+            self.sequences = array('I', [0] * capacity)
+            self.timestamps = array('d', [0.0] * capacity)
+            self.sizes = array('I', [0] * capacity)
+
+    @property
+    def full(self):
+        return self.count >= self.capacity
+
+    def add(self, frame, timestamp):
+        """
+        Copies a uvc_frame struct into the next slot.  Frames larger
+        than the slot are truncated and counted in truncated.  Raw
+        frames whose rows are padded (step larger than a row) are
+        copied row by row so the slot is tightly packed.
+        """
+        index = self.count
+        dest = self._address + index * self.slot_size
+        size = frame.data_bytes
+        channels = FORMAT_CHANNELS.get(frame.frame_format)
+        row = frame.width * channels if channels else 0
+        if row and frame.step > row:
+            rows = min(frame.height, self.slot_size // row)
+            for y in range(rows):
+                memmove(dest + y * row, frame.data + y * frame.step, row)
+            size = rows * row
+        else:
+            if size > self.slot_size:
+                size = self.slot_size
+                self.truncated += 1
+            memmove(dest, frame.data, size)
+
+        self.sequences[index] = frame.sequence
+        self.timestamps[index] = timestamp
+        self.sizes[index] = size
+        self.count = index + 1
+
+    def frame_data(self, index):
+        """
+        Returns a memoryview of the bytes of frame index.
+        """
+        if index >= self.count:
+            raise IndexError()
+        start = index * self.slot_size
+        return memoryview(self.data).cast('B')[start:start + self.sizes[index]]
+
+    def frames(self):
+        """
+        Returns the filled part of data, a view of the first count
+        slots.
+        """
+        if numpy is not None and isinstance(self.data, numpy.ndarray):
+            return self.data[:self.count]
+        return memoryview(self.data)[:self.count * self.slot_size]
+
+
+def batch_layout(frame_format, width, height, max_frame_size):
+    """
+    Returns (slot_size, shape) of a FrameBatch for the given stream
+    format.  max_frame_size sizes the slots of compressed formats.
+    """
+    value = getattr(frame_format, 'value', frame_format)
+    channels = FORMAT_CHANNELS.get(value)
+    if channels:
+        return width * height * channels, (height, width, channels)
+    return max_frame_size, None
+
+
+def capture_timestamp(frame, clock, arrival_time):
+    # host_time as a UVCFrame would compute it, without building one
+    capture_time = frame.capture_time
+    return clock.update(capture_time.tv_sec + capture_time.tv_usec / 1000000.0,
+                        arrival_time)
@@ -0,0 +1,330 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" A memory budget for the frames held across all devices of a process
+
+"""
+
+import queue
+import threading
+import weakref
+
+__author__ = 'Eric Callahan'
+
+DROP_NEWEST = 'drop_newest'
+DROP_OLDEST = 'drop_oldest'
+
+
+class _Account(object):
+    # bytes held for one device
+    __slots__ = ('device', 'weight', 'held', 'consumers', 'dropped')
+
+    def __init__(self, device, weight):
+        self.device = device
+        self.weight = weight
+        self.held = 0
+        self.consumers = {}
+        self.dropped = 0
+
+
+class FrameBudget(object):
+    """
+    Limits the bytes of frame data held in memory by every device
+    added to it.  Each device gets a share of the limit in proportion
+    to its weight, by default the dwMaxVideoFrameSize negotiated for
+    its stream.
+
+    A frame is charged to its device when the device copies it into
+    a UVCFrame, and the charge is released when the UVCFrame is
+    garbage collected.  Frames placed in a BudgetedQueue are charged
+    to that consumer until they are taken out.
+
+    When a frame would take a device past its share, or the process
+    past the limit, the policy decides:
+
+    drop_newest - the new frame is dropped before it is copied
+    drop_oldest - the oldest frames of the consumer holding the most
+                  bytes are evicted until the new frame fits, and the
+                  new frame is dropped only if evicting is not enough
+
+    Frames copied into FrameBatches are not charged, but are still
+    dropped while their device is over budget.
+
+    Usage:
+
+    budget = FrameBudget(256 * 1024 * 1024, policy=DROP_OLDEST)
+    for dev in devices:
+        dev.set_stream_format(...)
+        budget.add_device(dev)
+    frames = BudgetedQueue(budget, 'encoder', maxsize=32)
+    """
+    def __init__(self, limit, policy=DROP_NEWEST):
+        if policy not in (DROP_NEWEST, DROP_OLDEST):
+            raise ValueError("Unknown budget policy %r" % policy)
+        self.limit = limit
+        self.policy = policy
+        self._lock = threading.RLock()
+        self._accounts = {}
+        self._consumers = weakref.WeakValueDictionary()
+        self._held = 0
+        self._stats = {
+            'charged': 0,
+            'dropped': 0,
+            'evicted': 0,
+            'peak': 0
+        }
+
+    def add_device(self, device, name=None, weight=None):
+        """
+        Puts a device under the budget and returns its name.
+
+        Params:
+        device - a UVCDevice
+        name   - name used in usage(), defaults to "bus-address"
+        weight - relative share, defaults to the device's negotiated
+                 dwMaxVideoFrameSize, read on every frame so format
+                 switches are followed
+
+        A device added under the name of one removed earlier takes
+        over its account, along with the frames still charged to it.
+        """
+        if name is None:
+            name = '%d-%d' % (device.get_bus_number(), device.get_device_address())
+        with self._lock:
+            account = self._accounts.get(name)
+            if account is None:
+                self._accounts[name] = _Account(device, weight)
+            else:
+                account.device = device
+                account.weight = weight
+        device.budget = self
+        device.budget_name = name
+        return name
+
+    def remove_device(self, device):
+        """
+        Takes a device out of the budget.  Frames it already delivered
+        stay charged until they are released.  Does nothing if the
+        device is not under this budget.
+        """
+        with self._lock:
+            account = self._accounts.get(device.budget_name)
+            if account is None or account.device is not device:
+                return
+            account.device = None
+            if not account.held:
+                del self._accounts[device.budget_name]
+        device.budget = None
+
+    def _weight(self, account):
+        if account.weight is not None:
+            return account.weight
+        device = account.device
+        if device is None:
+            return 0
+        ctrl = getattr(device, '_stream_ctrl', None)
+        return ctrl.dwMaxVideoFrameSize if ctrl is not None else 1
+
+    def share(self, name):
+        """
+        Returns the bytes the named device may hold.
+        """
+        with self._lock:
+            total = sum(self._weight(a) for a in self._accounts.values())
+            if not total:
+                return self.limit
+            return self.limit * self._weight(self._accounts[name]) // total
+
+    def _fits(self, account, name, size):
+        return (self._held + size <= self.limit and
+                account.held + size <= self.share(name))
+
+    def reserve(self, name, size):
+        """
+        Called by a device before copying a frame of size bytes.
+        Returns a charge to pass to charge(), or None if the frame
+        must be dropped.
+        """
+        with self._lock:
+            account = self._accounts[name]
+            if not self._fits(account, name, size) and self.policy == DROP_OLDEST:
+                self._evict(account, name, size)
+            if not self._fits(account, name, size):
+                account.dropped += 1
+                self._stats['dropped'] += 1
+                return None
+            # charged now, so frames reserved together cannot overshoot
+            account.held += size
+            self._held += size
+            self._stats['charged'] += 1
+            if self._held > self._stats['peak']:
+                self._stats['peak'] = self._held
+            return [name, None, size]
+
+    def _evict(self, account, name, size):
+        # evict from the largest consumer, among this device's if it is
+        # over its share, until the frame fits or nothing is left
+        while not self._fits(account, name, size):
+            over_share = account.held + size > self.share(name)
+            largest = None
+            largest_bytes = 0
+            for consumer_name, consumer in list(self._consumers.items()):
+                if over_share:
+                    held = account.consumers.get(consumer_name, 0)
+                else:
+                    held = sum(a.consumers.get(consumer_name, 0)
+                               for a in self._accounts.values())
+                if held > largest_bytes:
+                    largest, largest_bytes = consumer, held
+            if largest is None:
+                return
+            before = self._held
+            frame = largest.evict_oldest(name if over_share else None)
+            if frame is None:
+                return
+            self._stats['evicted'] += 1
+            # released now rather than when the frame is collected,
+            # which other references to it may put off
+            finalizer = getattr(frame, '_budget_finalizer', None)
+            if finalizer is not None:
+                finalizer()
+            frame._budget_charge = None
+            if self._held >= before:
+                return
+
+    def charge(self, frame, charge):
+        """
+        Ties a reserved charge to the UVCFrame built for it.
+        """
+        frame._budget_charge = charge  # pylint: disable=protected-access
+        frame._budget_finalizer = weakref.finalize(frame, self.release, charge)
+
+    def release(self, charge):
+        """
+        Releases a charge that was reserved but not passed to charge().
+        """
+        with self._lock:
+            name, consumer, size = charge
+            account = self._accounts[name]
+            account.held -= size
+            if consumer is not None:
+                account.consumers[consumer] -= size
+            self._held -= size
+            if account.device is None and not account.held:
+                # the device was removed and this was its last frame
+                del self._accounts[name]
+
+    def transfer(self, frame, consumer):
+        """
+        Charges a frame to the named consumer, or to no consumer if
+        consumer is None.  Frames that were not charged are ignored.
+        """
+        charge = getattr(frame, '_budget_charge', None)
+        if charge is None:
+            return
+        with self._lock:
+            name, old, size = charge
+            account = self._accounts[name]
+            if old is not None:
+                account.consumers[old] -= size
+            if consumer is not None:
+                account.consumers[consumer] = account.consumers.get(consumer, 0) + size
+            charge[1] = consumer
+
+    def _register(self, consumer):
+        with self._lock:
+            self._consumers[consumer.name] = consumer
+
+    def usage(self):
+        """
+        Returns the current accounting as a dict:
+
+        limit   - the budget in bytes
+        held    - bytes held by every device
+        devices - dict of device name to a dict of its 'share', bytes
+                  'held', bytes held per consumer in 'consumers' and
+                  frames 'dropped' by the budget
+        """
+        with self._lock:
+            devices = {}
+            for name, account in self._accounts.items():
+                devices[name] = {
+                    'share': self.share(name),
+                    'held': account.held,
+                    'consumers': dict((c, held) for c, held in account.consumers.items()
+                                      if held),
+                    'dropped': account.dropped
+                }
+            return {'limit': self.limit, 'held': self._held, 'devices': devices}
+
+    def get_stats(self):
+        """
+        Returns a dict of counters: frames charged, dropped by the
+        budget and evicted from consumers, the bytes held and the
+        peak bytes held.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['held'] = self._held
+        return stats
+
+
+class BudgetedQueue(queue.Queue):
+    """
+    A queue.Queue of UVCFrames whose frames are charged to it under a
+    FrameBudget.  With the drop_oldest policy the budget may evict its
+    oldest frames to make room for new ones.
+    """
+    def __init__(self, budget, name, maxsize=0):
+        queue.Queue.__init__(self, maxsize)
+        self.budget = budget
+        self.name = name
+        self.evicted = 0
+        budget._register(self)     # pylint: disable=protected-access
+
+    # charges move outside the queue's mutex, which the budget takes
+    # while holding its own lock when evicting
+
+    def put(self, item, block=True, timeout=None):
+        self.budget.transfer(item, self.name)
+        try:
+            queue.Queue.put(self, item, block, timeout)
+        except queue.Full:
+            self.budget.transfer(item, None)
+            raise
+
+    def get(self, block=True, timeout=None):
+        item = queue.Queue.get(self, block, timeout)
+        self.budget.transfer(item, None)
+        return item
+
+    def evict_oldest(self, device_name=None):
+        """
+        Removes and returns the oldest frame, or the oldest from the
+        named device.  Returns None if there is none.
+        """
+        with self.mutex:
+            for index, frame in enumerate(self.queue):
+                charge = getattr(frame, '_budget_charge', None)
+                if device_name is None or (charge and charge[0] == device_name):
+                    del self.queue[index]
+                    break
+            else:
+                return None
+            self.not_full.notify()
+        self.budget.transfer(frame, None)
+        self.evicted += 1
+        return frame
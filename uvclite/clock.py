@@ -0,0 +1,185 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Mapping of frame capture times onto the host monotonic clock
+
+"""
+
+import math
+import time
+
+__author__ = 'Eric Callahan'
+
+# the host clock every uvclite timestamp is read from
+monotonic = time.monotonic
+
+
+class ClockSync(object):
+    """
+    Fits a line host_time = offset + rate * capture_time online, using
+    exponentially weighted least squares over (capture_time, arrival
+    time) pairs, where arrival times are read from the host monotonic
+    clock as frames are received.
+
+    The fitted offset includes the mean delivery latency, so mapped
+    times estimate when frames became available on the host, without
+    the scheduling jitter of the arrival times.  A residual larger than
+    step_threshold seconds (for example an NTP step of the wall clock)
+    restarts the fit.
+
+    libuvc stamps uvc_frame.capture_time with the host wall clock when
+    the last payload of a frame arrives.  With wall_clock set, the
+    current offset between the wall clock and the monotonic clock is
+    also sampled on each update, which gives the true delay between
+    capture and arrival (see get_stats()).  Clear it for capture
+    times that come from a device clock.
+
+    Params:
+    forgetting     - weight decay per sample, closer to 1 averages
+                     over more frames
+    step_threshold - residual in seconds that restarts the fit
+    wall_clock     - capture times are host wall clock times
+    """
+    def __init__(self, forgetting=0.995, step_threshold=0.5, wall_clock=True):
+        self.forgetting = forgetting
+        self.step_threshold = step_threshold
+        self.wall_clock = wall_clock
+        self.resets = 0
+        self._reset()
+
+    def _reset(self):
+        self._x0 = None
+        self._y0 = None
+        self._sw = self._sx = self._sy = self._sxx = self._sxy = 0.0
+        self._offset = 0.0
+        self._rate = 1.0
+        self.samples = 0
+        self._jitter_mean = 0.0
+        self._jitter_m2 = 0.0
+        self._jitter_max = 0.0
+        self._latency_last = None
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+        self._last_capture = None
+
+    def update(self, capture_time, arrival_time):
+        """
+        Adds a sample and returns capture_time mapped to the host
+        monotonic clock.
+        """
+        if self._x0 is None:
+            self._x0 = capture_time
+            self._y0 = arrival_time
+        x = capture_time - self._x0
+        y = arrival_time - self._y0
+
+        if self.samples:
+            residual = y - (self._offset + self._rate * x)
+            if abs(residual) > self.step_threshold:
+                self.resets += 1
+                self._reset()
+                return self.update(capture_time, arrival_time)
+
+            # Welford's running mean and variance of the residuals
+            count = self.samples
+            delta = residual - self._jitter_mean
+            self._jitter_mean += delta / count
+            self._jitter_m2 += delta * (residual - self._jitter_mean)
+            if abs(residual) > self._jitter_max:
+                self._jitter_max = abs(residual)
+
+        decay = self.forgetting
+        self._sw = self._sw * decay + 1.0
+        self._sx = self._sx * decay + x
+        self._sy = self._sy * decay + y
+        self._sxx = self._sxx * decay + x * x
+        self._sxy = self._sxy * decay + x * y
+        self.samples += 1
+
+        denom = self._sw * self._sxx - self._sx * self._sx
+        if self.samples > 2 and denom > 1e-12:
+            self._rate = (self._sw * self._sxy - self._sx * self._sy) / denom
+            self._offset = (self._sy - self._rate * self._sx) / self._sw
+        else:
+            self._rate = 1.0
+            self._offset = (self._sy - self._sx) / self._sw
+
+        self._last_capture = capture_time
+        if self.wall_clock:
+            latency = arrival_time - (capture_time - (time.time() - monotonic()))
+            self._latency_last = latency
+            self._latency_total += latency
+            if latency > self._latency_max:
+                self._latency_max = latency
+        return self.to_host(capture_time)
+
+    def to_host(self, capture_time):
+        """
+        Maps a capture time onto the host monotonic clock using the
+        current fit.
+        """
+        if self._x0 is None:
+            return None
+        return self._y0 + self._offset + self._rate * (capture_time - self._x0)
+
+    @property
+    def offset(self):
+        """
+        Seconds to add to a capture time to get host monotonic time,
+        at the most recent sample
+        """
+        if self._last_capture is None:
+            return None
+        return self.to_host(self._last_capture) - self._last_capture
+
+    @property
+    def drift(self):
+        """
+        Drift of the capture clock against the host clock in parts
+        per million
+        """
+        return (self._rate - 1.0) * 1e6
+
+    def get_stats(self):
+        """
+        Returns a dict describing the fit:
+
+        samples        - samples since the last reset
+        resets         - times the fit was restarted
+        offset         - see offset
+        drift_ppm      - see drift
+        jitter_mean    - mean residual of arrivals against the fit (seconds)
+        jitter_std     - standard deviation of the residuals
+        jitter_max     - largest absolute residual
+        latency_last   - delay between capture and arrival of the last
+                         frame in seconds, None unless wall_clock is set
+        latency_avg    - average delay since the last reset
+        latency_max    - maximum delay since the last reset
+        """
+        count = self.samples - 1
+        return {
+            'latency_avg': (self._latency_total / self.samples
+                            if self.wall_clock and self.samples else None),
+            'latency_max': self._latency_max if self.wall_clock else None,
+            'samples': self.samples,
+            'resets': self.resets,
+            'offset': self.offset,
+            'drift_ppm': self.drift,
+            'jitter_mean': self._jitter_mean,
+            'jitter_std': math.sqrt(self._jitter_m2 / count) if count > 1 else 0.0,
+            'jitter_max': self._jitter_max,
+            'latency_last': self._latency_last
+        }
@@ -0,0 +1,530 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" JPEG encoding of raw frames in a pool of worker processes
+
+Raw frames are copied once, from the libuvc buffer into a block of
+shared memory, and the worker process encodes from there.  Only the
+block name and the frame geometry travel over the worker's pipe, and
+only the JPEG data comes back.
+
+The encoder backend is the first of simplejpeg, OpenCV (cv2) and
+Pillow that can be imported.  All of them also require NumPy.
+"""
+
+from collections import deque
+from ctypes import addressof, c_char, memmove
+import io
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+import os
+import queue
+import threading
+
+from . import libuvc
+from .ipc import _Attached
+from .clock import monotonic as _monotonic
+
+__author__ = 'Eric Callahan'
+
+_logger = logging.getLogger(__name__)
+
+_fmt = libuvc.uvc_frame_format
+
+BACKENDS = ('simplejpeg', 'cv2', 'PIL')
+
+_STOP = None
+
+
+def available_backends():
+    """
+    Returns the names of the encoder backends that can be imported.
+    """
+    found = []
+    for name in BACKENDS:
+        try:
+            __import__('numpy')
+            __import__(name)
+        except ImportError:
+            continue
+        found.append(name)
+    return found
+
+
+def _pixels(view, frame_format, width, height, step):
+    # (height, width, channels) array of the frame rows
+    import numpy
+    rows = numpy.frombuffer(view, dtype=numpy.uint8, count=step * height)
+    rows = rows.reshape(height, step)
+    if frame_format in (_fmt.UVC_FRAME_FORMAT_YUYV.value, _fmt.UVC_FRAME_FORMAT_UYVY.value):
+        return rows[:, :width * 2].reshape(height, width, 2)
+    if frame_format in (_fmt.UVC_FRAME_FORMAT_RGB.value, _fmt.UVC_FRAME_FORMAT_BGR.value):
+        return rows[:, :width * 3].reshape(height, width, 3)
+    return rows[:, :width].reshape(height, width, 1)
+
+
+def _planes(pixels, frame_format):
+    # Y, U and V planes of a 4:2:2 packed frame
+    luma = 0 if frame_format == _fmt.UVC_FRAME_FORMAT_YUYV.value else 1
+    chroma = pixels[:, :, 1 - luma]
+    return pixels[:, :, luma], chroma[:, 0::2], chroma[:, 1::2]
+
+
+def _load_backend(name):
+    # returns encode(pixels, frame_format, quality) -> bytes
+    import numpy
+
+    if name == 'simplejpeg':
+        import simplejpeg
+
+        def _encode(pixels, frame_format, quality):
+            if pixels.shape[2] == 2:
+                y, u, v = (numpy.ascontiguousarray(p) for p in _planes(pixels, frame_format))
+                return simplejpeg.encode_jpeg_yuv_planes(y, u, v, quality)
+            if pixels.shape[2] == 1:
+                return simplejpeg.encode_jpeg(numpy.ascontiguousarray(pixels), quality,
+                                              colorspace='GRAY')
+            colorspace = 'RGB' if frame_format == _fmt.UVC_FRAME_FORMAT_RGB.value else 'BGR'
+            return simplejpeg.encode_jpeg(numpy.ascontiguousarray(pixels), quality,
+                                          colorspace=colorspace)
+        return _encode
+
+    if name == 'cv2':
+        import cv2
+        conversions = {
+            _fmt.UVC_FRAME_FORMAT_YUYV.value: cv2.COLOR_YUV2BGR_YUYV,
+            _fmt.UVC_FRAME_FORMAT_UYVY.value: cv2.COLOR_YUV2BGR_UYVY,
+            _fmt.UVC_FRAME_FORMAT_RGB.value: cv2.COLOR_RGB2BGR
+        }
+
+        def _encode(pixels, frame_format, quality):
+            conversion = conversions.get(frame_format)
+            if conversion is not None:
+                pixels = cv2.cvtColor(pixels, conversion)
+            elif pixels.shape[2] == 1:
+                pixels = pixels[:, :, 0]
+            ok, data = cv2.imencode('.jpg', pixels, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if not ok:
+                raise ValueError("cv2.imencode failed")
+            return data.tobytes()
+        return _encode
+
+    if name == 'PIL':
+        from PIL import Image
+
+        def _encode(pixels, frame_format, quality):
+            if pixels.shape[2] == 2:
+                y, u, v = _planes(pixels, frame_format)
+                ycbcr = numpy.empty(pixels.shape[:2] + (3,), dtype=numpy.uint8)
+                ycbcr[:, :, 0] = y
+                ycbcr[:, :, 1] = numpy.repeat(u, 2, axis=1)
+                ycbcr[:, :, 2] = numpy.repeat(v, 2, axis=1)
+                image = Image.fromarray(ycbcr, 'YCbCr')
+            elif pixels.shape[2] == 1:
+                image = Image.fromarray(numpy.ascontiguousarray(pixels[:, :, 0]), 'L')
+            else:
+                if frame_format == _fmt.UVC_FRAME_FORMAT_BGR.value:
+                    pixels = pixels[:, :, ::-1]
+                image = Image.fromarray(numpy.ascontiguousarray(pixels), 'RGB')
+            out = io.BytesIO()
+            image.save(out, 'JPEG', quality=quality)
+            return out.getvalue()
+        return _encode
+
+    raise ValueError("Unknown encoder backend %r" % name)
+
+
+def _worker_main(conn, backend, quality):
+    # runs in the worker process
+    encode = _load_backend(backend)
+    blocks = {}
+    try:
+        while True:
+            task = conn.recv()
+            if task is _STOP:
+                break
+            index, block_name, size, frame_format, width, height, step = task
+            start = _monotonic()
+            try:
+                shm = blocks.get(block_name)
+                if shm is None:
+                    shm = blocks[block_name] = _Attached(block_name)
+                view = shm.buf[:size]
+                try:
+                    data = encode(_pixels(view, frame_format, width, height, step),
+                                  frame_format, quality)
+                finally:
+                    view.release()
+                conn.send((index, data, _monotonic() - start, None))
+            except Exception as err:     # pylint: disable=broad-except
+                conn.send((index, None, _monotonic() - start, repr(err)))
+    except (EOFError, KeyboardInterrupt):
+        pass
+    finally:
+        for shm in blocks.values():
+            shm.close()
+
+
+class EncodedFrame(object):
+    """
+    A JPEG encoded frame.
+
+    data      - the JPEG bytes
+    sequence  - libuvc sequence number of the raw frame
+    timestamp - host timestamp of the raw frame
+    width, height
+    latency   - seconds from submission to release in order
+    """
+    __slots__ = ('data', 'sequence', 'timestamp', 'width', 'height', 'latency')
+
+    def __init__(self, data, sequence, timestamp, width, height, latency):
+        self.data = data
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.width = width
+        self.height = height
+        self.latency = latency
+
+
+class _Worker(object):
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.send_lock = threading.Lock()
+        self.queued = 0
+        self.completed = 0
+        self.errors = 0
+        self.encode_total = 0.0
+        self.encode_max = 0.0
+
+
+class JPEGEncoder(object):
+    """
+    Encodes raw frames (YUYV, UYVY, RGB, BGR, GRAY8) to JPEG in a pool
+    of worker processes, releasing results in the order frames were
+    submitted.
+
+    At most max_in_flight frames are being encoded or waiting to be
+    released at once.  A frame holds one of as many shared memory
+    blocks while it is encoded.  Frames submitted with max_in_flight
+    reached are dropped, so the libuvc callback thread never waits on
+    the workers.  Each frame goes to the worker with the fewest frames
+    queued.  A worker that exits leaves the pool, and the frames it held
+    are counted as errors.
+
+    Encoded frames are passed to callback, or placed in a bounded queue
+    read with get().
+
+    Params:
+    workers        - number of worker processes, default os.cpu_count()
+    quality        - JPEG quality (1-100)
+    backend        - encoder backend name, default the first available
+    max_in_flight  - frames in flight, default 2 per worker
+    max_frame_size - size of the shared memory blocks, default the size
+                     of the first frame submitted
+    callback       - called as callback(encoded_frame) in order
+    queue_size     - size of the output queue when there is no callback
+    start_method   - multiprocessing start method.  'spawn' keeps the
+                     workers clear of libusb and libuvc threads in the
+                     parent.
+
+    Usage:
+
+    encoder = JPEGEncoder(workers=3, quality=80)
+    encoder.start()
+    dev.set_raw_callback(encoder.raw_callback)
+    dev.start_streaming()
+    jpeg = encoder.get(timeout=1.0)
+    """
+    def __init__(self, workers=None, quality=85, backend=None, max_in_flight=None,
+                 max_frame_size=None, callback=None, queue_size=16, start_method='spawn'):
+        if backend is None:
+            backends = available_backends()
+            if not backends:
+                raise ImportError("JPEGEncoder requires NumPy and one of %s" %
+                                  ', '.join(BACKENDS))
+            backend = backends[0]
+        self.backend = backend
+        self.quality = quality
+        self.num_workers = workers or os.cpu_count() or 1
+        self.max_in_flight = max_in_flight or 2 * self.num_workers
+        self.max_frame_size = max_frame_size
+        self.callback = callback
+        self.output = queue.Queue(queue_size)
+        self._mp = multiprocessing.get_context(start_method)
+        self._workers = []
+        self._exited = []
+        self._blocks = []
+        self._addresses = []
+        self._free = deque()
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._done = {}
+        self._next_index = 0
+        self._next_release = 0
+        self._collector = None
+        self._running = False
+        self._stats = {
+            'submitted': 0,
+            'completed': 0,
+            'dropped': 0,
+            'oversize': 0,
+            'errors': 0,
+            'output_dropped': 0,
+            'latency_total': 0.0,
+            'latency_max': 0.0
+        }
+
+    def start(self):
+        """
+        Starts the worker processes.
+        """
+        self._workers = []
+        self._exited = []
+        for _ in range(self.num_workers):
+            parent_conn, child_conn = self._mp.Pipe()
+            process = self._mp.Process(target=_worker_main,
+                                       args=(child_conn, self.backend, self.quality))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self._workers.append(_Worker(process, parent_conn))
+        self._running = True
+        self._collector = threading.Thread(target=self._collect, name='uvclite-encode')
+        self._collector.daemon = True
+        self._collector.start()
+
+    def _allocate(self, size):
+        for _ in range(self.max_in_flight):
+            shm = shared_memory.SharedMemory(create=True, size=size)
+            self._blocks.append(shm)
+            self._addresses.append(addressof((c_char * size).from_buffer(shm.buf)))
+        self._free.extend(range(self.max_in_flight))
+
+    def _acquire(self, size):
+        # returns a free block index, or None if the frame is dropped
+        with self._lock:
+            if not self._blocks:
+                if self.max_frame_size is None:
+                    self.max_frame_size = size
+                self._allocate(self.max_frame_size)
+            if size > self.max_frame_size:
+                self._stats['oversize'] += 1
+                return None
+            # blocks come back as soon as they are encoded, but results
+            # waiting on an earlier frame are still in flight
+            if not self._free or len(self._pending) + len(self._done) >= self.max_in_flight:
+                self._stats['dropped'] += 1
+                return None
+            return self._free.popleft()
+
+    def raw_callback(self, frame, timestamp, user=None):   # pylint: disable=unused-argument
+        """
+        A callback for UVCDevice.set_raw_callback().  Copies the frame
+        from the libuvc buffer into shared memory and submits it.
+        """
+        if not self._running:
+            return
+        size = frame.data_bytes
+        block = self._acquire(size)
+        if block is None:
+            return
+        memmove(self._addresses[block], frame.data, size)
+        step = frame.step or size // max(frame.height, 1)
+        self._dispatch(block, size, frame.frame_format, frame.width, frame.height,
+                       step, frame.sequence, timestamp)
+
+    def submit(self, frame):
+        """
+        Submits a UVCFrame.  Returns False if it was dropped.
+        """
+        if not self._running:
+            return False
+        size = len(frame.data)
+        block = self._acquire(size)
+        if block is None:
+            return False
+        self._blocks[block].buf[:size] = frame.data
+        struct = frame.frame
+        step = struct.step or size // max(frame.height, 1)
+        timestamp = frame.host_time if frame.host_time is not None else frame.arrival_time
+        return self._dispatch(block, size, struct.frame_format, frame.width, frame.height,
+                              step, frame.sequence, timestamp)
+
+    def _dispatch(self, block, size, frame_format, width, height, step, sequence, timestamp):
+        # returns False if the frame could not be sent to a worker
+        with self._lock:
+            if not self._workers:
+                self._free.append(block)
+                self._stats['dropped'] += 1
+                return False
+            index = self._next_index
+            self._next_index += 1
+            worker = min(self._workers, key=lambda w: w.queued)
+            worker.queued += 1
+            self._pending[index] = (block, worker, sequence, timestamp, width, height,
+                                    _monotonic())
+            self._stats['submitted'] += 1
+        try:
+            with worker.send_lock:
+                worker.conn.send((index, self._blocks[block].name, size, frame_format,
+                                  width, height, step))
+        except (OSError, ValueError):
+            # the worker is gone, its pipe broken or closed
+            _logger.error("Encoder worker %d exited", worker.process.pid)
+            self._fail_worker(worker)
+            return False
+        return True
+
+    def _collect(self):
+        conns = dict((w.conn, w) for w in self._workers)
+        while self._running or self._pending:
+            ready = wait(list(conns), timeout=0.2)
+            for conn in ready:
+                worker = conns[conn]
+                try:
+                    index, data, encode_time, error = conn.recv()
+                except (EOFError, OSError):
+                    _logger.error("Encoder worker %d exited", worker.process.pid)
+                    del conns[conn]
+                    self._fail_worker(worker)
+                    continue
+                self._complete(worker, index, data, encode_time, error)
+            if not conns:
+                break
+
+    def _fail_worker(self, worker):
+        # called by the collector and by a failed send, possibly both
+        with self._lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+                self._exited.append(worker)
+            lost = [i for i, p in self._pending.items() if p[1] is worker]
+        for index in lost:
+            self._complete(worker, index, None, 0.0, 'worker exited')
+
+    def _complete(self, worker, index, data, encode_time, error):
+        released = []
+        with self._lock:
+            pending = self._pending.pop(index, None)
+            if pending is None:
+                # already failed with its worker
+                return
+            block, _, sequence, timestamp, width, height, submitted = pending
+            self._free.append(block)
+            worker.queued -= 1
+            worker.completed += 1
+            worker.encode_total += encode_time
+            if encode_time > worker.encode_max:
+                worker.encode_max = encode_time
+            if error is not None:
+                worker.errors += 1
+                self._stats['errors'] += 1
+                _logger.warning("JPEG encoding failed: %s", error)
+                self._done[index] = None
+            else:
+                self._done[index] = (data, sequence, timestamp, width, height, submitted)
+            # release everything that is now in order
+            while self._next_release in self._done:
+                result = self._done.pop(self._next_release)
+                self._next_release += 1
+                if result is None:
+                    continue
+                latency = _monotonic() - result[5]
+                self._stats['completed'] += 1
+                self._stats['latency_total'] += latency
+                if latency > self._stats['latency_max']:
+                    self._stats['latency_max'] = latency
+                released.append(EncodedFrame(result[0], result[1], result[2], result[3],
+                                             result[4], latency))
+
+        for encoded in released:
+            if self.callback is not None:
+                self.callback(encoded)
+                continue
+            try:
+                self.output.put_nowait(encoded)
+            except queue.Full:
+                self._stats['output_dropped'] += 1
+
+    def get(self, timeout=None):
+        """
+        Returns the next EncodedFrame, blocking for up to timeout
+        seconds.  Raises queue.Empty if none arrives.
+        """
+        return self.output.get(timeout=timeout)
+
+    def stop(self, timeout=5.0):
+        """
+        Waits for frames in flight, stops the workers and frees the
+        shared memory.
+        """
+        self._running = False
+        if self._collector is not None:
+            self._collector.join(timeout)
+            self._collector = None
+        for worker in self._workers:
+            try:
+                with worker.send_lock:
+                    worker.conn.send(_STOP)
+            except OSError:
+                pass
+        for worker in self._workers + self._exited:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.conn.close()
+        self._exited = []
+        self._addresses = []
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
+        self._free.clear()
+
+    def get_stats(self):
+        """
+        Returns a dict of counters:
+
+        submitted      - frames sent to workers
+        completed      - frames encoded and released
+        dropped        - frames dropped with max_in_flight reached
+        oversize       - frames dropped as larger than max_frame_size
+        errors         - frames the backend failed to encode
+        output_dropped - encoded frames dropped with the output queue full
+        in_flight      - frames being encoded or waiting to be released
+        latency_avg    - average seconds from submission to release
+        latency_max    - maximum of the same
+        workers        - list of a dict per worker: pid, queued (frames
+                         sent but not finished), completed, errors,
+                         encode_avg and encode_max in seconds
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            total = stats.pop('latency_total')
+            stats['latency_avg'] = total / stats['completed'] if stats['completed'] else None
+            stats['in_flight'] = len(self._pending) + len(self._done)
+            stats['workers'] = [{
+                'pid': w.process.pid,
+                'queued': w.queued,
+                'completed': w.completed,
+                'errors': w.errors,
+                'encode_avg': w.encode_total / w.completed if w.completed else None,
+                'encode_max': w.encode_max
+            } for w in self._workers]
+        return stats
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Change gating to suppress frames of a static scene
+
+"""
+
+from ctypes import c_uint8, string_at
+import zlib
+
+from . import libuvc
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__author__ = 'Eric Callahan'
+
+_fmt = libuvc.uvc_frame_format
+
+# (bytes per pixel, offset of the luma byte) of formats with a luma plane
+LUMA_LAYOUT = {
+    _fmt.UVC_FRAME_FORMAT_GRAY8.value: (1, 0),
+    _fmt.UVC_FRAME_FORMAT_BY8.value: (1, 0),
+    _fmt.UVC_FRAME_FORMAT_YUYV.value: (2, 0),
+    _fmt.UVC_FRAME_FORMAT_UYVY.value: (2, 1)
+}
+
+# bytes hashed from each sampled chunk of a compressed frame
+_SIGNATURE_CHUNK = 64
+_SIGNATURE_CHUNKS = 16
+
+
+class ChangeGate(object):
+    """
+    Decides whether a frame differs enough from the last frame let
+    through to be worth delivering.  Works on the raw uvc_frame before
+    any copy is made, see UVCDevice.set_gate().
+
+    For GRAY8, BY8, YUYV and UYVY frames the luma of every step-th
+    pixel of every step-th row is compared against the same samples of
+    the reference frame, and the score is the mean absolute difference
+    in luma levels (0-255).  With NumPy the samples are a strided view
+    of the frame buffer, without it they are gathered row by row.
+
+    For MJPEG frames the score is the relative change of the
+    compressed size, which follows the amount of detail in the scene.
+    A CRC of sampled chunks of the frame identifies exact repeats,
+    which are suppressed regardless of size.
+
+    Frames of other formats always pass.  The reference is only
+    replaced when a frame passes, so slow changes accumulate until
+    they cross the threshold.
+
+    Params:
+    threshold      - minimum mean luma difference of raw frames
+    size_threshold - minimum relative size change of MJPEG frames
+    step           - sampling step in pixels and rows for raw frames
+    keepalive      - pass a frame at least every keepalive seconds
+                     even if the scene is static, None to disable
+
+    Usage:
+
+    gate = ChangeGate(threshold=3.0, keepalive=10.0)
+    dev.set_gate(gate)
+    """
+    def __init__(self, threshold=4.0, size_threshold=0.02, step=8, keepalive=5.0):
+        self.threshold = threshold
+        self.size_threshold = size_threshold
+        self.step = step
+        self.keepalive = keepalive
+        self.last_score = None
+        self._reference = None
+        self._reference_key = None
+        self._last_pass = None
+        self._stats = {
+            'checked': 0,
+            'passed': 0,
+            'suppressed': 0,
+            'keepalives': 0,
+            'duplicates': 0
+        }
+
+    def reset(self):
+        """
+        Drops the reference, so the next frame passes.
+        """
+        self._reference = None
+        self._reference_key = None
+
+    def check(self, frame, now):
+        """
+        Returns True if the uvc_frame struct should be delivered.
+
+        Params:
+        frame - the uvc_frame (frame_p.contents)
+        now   - host monotonic arrival time of the frame
+        """
+        self._stats['checked'] += 1
+        frame_format = frame.frame_format
+        layout = LUMA_LAYOUT.get(frame_format)
+        if layout is not None:
+            key = (frame_format, frame.width, frame.height)
+            sample = self._luma_sample(frame, layout)
+            changed = self._raw_changed(key, sample)
+        elif frame_format == _fmt.UVC_FRAME_FORMAT_MJPEG.value:
+            key = (frame_format, frame.width, frame.height)
+            sample = self._signature(frame)
+            changed = self._compressed_changed(key, sample)
+        else:
+            self._stats['passed'] += 1
+            self._last_pass = now
+            return True
+
+        if changed:
+            pass
+        elif (self.keepalive is not None and self._last_pass is not None and
+              now - self._last_pass >= self.keepalive):
+            self._stats['keepalives'] += 1
+        else:
+            self._stats['suppressed'] += 1
+            return False
+
+        self._reference = sample
+        self._reference_key = key
+        self._last_pass = now
+        self._stats['passed'] += 1
+        return True
+
+    def _raw_changed(self, key, sample):
+        if self._reference is None or key != self._reference_key:
+            self.last_score = None
+            return True
+        if numpy is not None:
+            diff = numpy.abs(sample.astype(numpy.int16) - self._reference)
+            score = float(diff.mean()) if diff.size else 0.0
+        else:
+            total = 0
+            for new, old in zip(sample, self._reference):
+                total += abs(new - old)
+            score = float(total) / len(sample) if sample else 0.0
+        self.last_score = score
+        return score >= self.threshold
+
+    def _compressed_changed(self, key, sample):
+        if self._reference is None or key != self._reference_key:
+            self.last_score = None
+            return True
+        if sample == self._reference:
+            self._stats['duplicates'] += 1
+            self.last_score = 0.0
+            return False
+        ref_size = self._reference[0]
+        score = abs(sample[0] - ref_size) / float(ref_size) if ref_size else 1.0
+        self.last_score = score
+        return score >= self.size_threshold
+
+    def _luma_sample(self, frame, layout):
+        pixel_bytes, offset = layout
+        step = self.step
+        width, height = frame.width, frame.height
+        stride = frame.step or width * pixel_bytes
+        height = min(height, frame.data_bytes // stride)
+        if numpy is not None:
+            buf = (c_uint8 * (stride * height)).from_address(frame.data)
+            rows = numpy.frombuffer(buf, dtype=numpy.uint8).reshape(height, stride)
+            # strided view, only the sampled bytes are copied
+            return rows[::step, offset:width * pixel_bytes:pixel_bytes * step].copy()
+
+        sample = bytearray()
+        row_bytes = width * pixel_bytes
+        for y in range(0, height, step):
+            row = string_at(frame.data + y * stride, row_bytes)
+            sample.extend(row[offset::pixel_bytes * step])
+        return sample
+
+    @staticmethod
+    def _signature(frame):
+        # compressed size plus a CRC of chunks spread across the frame
+        size = frame.data_bytes
+        crc = 0
+        if size:
+            spacing = max(size // _SIGNATURE_CHUNKS, _SIGNATURE_CHUNK)
+            for start in range(0, size, spacing):
+                chunk = string_at(frame.data + start, min(_SIGNATURE_CHUNK, size - start))
+                crc = zlib.crc32(chunk, crc)
+        return (size, crc & 0xffffffff)
+
+    def get_stats(self):
+        """
+        Returns a dict of counters:
+
+        checked    - frames checked
+        passed     - frames let through, including keepalives
+        suppressed - frames suppressed as unchanged
+        keepalives - unchanged frames let through by the keepalive
+        duplicates - MJPEG frames identical to the reference
+        pass_rate  - passed / checked
+        last_score - change score of the last frame compared
+        """
+        stats = dict(self._stats)
+        checked = stats['checked']
+        stats['pass_rate'] = float(stats['passed']) / checked if checked else None
+        stats['last_score'] = self.last_score
+        return stats
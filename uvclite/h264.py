@@ -0,0 +1,177 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" H.264 Annex B access unit inspection and keyframe indexing
+
+UVC frame based H.264 streams deliver one access unit per frame as an
+Annex B byte stream.  Nothing here decodes video: NAL unit headers are
+located with bytes.find and only their type is read.
+"""
+
+from bisect import bisect_right
+from collections import namedtuple
+
+__author__ = 'Eric Callahan'
+
+NAL_SLICE = 1
+NAL_IDR = 5
+NAL_SEI = 6
+NAL_SPS = 7
+NAL_PPS = 8
+NAL_AUD = 9
+
+_VCL_TYPES = frozenset(range(1, 6))
+_START_CODE = b'\x00\x00\x01'
+
+# The result of scan_access_unit().
+#   keyframe       - the access unit contains an IDR slice
+#   parameter_sets - the access unit carries both an SPS and a PPS
+#   nal_types      - types of the NAL units up to the first slice
+AccessUnit = namedtuple('AccessUnit', ['keyframe', 'parameter_sets', 'nal_types'])
+
+
+def nal_units(data, start=0):
+    """
+    Yields (nal_type, begin, end) for each NAL unit of an Annex B
+    byte stream, where data[begin:end] is the unit including its
+    header byte but not the start code.  Trailing zero bytes that
+    belong to the next start code are included in end.
+    """
+    pos = data.find(_START_CODE, start)
+    while pos >= 0:
+        begin = pos + 3
+        if begin >= len(data):
+            return
+        nxt = data.find(_START_CODE, begin)
+        end = len(data) if nxt < 0 else nxt
+        yield data[begin] & 0x1f, begin, end
+        pos = nxt
+
+
+def scan_access_unit(data):
+    """
+    Returns the AccessUnit describing a frame.  The scan stops at the
+    first slice, so only the headers of the frame are searched.
+    """
+    types = []
+    for nal_type, _, _ in nal_units(data):
+        types.append(nal_type)
+        if nal_type in _VCL_TYPES:
+            break
+    return AccessUnit(NAL_IDR in types, NAL_SPS in types and NAL_PPS in types,
+                      tuple(types))
+
+
+def is_keyframe(data):
+    """
+    True if the frame contains an IDR slice.
+    """
+    return scan_access_unit(data).keyframe
+
+
+class KeyframeIndex(object):
+    """
+    Records the position of each keyframe of a stream, so recorders
+    can seek to, and streamers start at, an IDR frame.  The most
+    recent SPS and PPS are also kept so they can be sent ahead of an
+    IDR frame that does not carry them.
+
+    Positions are any increasing number chosen by the caller, such as
+    the byte offset in a recording or the frame sequence number.
+
+    Usage:
+
+    index = KeyframeIndex()
+    for frame in frames:
+        unit = index.add(offset, frame.host_time, frame.data)
+        ...
+    offset, timestamp = index.seek_time(t)
+    """
+    def __init__(self):
+        self.positions = []
+        self.timestamps = []
+        self.sps = None
+        self.pps = None
+        self.frames = 0
+
+    def add(self, position, timestamp, data):
+        """
+        Inspects a frame and records it if it is a keyframe.  Returns
+        its AccessUnit.
+        """
+        self.frames += 1
+        types = []
+        for nal_type, begin, end in nal_units(data):
+            types.append(nal_type)
+            if nal_type == NAL_SPS:
+                self.sps = bytes(data[begin:end]).rstrip(b'\x00')
+            elif nal_type == NAL_PPS:
+                self.pps = bytes(data[begin:end]).rstrip(b'\x00')
+            elif nal_type in _VCL_TYPES:
+                break
+        unit = AccessUnit(NAL_IDR in types, NAL_SPS in types and NAL_PPS in types,
+                          tuple(types))
+        if unit.keyframe:
+            self.positions.append(position)
+            self.timestamps.append(timestamp)
+        return unit
+
+    def __len__(self):
+        return len(self.positions)
+
+    def seek(self, position):
+        """
+        Returns (position, timestamp) of the last keyframe at or before
+        position, or None.
+        """
+        index = bisect_right(self.positions, position)
+        if not index:
+            return None
+        return self.positions[index - 1], self.timestamps[index - 1]
+
+    def seek_time(self, timestamp):
+        """
+        Returns (position, timestamp) of the last keyframe at or before
+        timestamp, or None.
+        """
+        index = bisect_right(self.timestamps, timestamp)
+        if not index:
+            return None
+        return self.positions[index - 1], self.timestamps[index - 1]
+
+    def parameter_sets(self):
+        """
+        Returns the latest SPS and PPS as Annex B bytes, or None if
+        either has not been seen.
+        """
+        if self.sps is None or self.pps is None:
+            return None
+        return b'\x00\x00\x00\x01' + self.sps + b'\x00\x00\x00\x01' + self.pps
+
+    def start_data(self, data, unit=None):
+        """
+        Returns the bytes to send when starting a stream at the given
+        keyframe: the frame itself, preceded by the cached parameter
+        sets if it does not carry its own.
+        """
+        if unit is None:
+            unit = scan_access_unit(data)
+        if unit.parameter_sets:
+            return bytes(data)
+        params = self.parameter_sets()
+        if params is None:
+            return bytes(data)
+        return params + bytes(data)
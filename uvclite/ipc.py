@@ -0,0 +1,556 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Frame publishing to other processes through shared memory
+
+The process that owns a UVCDevice runs a FramePublisher, which copies
+each frame into the next slot of a ring in named shared memory and
+announces it to every connected FrameSubscriber over a Unix domain
+socket.  Subscribers read the slot in place.  Each announcement is a
+few dozen bytes, so the cost of a frame grows very little with the
+number of subscribers.
+
+Every slot carries a counter that is odd while the publisher writes
+it.  An announcement includes the counter value of the finished write,
+so a subscriber can tell whether the slot has been rewritten since,
+which happens when it falls more than the ring length behind.
+
+Usage, in the owning process:
+
+    publisher = FramePublisher('front', slot_size=dev_max_frame_size)
+    publisher.start()
+    dev.set_raw_callback(publisher.raw_callback)
+
+and in any other process:
+
+    subscriber = FrameSubscriber('front')
+    frame = subscriber.get(timeout=1.0)
+    data = frame.copy()
+"""
+
+from ctypes import addressof, c_char, memmove
+import errno
+import logging
+import mmap
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+
+from multiprocessing import shared_memory
+
+from . import UVCError
+from .clock import monotonic as _monotonic
+
+__author__ = 'Eric Callahan'
+
+_logger = logging.getLogger(__name__)
+
+MAGIC = b'UVCR'
+VERSION = 1
+
+# magic, version, slots, slot_size, generation, published
+_HEADER = struct.Struct('<4sIIIQQ')
+_HEADER_SIZE = 64
+# counter, size, sequence, width, height, frame_format, timestamp
+_SLOT = struct.Struct('<QIIIIId')
+_SLOT_STRIDE = 64
+_COUNTER = struct.Struct('<Q')
+
+# where POSIX shared memory lives on Linux
+_SHM_DIR = '/dev/shm'
+
+_MSG_HELLO = 1
+_MSG_FRAME = 2
+# type, slots, slot_size, generation, followed by the shared memory name
+_HELLO = struct.Struct('<B3xIIQ')
+# type, slot, size, sequence, counter, index, timestamp
+_FRAME = struct.Struct('<B3xIIIQQd')
+
+
+class Overrun(UVCError):
+    """
+    Raised when a shared frame was overwritten while it was read.
+    """
+    def __init__(self, strerror="Frame overwritten by the publisher"):
+        UVCError.__init__(self, strerror, errno.EAGAIN)
+
+
+def default_socket_path(name):
+    """
+    Returns the socket path used for a publisher name.
+    """
+    return os.path.join(tempfile.gettempdir(), 'uvclite-%s.sock' % name)
+
+
+def _align(size):
+    return (size + 63) & ~63
+
+
+class _Attached(object):
+    # another process' shared memory, mapped without a SharedMemory.
+    # Attaching with SharedMemory registers the memory with the resource
+    # tracker before Python 3.13, and the tracker is often shared with
+    # the publisher (a multiprocessing parent or child), so neither
+    # keeping nor undoing that registration is safe.
+    def __init__(self, name):
+        fd = os.open(os.path.join(_SHM_DIR, name.lstrip('/')), os.O_RDWR)
+        try:
+            self._mmap = mmap.mmap(fd, os.fstat(fd).st_size)
+        finally:
+            os.close(fd)
+        self.buf = memoryview(self._mmap)
+
+    def close(self):
+        # raises BufferError while frames hold views of the memory
+        self.buf.release()
+        self._mmap.close()
+
+
+class FramePublisher(object):
+    """
+    Publishes frames to FrameSubscribers on the same host.
+
+    Params:
+    name        - name subscribers connect with, also names the
+                  shared memory
+    slot_size   - bytes per frame slot, normally the stream's
+                  dwMaxVideoFrameSize.  Larger frames are truncated.
+    slots       - length of the ring
+    socket_path - Unix socket path, see default_socket_path()
+    """
+    def __init__(self, name, slot_size, slots=8, socket_path=None):
+        self.name = name
+        self.shm_name = 'uvclite-%s' % name
+        self.slots = slots
+        self.slot_size = slot_size
+        self.socket_path = socket_path or default_socket_path(name)
+        self._stride = _align(slot_size)
+        self._data_offset = _align(_HEADER_SIZE + slots * _SLOT_STRIDE)
+        self._shm = None
+        self._buffer = None
+        self._address = None
+        self._listener = None
+        self._thread = None
+        self._running = False
+        self._clients = []
+        self._lock = threading.Lock()
+        self._published = 0
+        self.generation = None
+        self._stats = {
+            'published': 0,
+            'truncated': 0,
+            'notify_dropped': 0,
+            'connects': 0
+        }
+
+    def start(self):
+        """
+        Creates the shared memory ring and starts accepting subscribers.
+        """
+        size = self._data_offset + self.slots * self._stride
+        try:
+            self._shm = shared_memory.SharedMemory(self.shm_name, create=True, size=size)
+        except FileExistsError:
+            # left behind by a publisher that did not shut down
+            os.unlink(os.path.join(_SHM_DIR, self.shm_name))
+            self._shm = shared_memory.SharedMemory(self.shm_name, create=True, size=size)
+        buf = self._shm.buf
+        self._buffer = (c_char * size).from_buffer(buf)
+        self._address = addressof(self._buffer)
+        self.generation = struct.unpack('<Q', os.urandom(8))[0]
+        _HEADER.pack_into(buf, 0, MAGIC, VERSION, self.slots, self.slot_size,
+                          self.generation, 0)
+
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        self._listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._listener.bind(self.socket_path)
+        self._listener.listen(16)
+        self._listener.settimeout(0.5)
+        self._running = True
+        self._thread = threading.Thread(target=self._accept_loop,
+                                        name='uvclite-publish-%s' % self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept_loop(self):
+        hello = _HELLO.pack(_MSG_HELLO, self.slots, self.slot_size,
+                            self.generation) + self.shm_name.encode('utf8')
+        while self._running:
+            try:
+                client, _ = self._listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                client.sendall(hello)
+            except OSError:
+                client.close()
+                continue
+            client.setblocking(False)
+            with self._lock:
+                self._clients.append(client)
+                self._stats['connects'] += 1
+
+    @property
+    def subscribers(self):
+        return len(self._clients)
+
+    def raw_callback(self, frame, timestamp, user=None):   # pylint: disable=unused-argument
+        """
+        A callback for UVCDevice.set_raw_callback(), which copies the
+        frame straight from the libuvc buffer into the ring.
+        """
+        size = frame.data_bytes
+        if size > self.slot_size:
+            size = self.slot_size
+            self._stats['truncated'] += 1
+        with self._lock:
+            slot = self._begin()
+            memmove(self._address + self._data_offset + slot * self._stride,
+                    frame.data, size)
+            self._finish(slot, size, frame.sequence, frame.width, frame.height,
+                         frame.frame_format, timestamp)
+
+    def publish(self, frame):
+        """
+        Publishes a UVCFrame.
+        """
+        data = frame.data
+        size = len(data)
+        if size > self.slot_size:
+            size = self.slot_size
+            self._stats['truncated'] += 1
+        timestamp = frame.host_time if frame.host_time is not None else 0.0
+        struct_ = frame.frame
+        with self._lock:
+            slot = self._begin()
+            start = self._data_offset + slot * self._stride
+            self._shm.buf[start:start + size] = memoryview(data)[:size]
+            self._finish(slot, size, frame.sequence, frame.width, frame.height,
+                         struct_.frame_format, timestamp)
+
+    def _begin(self):
+        # mark the next slot as being written
+        slot = self._published % self.slots
+        offset = _HEADER_SIZE + slot * _SLOT_STRIDE
+        counter = _COUNTER.unpack_from(self._shm.buf, offset)[0]
+        _COUNTER.pack_into(self._shm.buf, offset, counter + 1)
+        return slot
+
+    def _finish(self, slot, size, sequence, width, height, frame_format, timestamp):
+        buf = self._shm.buf
+        offset = _HEADER_SIZE + slot * _SLOT_STRIDE
+        counter = _COUNTER.unpack_from(buf, offset)[0] + 1
+        _SLOT.pack_into(buf, offset, counter, size, sequence, width, height,
+                        frame_format, timestamp)
+        index = self._published
+        self._published += 1
+        struct.pack_into('<Q', buf, _HEADER.size - 8, self._published)
+        self._stats['published'] += 1
+
+        message = _FRAME.pack(_MSG_FRAME, slot, size, sequence, counter, index, timestamp)
+        for client in list(self._clients):
+            try:
+                client.send(message)
+            except (BlockingIOError, socket.timeout):
+                # the subscriber is behind, it sees the gap in index
+                self._stats['notify_dropped'] += 1
+            except OSError:
+                client.close()
+                self._clients.remove(client)
+
+    def close(self):
+        """
+        Disconnects subscribers and removes the ring and the socket.
+        """
+        self._running = False
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            for client in self._clients:
+                client.close()
+            self._clients = []
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        if self._shm is not None:
+            self._buffer = None
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_stats(self):
+        """
+        Returns a dict of counters: frames published and truncated,
+        announcements dropped because a subscriber was behind,
+        subscriber connects and the current number of subscribers.
+        """
+        stats = dict(self._stats)
+        stats['subscribers'] = len(self._clients)
+        return stats
+
+
+class SharedFrame(object):
+    """
+    A frame in a publisher's ring.
+
+    data      - memoryview of the frame bytes in shared memory, no copy
+                is made.  The publisher overwrites it once it wraps
+                around the ring, check valid() after using it, or use
+                copy().
+    size, sequence, width, height, frame_format - as in UVCFrame
+    timestamp - the publisher's host_time of the frame
+    index     - position of the frame in the publisher's stream
+    """
+    def __init__(self, subscriber, slot, counter, index, size, sequence, timestamp):
+        shm = subscriber._shm  # pylint: disable=protected-access
+        self._buf = shm.buf
+        self._counter_offset = _HEADER_SIZE + slot * _SLOT_STRIDE
+        self._counter = counter
+        (_, _, _, self.width, self.height, self.frame_format,
+         _) = _SLOT.unpack_from(self._buf, self._counter_offset)
+        start = subscriber._data_offset + slot * subscriber._stride  # pylint: disable=protected-access
+        self.slot = slot
+        self.index = index
+        self.size = size
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.data = self._buf[start:start + size]
+
+    def valid(self):
+        """
+        True if the slot still holds this frame.
+        """
+        return _COUNTER.unpack_from(self._buf, self._counter_offset)[0] == self._counter
+
+    def copy(self):
+        """
+        Returns the frame bytes, raising Overrun if the publisher
+        overwrote them during the copy.
+        """
+        data = bytes(self.data)
+        if not self.valid():
+            raise Overrun()
+        return data
+
+    def release(self):
+        """
+        Drops the views of shared memory, so the subscriber can detach
+        from it.
+        """
+        self.data = None
+        self._buf = None
+
+
+class FrameSubscriber(object):
+    """
+    Receives frames from a FramePublisher.  If the publisher goes away
+    the subscriber reconnects, and attaches to the new ring when the
+    publisher is restarted.
+
+    Params:
+    name           - the publisher's name
+    socket_path    - the publisher's socket path
+    retry_interval - seconds between reconnection attempts
+    """
+    def __init__(self, name, socket_path=None, retry_interval=0.5):
+        self.name = name
+        self.socket_path = socket_path or default_socket_path(name)
+        self.retry_interval = retry_interval
+        self._sock = None
+        self._shm = None
+        self._generation = None
+        self._last_index = None
+        self._data_offset = None
+        self._stride = None
+        self._stats = {
+            'received': 0,
+            'overruns': 0,
+            'missed': 0,
+            'skipped': 0,
+            'attaches': 0,
+            'disconnects': 0
+        }
+
+    @property
+    def connected(self):
+        return self._sock is not None
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            sock.connect(self.socket_path)
+            message = sock.recv(4096)
+        except OSError:
+            sock.close()
+            return False
+        if len(message) < _HELLO.size or message[0] != _MSG_HELLO:
+            sock.close()
+            return False
+        _, slots, slot_size, generation = _HELLO.unpack_from(message)
+        if generation != self._generation:
+            self._detach()
+            self._shm = _Attached(message[_HELLO.size:].decode('utf8'))
+            self._data_offset = _align(_HEADER_SIZE + slots * _SLOT_STRIDE)
+            self._stride = _align(slot_size)
+            self._generation = generation
+            self._last_index = None
+            self._stats['attaches'] += 1
+        self._sock = sock
+        return True
+
+    def _detach(self):
+        if self._shm is not None:
+            try:
+                self._shm.close()
+            except BufferError:
+                # frames still hold views, the mapping goes with them
+                pass
+            self._shm = None
+
+    def _disconnect(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            self._stats['disconnects'] += 1
+
+    def get(self, timeout=None):
+        """
+        Returns the next SharedFrame, or None if none arrives within
+        timeout seconds.  Frames overwritten before they could be read
+        are skipped and counted as overruns.
+        """
+        deadline = None if timeout is None else _monotonic() + timeout
+        while True:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - _monotonic()
+                if remaining <= 0:
+                    return None
+            if self._sock is None:
+                if not self._connect():
+                    wait = self.retry_interval
+                    if remaining is not None:
+                        wait = min(wait, remaining)
+                    time.sleep(wait)
+                    continue
+            self._sock.settimeout(remaining)
+            try:
+                message = self._sock.recv(256)
+            except socket.timeout:
+                return None
+            except OSError:
+                message = b''
+            if not message:
+                # the publisher closed, wait for it to come back
+                self._disconnect()
+                continue
+            frame = self._frame(message)
+            if frame is not None:
+                return frame
+
+    def latest(self):
+        """
+        Returns the newest frame announced so far without blocking,
+        skipping older ones, or None if there is none.
+        """
+        if self._sock is None and not self._connect():
+            return None
+        first = newest = previous = None
+        self._sock.setblocking(False)
+        try:
+            while True:
+                try:
+                    message = self._sock.recv(256)
+                except (BlockingIOError, socket.timeout):
+                    break
+                except OSError:
+                    message = b''
+                if not message:
+                    self._disconnect()
+                    break
+                if first is None:
+                    first = message
+                previous, newest = newest, message
+        finally:
+            if self._sock is not None:
+                self._sock.setblocking(True)
+        if newest is None:
+            return None
+        if previous is not None and previous[0] == _MSG_FRAME:
+            # frames passed over are skipped, not missed
+            index = _FRAME.unpack_from(previous)[5]
+            if self._last_index is None:
+                start = _FRAME.unpack_from(first)[5]
+            else:
+                start = self._last_index + 1
+            self._stats['skipped'] += index - start + 1
+            self._last_index = index
+        return self._frame(newest)
+
+    def _frame(self, message):
+        if message[0] != _MSG_FRAME:
+            return None
+        _, slot, size, sequence, counter, index, timestamp = _FRAME.unpack_from(message)
+        if self._last_index is not None and index > self._last_index + 1:
+            self._stats['missed'] += index - self._last_index - 1
+        self._last_index = index
+        frame = SharedFrame(self, slot, counter, index, size, sequence, timestamp)
+        if not frame.valid():
+            self._stats['overruns'] += 1
+            frame.release()
+            return None
+        self._stats['received'] += 1
+        return frame
+
+    def close(self):
+        self._disconnect()
+        self._detach()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_stats(self):
+        """
+        Returns a dict of counters:
+
+        received    - frames returned
+        overruns    - frames overwritten before they were read
+        missed      - announcements the publisher could not deliver
+        skipped     - frames passed over by latest()
+        attaches    - times a ring was attached, more than one means the
+                      publisher restarted
+        disconnects - times the publisher went away
+        """
+        return dict(self._stats)
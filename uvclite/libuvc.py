@@ -18,6 +18,7 @@
 # pylint: disable=W0511,W0622,W0613,W0603,R0902,C0103,W0614,W0401,W0212,R0903,C0111
 
 from ctypes import *
+from ctypes.util import find_library
 import errno
 from enum import Enum
 
@@ -58,9 +59,7 @@ __all__ = [
     'uvc_print_diag'
 ]
 
-# TODO: create function for more robust library loading, that should hopefully
-# work on all platforms
-_libuvc = CDLL('libuvc.so')
+_libuvc = CDLL(find_library('uvc') or 'libuvc.so')
 
 def buffer_at(address, length):
     """
@@ -218,6 +217,19 @@ uvc_format_desc._fields_ = [('parent', c_void_p),
                             ('bVariableSize', c_uint8),
                             ('frame_descs', uvc_frame_desc_p)]
 
+# struct uvc_streaming_interface, the parent of each uvc_format_desc
+class uvc_streaming_interface(Structure):
+    pass
+
+uvc_streaming_interface_p = POINTER(uvc_streaming_interface)
+uvc_streaming_interface._fields_ = [('parent', c_void_p),
+                                    ('prev', uvc_streaming_interface_p),
+                                    ('next', uvc_streaming_interface_p),
+                                    ('bInterfaceNumber', c_uint8),
+                                    ('format_descs', uvc_format_desc_p),
+                                    ('bEndpointAddress', c_uint8),
+                                    ('bTerminalLink', c_uint8)]
+
 # enum_uvc_req_code
 class uvc_req_code(Enum):
     UVC_RC_UNDEFINED = 0x00
@@ -0,0 +1,228 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Structural validation of MJPEG frames without decoding
+
+"""
+
+from ctypes import string_at
+import struct
+
+from . import libuvc
+
+__author__ = 'Eric Callahan'
+
+SOI = b'\xff\xd8'
+EOI = b'\xff\xd9'
+
+# reasons returned by validate()
+NO_SOI = 'no_soi'
+NO_EOI = 'no_eoi'
+BAD_SEGMENT = 'bad_segment'
+NO_SOF = 'no_sof'
+NO_SOS = 'no_sos'
+DIMENSIONS = 'dimensions'
+TRUNCATED = 'truncated'
+
+REASONS = (NO_SOI, NO_EOI, BAD_SEGMENT, NO_SOF, NO_SOS, DIMENSIONS, TRUNCATED)
+
+_SOS = 0xda
+_EOI = 0xd9
+# SOF0-SOF15, less DHT (c4), JPG (c8) and DAC (cc)
+_SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - frozenset((0xc4, 0xc8, 0xcc))
+# markers without a length: TEM and RST0-RST7
+_STANDALONE = frozenset([0x01] + list(range(0xd0, 0xd8)))
+
+_unpack_length = struct.Struct('>H').unpack_from
+_unpack_sof = struct.Struct('>BHH').unpack_from
+
+_MJPEG = libuvc.uvc_frame_format.UVC_FRAME_FORMAT_MJPEG.value
+
+
+def validate(data, width=None, height=None, size=None):
+    """
+    Checks the structure of a JPEG image without decoding it.
+    Returns None if it looks complete, or one of the REASONS.
+
+    The header segments up to the start of scan are walked and their
+    lengths checked, the frame header is compared against width and
+    height when given, and the image must end with an EOI marker after
+    the scan.  Zero padding after the EOI is allowed.
+
+    Params:
+    data   - bytes or bytearray, either the whole image or, when size
+             is given, a prefix of an image of size bytes.  A prefix
+             must include the headers; TRUNCATED is returned if the
+             walk runs past its end.
+    width  - expected width in pixels, or None
+    height - expected height in pixels, or None
+    """
+    length = len(data)
+    if size is None:
+        size = length
+    if data[:2] != SOI:
+        return NO_SOI
+
+    pos = 2
+    sof = None
+    while True:
+        if pos + 4 > length:
+            return TRUNCATED if length < size else BAD_SEGMENT
+        if data[pos] != 0xff:
+            return BAD_SEGMENT
+        marker = data[pos + 1]
+        if marker == 0xff:
+            # fill byte
+            pos += 1
+            continue
+        if marker in _STANDALONE:
+            pos += 2
+            continue
+        if marker == _EOI:
+            return NO_SOS
+        seg_len = _unpack_length(data, pos + 2)[0]
+        if seg_len < 2:
+            return BAD_SEGMENT
+        end = pos + 2 + seg_len
+        if end > size:
+            return BAD_SEGMENT
+        if marker in _SOF_MARKERS:
+            if seg_len < 8:
+                return BAD_SEGMENT
+            if pos + 9 > length:
+                return TRUNCATED
+            sof = _unpack_sof(data, pos + 4)
+        elif marker == _SOS:
+            if sof is None:
+                return NO_SOF
+            scan_start = end
+            break
+        pos = end
+
+    if ((width is not None and sof[2] != width) or
+            (height is not None and sof[1] and sof[1] != height)):
+        return DIMENSIONS
+    if size > length:
+        return None
+    eoi = data.rfind(EOI, scan_start)
+    if eoi < 0:
+        return NO_EOI
+    tail = eoi + 2
+    if tail < size and data.count(b'\x00', tail) != size - tail:
+        # data after the EOI is not padding, the EOI was scan data
+        return NO_EOI
+    return None
+
+
+class MJPEGValidator(object):
+    """
+    Validates MJPEG frames with validate() and counts the results.
+    Attach it to a device with UVCDevice.set_validator() to drop or
+    flag bad frames in the capture path, or call check_bytes() on
+    frame data directly.
+
+    When checking a raw uvc_frame only the first header_size and the
+    last tail_size bytes are read from the libuvc buffer, so a frame
+    is not copied whole unless its headers are larger than
+    header_size or its padding longer than tail_size.
+
+    Params:
+    check_dimensions - compare the frame header against the frame's
+                       width and height
+    header_size      - bytes read for the header walk
+    tail_size        - bytes searched for the EOI marker
+
+    Usage:
+
+    validator = MJPEGValidator()
+    dev.set_validator(validator)
+    ...
+    print(validator.get_stats())
+    """
+    def __init__(self, check_dimensions=True, header_size=2048, tail_size=512):
+        self.check_dimensions = check_dimensions
+        self.header_size = header_size
+        self.tail_size = tail_size
+        self.last_reason = None
+        self._stats = {
+            'checked': 0,
+            'valid': 0,
+            'invalid': 0
+        }
+        self._reasons = dict((reason, 0) for reason in REASONS)
+
+    def _count(self, reason):
+        self._stats['checked'] += 1
+        self.last_reason = reason
+        if reason is None:
+            self._stats['valid'] += 1
+            return True
+        self._stats['invalid'] += 1
+        self._reasons[reason] += 1
+        return False
+
+    def check_bytes(self, data, width=None, height=None):
+        """
+        Validates a complete image, for example UVCFrame.data.
+        Returns True if it is valid.
+        """
+        if not self.check_dimensions:
+            width = height = None
+        return self._count(validate(data, width, height))
+
+    def check(self, frame, now=None):     # pylint: disable=unused-argument
+        """
+        Validates a uvc_frame struct in place.  Frames in other formats
+        are not counted and always valid.  Returns True if valid.
+        """
+        if frame.frame_format != _MJPEG:
+            return True
+        size = frame.data_bytes
+        if not frame.data or size < 4:
+            return self._count(TRUNCATED if size else NO_SOI)
+        if self.check_dimensions:
+            width, height = frame.width, frame.height
+        else:
+            width = height = None
+
+        if size <= self.header_size + self.tail_size:
+            return self._count(validate(string_at(frame.data, size), width, height))
+
+        head = string_at(frame.data, self.header_size)
+        reason = validate(head, width, height, size)
+        if reason == TRUNCATED:
+            # unusually large headers, such as an embedded thumbnail
+            return self._count(validate(string_at(frame.data, size), width, height))
+        if reason is None:
+            tail = string_at(frame.data + size - self.tail_size, self.tail_size)
+            eoi = tail.rfind(EOI)
+            if eoi < 0 or tail.count(b'\x00', eoi + 2) != len(tail) - eoi - 2:
+                # maybe a long padding run, check the whole frame
+                reason = validate(string_at(frame.data, size), width, height)
+        return self._count(reason)
+
+    def get_stats(self):
+        """
+        Returns a dict of counters:
+
+        checked - frames validated
+        valid   - frames that passed
+        invalid - frames that failed
+        reasons - dict of failures by reason
+        """
+        stats = dict(self._stats)
+        stats['reasons'] = dict(self._reasons)
+        return stats
@@ -0,0 +1,328 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" A multi-stage frame processing pipeline fed by a UVCDevice
+
+"""
+
+import logging
+import queue
+import threading
+import time
+
+from . import UVCError
+from .clock import monotonic as _monotonic
+
+__author__ = 'Eric Callahan'
+
+_logger = logging.getLogger(__name__)
+
+# marks an item that produced no output, so ordered stages can move past it
+_SKIP = object()
+
+
+class _Item(object):
+    __slots__ = ('seq', 'entered', 'payload')
+
+    def __init__(self, seq, entered, payload):
+        self.seq = seq
+        self.entered = entered
+        self.payload = payload
+
+
+class Stage(object):
+    """
+    A pipeline stage.  Items are taken from the stage's bounded input
+    queue by a pool of worker threads, passed to func, and the return
+    value is handed to the next stage.  If func returns None the item
+    is filtered out.  If func raises, the error is logged and counted
+    and the item is dropped.
+
+    When ordered is True results leave the stage in the order items
+    entered it, regardless of which worker finished first.  Since the
+    capture source feeds frames in sequence order, a pipeline whose
+    stages are all ordered delivers results in frame sequence order.
+
+    Workers block when the next stage's queue is full, so a slow stage
+    pushes back on the stages before it.  Only the capture source drops
+    frames, see Pipeline.
+
+    Stages are created with Pipeline.add_stage().
+    """
+    def __init__(self, name, func, workers=1, queue_size=8, ordered=True):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.ordered = ordered
+        self.input = queue.Queue(queue_size)
+        self.next_stage = None
+
+        self._threads = []
+        self._stopping = False
+        self._get_lock = threading.Lock()
+        self._out_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._next_in = 0
+        self._next_out = 0
+        self._pending = {}
+        self._started = None
+        self._stats = {
+            'processed': 0,
+            'filtered': 0,
+            'errors': 0,
+            'busy_time': 0.0,
+            'latency_max': 0.0,
+            'wait_time': 0.0
+        }
+
+    def start(self):
+        """
+        Starts the worker threads.
+        """
+        self._stopping = False
+        self._started = _monotonic()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run,
+                                      name='uvclite-%s-%d' % (self.name, i))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        """
+        Waits for queued items to be processed, then stops the workers.
+        """
+        self._stopping = True
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _get(self):
+        # items are numbered as they are taken so results can be
+        # released in input order
+        with self._get_lock:
+            while True:
+                try:
+                    item = self.input.get(timeout=0.1)
+                except queue.Empty:
+                    if self._stopping:
+                        return None, None
+                    continue
+                index = self._next_in
+                self._next_in += 1
+                return index, item
+
+    def _run(self):
+        stats = self._stats
+        while True:
+            index, item = self._get()
+            if item is None:
+                return
+
+            start = _monotonic()
+            failed = False
+            try:
+                result = self.func(item.payload)
+            except Exception:     # pylint: disable=broad-except
+                _logger.exception("Stage %s failed on item %d", self.name, item.seq)
+                failed = True
+                result = None
+            elapsed = _monotonic() - start
+
+            with self._stats_lock:
+                stats['busy_time'] += elapsed
+                stats['wait_time'] += start - item.entered
+                if elapsed > stats['latency_max']:
+                    stats['latency_max'] = elapsed
+                if failed:
+                    stats['errors'] += 1
+                elif result is None:
+                    stats['filtered'] += 1
+                else:
+                    stats['processed'] += 1
+
+            if result is None:
+                out = _SKIP
+            else:
+                item.payload = result
+                out = item
+
+            if self.ordered:
+                with self._out_lock:
+                    self._pending[index] = out
+                    while self._next_out in self._pending:
+                        ready = self._pending.pop(self._next_out)
+                        self._next_out += 1
+                        if ready is not _SKIP:
+                            self._forward(ready)
+            elif out is not _SKIP:
+                self._forward(out)
+
+    def _forward(self, item):
+        if self.next_stage is not None:
+            item.entered = _monotonic()
+            self.next_stage.input.put(item)
+
+    def get_stats(self):
+        """
+        Returns a dict of counters for the stage:
+
+        processed    - items passed on to the next stage
+        filtered     - items for which func returned None
+        errors       - items for which func raised an exception
+        throughput   - items processed per second since start
+        latency_avg  - average time spent in func (seconds)
+        latency_max  - maximum time spent in func (seconds)
+        wait_avg     - average time spent in the input queue (seconds)
+        queue_depth  - items currently waiting in the input queue
+        utilization  - fraction of worker time spent in func
+        """
+        stats = dict(self._stats)
+        done = stats['processed'] + stats['filtered'] + stats['errors']
+        elapsed = _monotonic() - self._started if self._started else 0.0
+        stats['throughput'] = stats['processed'] / elapsed if elapsed else 0.0
+        stats['latency_avg'] = stats['busy_time'] / done if done else 0.0
+        stats['wait_avg'] = stats['wait_time'] / done if done else 0.0
+        stats['queue_depth'] = self.input.qsize()
+        stats['utilization'] = (stats['busy_time'] / (elapsed * self.workers)
+                                if elapsed else 0.0)
+        del stats['busy_time']
+        del stats['wait_time']
+        return stats
+
+
+class Pipeline(object):
+    """
+    Chains processing stages after a UVCDevice.  The capture source
+    never blocks: frames that do not fit in the first stage's queue
+    are dropped and counted, so capture stays real-time while the
+    stages behind it are scaled with their own worker pools.
+
+    If the device is in polling mode, start() runs a capture thread
+    that calls get_frame().  In callback mode pass frames to feed()
+    from the frame callback instead.
+
+    Usage:
+
+    pipeline = Pipeline(device)
+    pipeline.add_stage('decode', decode_jpeg, workers=4)
+    pipeline.add_stage('analyze', detect, workers=2)
+    pipeline.add_stage('publish', publish, ordered=True)
+    device.start_streaming()
+    pipeline.start()
+    ...
+    pipeline.stop()
+    """
+    def __init__(self, device=None, frame_timeout=100000):
+        self._device = device
+        self.frame_timeout = frame_timeout
+        self.stages = []
+        self._seq = 0
+        self._running = False
+        self._capture_thread = None
+        self._stats = {
+            'captured': 0,
+            'dropped': 0,
+            'capture_errors': 0
+        }
+
+    def add_stage(self, name, func, workers=1, queue_size=8, ordered=True):
+        """
+        Appends a stage to the pipeline and returns it.
+
+        Params:
+        name       - stage name used in stats and thread names
+        func       - callable taking the previous stage's output (a
+                     UVCFrame for the first stage) and returning the
+                     output for the next stage, or None to filter
+        workers    - number of worker threads
+        queue_size - size of the stage's input queue
+        ordered    - release results in input order
+        """
+        stage = Stage(name, func, workers, queue_size, ordered)
+        if self.stages:
+            self.stages[-1].next_stage = stage
+        self.stages.append(stage)
+        return stage
+
+    def feed(self, frame):
+        """
+        Offers a frame to the first stage without blocking.  Returns
+        False if the frame was dropped.
+        """
+        if not self.stages:
+            return False
+        item = _Item(self._seq, _monotonic(), frame)
+        try:
+            self.stages[0].input.put_nowait(item)
+        except queue.Full:
+            self._stats['dropped'] += 1
+            return False
+        self._seq += 1
+        self._stats['captured'] += 1
+        return True
+
+    def start(self):
+        """
+        Starts every stage, and the capture thread if the device is
+        in polling mode.
+        """
+        if self._running:
+            return
+        self._running = True
+        for stage in self.stages:
+            stage.start()
+        if self._device is not None and self._device.is_polling:
+            self._capture_thread = threading.Thread(target=self._capture,
+                                                    name='uvclite-capture')
+            self._capture_thread.daemon = True
+            self._capture_thread.start()
+
+    def stop(self):
+        """
+        Stops capturing, then stops each stage in turn once it has
+        drained its queue.
+        """
+        self._running = False
+        if self._capture_thread is not None:
+            self._capture_thread.join()
+            self._capture_thread = None
+        for stage in self.stages:
+            stage.stop()
+
+    def _capture(self):
+        device = self._device
+        while self._running:
+            if not device.is_streaming:
+                time.sleep(self.frame_timeout / 1000000.0)
+                continue
+            try:
+                frame = device.get_frame(self.frame_timeout)
+            except UVCError:
+                # timeouts and null frames while the camera settles
+                self._stats['capture_errors'] += 1
+                continue
+            self.feed(frame)
+
+    def get_stats(self):
+        """
+        Returns a dict with the capture counters under 'source' and
+        the stats of each stage under its name.
+        """
+        stats = {'source': dict(self._stats)}
+        for stage in self.stages:
+            stats[stage.name] = stage.get_stats()
+        return stats
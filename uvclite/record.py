@@ -0,0 +1,450 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Lossless recording of raw frames as keyframes and block deltas
+
+Consecutive frames of a raw stream are mostly identical, so a recording
+stores a complete keyframe every keyframe_interval frames and, between
+them, only the blocks that changed since the previous frame.  Each
+delta record holds a bitmap with one bit per block_size bytes of the
+frame, followed by the changed blocks XORed with the previous frame.
+Unchanged blocks cost one bit.  Records may also be zlib compressed,
+which pays off on noisy sensors where few blocks are fully unchanged
+but the XOR is mostly small values.
+
+File layout, little endian:
+
+    header   magic 'UVCRAW1\\0', block size (u32), keyframe interval (u32)
+    records  kind (u8), flags (u8), frame format (u16), width, height,
+             sequence, frame size, payload size (u32 each), timestamp
+             (f64), then the payload
+    index    one entry per keyframe: frame number (u32), offset (u64),
+             timestamp (f64)
+    trailer  index offset (u64), keyframes (u32), frames (u32),
+             magic 'UVCRIDX\\0'
+
+A recording that was not closed has no index, RawReader rebuilds it by
+walking the record headers.  Reading a frame decodes forward from the
+nearest keyframe before it.
+
+NumPy makes the deltas vectorized, without it they are computed block
+by block in Python.
+"""
+
+from bisect import bisect_right
+from ctypes import c_char
+import os
+import struct
+import threading
+import zlib
+
+from . import libuvc, UVCError
+from .clock import monotonic as _monotonic
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__author__ = 'Eric Callahan'
+
+MAGIC = b'UVCRAW1\0'
+INDEX_MAGIC = b'UVCRIDX\0'
+
+KEYFRAME = 1
+DELTA = 2
+
+FLAG_ZLIB = 0x01
+
+_HEADER = struct.Struct('<8sII')
+_RECORD = struct.Struct('<BBHIIIIId')
+_INDEX_ENTRY = struct.Struct('<IQd')
+_TRAILER = struct.Struct('<QII8s')
+
+
+def _block_count(size, block_size):
+    return (size + block_size - 1) // block_size
+
+
+def encode_delta(previous, current, block_size=64):
+    """
+    Returns the delta payload turning previous into current, which
+    must be the same size: a bitmap of the changed blocks followed by
+    those blocks XORed with previous.
+    """
+    size = len(current)
+    blocks = _block_count(size, block_size)
+    if numpy is not None:
+        xor = numpy.zeros(blocks * block_size, dtype=numpy.uint8)
+        numpy.bitwise_xor(numpy.frombuffer(previous, dtype=numpy.uint8, count=size),
+                          numpy.frombuffer(current, dtype=numpy.uint8, count=size),
+                          out=xor[:size])
+        xor = xor.reshape(blocks, block_size)
+        changed = xor.any(axis=1)
+        return numpy.packbits(changed, bitorder='little').tobytes() + xor[changed].tobytes()
+
+    previous, current = memoryview(previous), memoryview(current)
+    bitmap = bytearray((blocks + 7) // 8)
+    changes = []
+    for block in range(blocks):
+        start = block * block_size
+        end = min(start + block_size, size)
+        old, new = previous[start:end], current[start:end]
+        if old != new:
+            bitmap[block >> 3] |= 1 << (block & 7)
+            xor = (int.from_bytes(old, 'little') ^ int.from_bytes(new, 'little'))
+            changes.append(xor.to_bytes(block_size, 'little'))
+    return bytes(bitmap) + b''.join(changes)
+
+
+def apply_delta(previous, payload, block_size=64):
+    """
+    Returns the frame previous turns into with a delta payload from
+    encode_delta().
+    """
+    size = len(previous)
+    blocks = _block_count(size, block_size)
+    bitmap_size = (blocks + 7) // 8
+    if numpy is not None:
+        changed = numpy.unpackbits(numpy.frombuffer(payload, dtype=numpy.uint8,
+                                                    count=bitmap_size),
+                                   count=blocks, bitorder='little').astype(bool)
+        xor = numpy.zeros((blocks, block_size), dtype=numpy.uint8)
+        xor[changed] = numpy.frombuffer(payload, dtype=numpy.uint8,
+                                        offset=bitmap_size).reshape(-1, block_size)
+        frame = numpy.frombuffer(previous, dtype=numpy.uint8, count=size) ^ \
+            xor.reshape(-1)[:size]
+        return frame.tobytes()
+
+    frame = bytearray(previous)
+    payload = memoryview(payload)
+    offset = bitmap_size
+    for block in range(blocks):
+        if not payload[block >> 3] & (1 << (block & 7)):
+            continue
+        start = block * block_size
+        end = min(start + block_size, size)
+        xor = int.from_bytes(payload[offset:offset + end - start], 'little')
+        frame[start:end] = (int.from_bytes(frame[start:end], 'little') ^ xor).to_bytes(
+            end - start, 'little')
+        offset += block_size
+    return bytes(frame)
+
+
+class RecordedFrame(object):
+    """
+    A frame read back from a recording.
+
+    data         - the frame bytes
+    index        - position of the frame in the recording
+    sequence     - libuvc sequence number
+    timestamp    - timestamp the frame was recorded with
+    frame_format - UVCFrameFormat
+    width, height
+    keyframe     - True if the frame was stored whole
+    """
+    __slots__ = ('data', 'index', 'sequence', 'timestamp', 'frame_format', 'width',
+                 'height', 'keyframe')
+
+    def __init__(self, data, index, sequence, timestamp, frame_format, width, height,
+                 keyframe):
+        self.data = data
+        self.index = index
+        self.sequence = sequence
+        self.timestamp = timestamp
+        self.frame_format = frame_format
+        self.width = width
+        self.height = height
+        self.keyframe = keyframe
+
+
+class RawRecorder(object):
+    """
+    Records raw frames to a file.
+
+    A keyframe is written every keyframe_interval frames, whenever the
+    format or size changes, and whenever a delta would not be smaller
+    than max_delta_ratio of the frame.
+
+    Params:
+    path              - file to create
+    keyframe_interval - frames between keyframes, which bounds the
+                        work of a seek
+    block_size        - bytes per delta block
+    compress_level    - zlib level for records, None to store them
+                        uncompressed
+    max_delta_ratio   - largest delta, relative to the frame size,
+                        written instead of a keyframe
+
+    Usage:
+
+    with RawRecorder('front.uvcraw', compress_level=1) as recorder:
+        dev.set_raw_callback(recorder.raw_callback)
+        dev.start_streaming()
+        ...
+        dev.stop_streaming()
+    """
+    def __init__(self, path, keyframe_interval=60, block_size=64, compress_level=None,
+                 max_delta_ratio=0.8):
+        self.path = path
+        self.keyframe_interval = keyframe_interval
+        self.block_size = block_size
+        self.compress_level = compress_level
+        self.max_delta_ratio = max_delta_ratio
+        self._file = open(path, 'wb')
+        self._file.write(_HEADER.pack(MAGIC, block_size, keyframe_interval))
+        self._lock = threading.Lock()
+        self._previous = None
+        self._previous_mode = None
+        self._since_keyframe = 0
+        self._frames = 0
+        self._index = []
+        self._stats = {
+            'frames': 0,
+            'keyframes': 0,
+            'raw_bytes': 0,
+            'written_bytes': _HEADER.size,
+            'encode_time': 0.0
+        }
+
+    def raw_callback(self, frame, timestamp, user=None):   # pylint: disable=unused-argument
+        """
+        A callback for UVCDevice.set_raw_callback(), which encodes the
+        frame straight from the libuvc buffer.
+        """
+        data = memoryview((c_char * frame.data_bytes).from_address(frame.data)).cast('B')
+        self.write_raw(data, frame.frame_format, frame.width, frame.height,
+                       frame.sequence, timestamp)
+
+    def write(self, frame):
+        """
+        Records a UVCFrame.
+        """
+        timestamp = frame.host_time if frame.host_time is not None else frame.arrival_time
+        self.write_raw(frame.data, frame.frame.frame_format, frame.width, frame.height,
+                       frame.sequence, timestamp or 0.0)
+
+    def write_raw(self, data, frame_format, width, height, sequence, timestamp):
+        """
+        Records a frame given as any bytes-like object.
+        """
+        with self._lock:
+            if self._file is None:
+                raise UVCError("Recorder is closed")
+            start = _monotonic()
+            size = len(data)
+            mode = (frame_format, width, height, size)
+            kind = DELTA
+            if (self._previous is None or mode != self._previous_mode or
+                    self._since_keyframe >= self.keyframe_interval):
+                kind = KEYFRAME
+            else:
+                payload = encode_delta(self._previous, data, self.block_size)
+                if len(payload) > size * self.max_delta_ratio:
+                    kind = KEYFRAME
+            if kind == KEYFRAME:
+                payload = data
+                self._since_keyframe = 0
+                self._index.append((self._frames, self._file.tell(), timestamp))
+                self._stats['keyframes'] += 1
+            self._since_keyframe += 1
+
+            flags = 0
+            if self.compress_level is not None:
+                payload = zlib.compress(payload, self.compress_level)
+                flags |= FLAG_ZLIB
+            self._file.write(_RECORD.pack(kind, flags, frame_format, width, height,
+                                          sequence, size, len(payload), timestamp))
+            self._file.write(payload)
+
+            self._previous = bytes(data)
+            self._previous_mode = mode
+            self._frames += 1
+            self._stats['frames'] += 1
+            self._stats['raw_bytes'] += size
+            self._stats['written_bytes'] += _RECORD.size + len(payload)
+            self._stats['encode_time'] += _monotonic() - start
+
+    def close(self):
+        """
+        Writes the index and closes the file.
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            offset = self._file.tell()
+            for entry in self._index:
+                self._file.write(_INDEX_ENTRY.pack(*entry))
+            self._file.write(_TRAILER.pack(offset, len(self._index), self._frames,
+                                           INDEX_MAGIC))
+            self._file.close()
+            self._file = None
+            self._previous = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_stats(self):
+        """
+        Returns a dict of counters: frames and keyframes written,
+        raw_bytes received, written_bytes to the file, their ratio and
+        the total encode_time in seconds.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        stats['ratio'] = (float(stats['raw_bytes']) / stats['written_bytes']
+                          if stats['written_bytes'] else None)
+        return stats
+
+
+class RawReader(object):
+    """
+    Reads a recording made by RawRecorder.  Frames are read by index
+    with read() or in order by iterating; a read decodes from the
+    nearest keyframe unless the previous read left off just before.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        magic, self.block_size, self.keyframe_interval = _HEADER.unpack(
+            self._file.read(_HEADER.size))
+        if magic != MAGIC:
+            self._file.close()
+            raise UVCError("%s is not a uvclite recording" % path)
+        self.keyframes = []
+        self.frames = 0
+        self.complete = self._load_index()
+        if not self.complete:
+            self._scan()
+        self._key_numbers = [entry[0] for entry in self.keyframes]
+        self._key_times = [entry[2] for entry in self.keyframes]
+        self._last = None
+
+    def _load_index(self):
+        end = self._file.seek(0, os.SEEK_END)
+        if end < _HEADER.size + _TRAILER.size:
+            return False
+        self._file.seek(end - _TRAILER.size)
+        offset, count, frames, magic = _TRAILER.unpack(self._file.read(_TRAILER.size))
+        if magic != INDEX_MAGIC:
+            return False
+        self._file.seek(offset)
+        data = self._file.read(count * _INDEX_ENTRY.size)
+        self.keyframes = [_INDEX_ENTRY.unpack_from(data, i * _INDEX_ENTRY.size)
+                          for i in range(count)]
+        self.frames = frames
+        self._end = offset
+        return True
+
+    def _scan(self):
+        # rebuild the index of a recording that was not closed
+        offset = _HEADER.size
+        self._file.seek(offset)
+        while True:
+            header = self._file.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                break
+            record = _RECORD.unpack(header)
+            if self._file.seek(record[7], os.SEEK_CUR) > os.fstat(self._file.fileno()).st_size:
+                break
+            if record[0] == KEYFRAME:
+                self.keyframes.append((self.frames, offset, record[8]))
+            self.frames += 1
+            offset += _RECORD.size + record[7]
+        self._end = offset
+
+    def __len__(self):
+        return self.frames
+
+    def _read_record(self, offset):
+        self._file.seek(offset)
+        record = _RECORD.unpack(self._file.read(_RECORD.size))
+        payload = self._file.read(record[7])
+        if record[1] & FLAG_ZLIB:
+            payload = zlib.decompress(payload)
+        return record, payload, offset + _RECORD.size + record[7]
+
+    def _frame(self, index, record, data):
+        kind, _, frame_format, width, height, sequence, _, _, timestamp = record
+        try:
+            frame_format = libuvc.uvc_frame_format(frame_format)
+        except ValueError:
+            pass
+        return RecordedFrame(data, index, sequence, timestamp, frame_format, width, height,
+                             kind == KEYFRAME)
+
+    def read(self, index):
+        """
+        Returns the RecordedFrame at index.
+        """
+        if index < 0:
+            index += self.frames
+        if not 0 <= index < self.frames:
+            raise IndexError(index)
+        key = bisect_right(self._key_numbers, index) - 1
+        number, offset, _ = self.keyframes[key]
+        last = self._last
+        if last is not None and number <= last[0] <= index:
+            # carry on from the previous read
+            number, record, data, offset = last
+        else:
+            number, record, data = number - 1, None, None
+        while number < index:
+            record, payload, offset = self._read_record(offset)
+            number += 1
+            data = payload if record[0] == KEYFRAME else \
+                apply_delta(data, payload, self.block_size)
+        self._last = (number, record, data, offset)
+        return self._frame(number, record, data)
+
+    def __iter__(self):
+        for index in range(self.frames):
+            yield self.read(index)
+
+    def seek_time(self, timestamp):
+        """
+        Returns the index of the last frame recorded at or before
+        timestamp, or 0 if every frame is later.
+        """
+        key = bisect_right(self._key_times, timestamp) - 1
+        if key < 0:
+            return 0
+        number, offset, _ = self.keyframes[key]
+        end = self.keyframes[key + 1][0] if key + 1 < len(self.keyframes) else self.frames
+        # walk the record headers of the keyframe's group
+        while number + 1 < end:
+            self._file.seek(offset)
+            record = _RECORD.unpack(self._file.read(_RECORD.size))
+            next_offset = offset + _RECORD.size + record[7]
+            self._file.seek(next_offset)
+            following = _RECORD.unpack(self._file.read(_RECORD.size))
+            if following[8] > timestamp:
+                break
+            number += 1
+            offset = next_offset
+        return number
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,345 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" NumPy downscaling of raw frames
+
+Requires NumPy.  Run as a module to benchmark:
+
+    python -m uvclite.resize
+"""
+
+from ctypes import addressof, c_uint8, c_char
+import threading
+
+from . import libuvc
+from .clock import monotonic as _monotonic
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+__author__ = 'Eric Callahan'
+
+_fmt = libuvc.uvc_frame_format
+
+# bytes per pixel and offset of the luma byte of each raw layout
+RAW_LAYOUT = {
+    _fmt.UVC_FRAME_FORMAT_GRAY8.value: (1, 0),
+    _fmt.UVC_FRAME_FORMAT_BY8.value: (1, 0),
+    _fmt.UVC_FRAME_FORMAT_YUYV.value: (2, 0),
+    _fmt.UVC_FRAME_FORMAT_UYVY.value: (2, 1),
+    _fmt.UVC_FRAME_FORMAT_RGB.value: (3, None),
+    _fmt.UVC_FRAME_FORMAT_BGR.value: (3, None)
+}
+
+# integer luma weights (sum 256) for RGB, reversed for BGR
+_LUMA_WEIGHTS = (77, 150, 29)
+
+
+def frame_array(frame):
+    """
+    Returns a NumPy uint8 view of a raw frame shaped (height, step),
+    honouring the row stride in uvc_frame.step.  frame may be a
+    UVCFrame, whose copied data is used, or a uvc_frame struct, whose
+    libuvc buffer is viewed without a copy.
+    """
+    struct = getattr(frame, 'frame', frame)
+    pixel_bytes = RAW_LAYOUT[struct.frame_format][0]
+    stride = struct.step or struct.width * pixel_bytes
+    height = min(struct.height, struct.data_bytes // stride)
+    if struct is frame:
+        buf = (c_uint8 * (stride * height)).from_address(struct.data)
+    else:
+        buf = frame.data
+    array = numpy.frombuffer(buf, dtype=numpy.uint8, count=stride * height)
+    return array.reshape(height, stride)
+
+
+def _area_weights(size_in, size_out):
+    # (size_out, size_in) matrix averaging the inputs each output covers
+    scale = float(size_in) / size_out
+    edges = numpy.arange(size_out + 1) * scale
+    start = edges[:-1, None]
+    end = edges[1:, None]
+    pixels = numpy.arange(size_in)[None, :]
+    overlap = numpy.clip(numpy.minimum(end, pixels + 1) - numpy.maximum(start, pixels),
+                         0, None)
+    return (overlap / scale).astype(numpy.float32)
+
+
+def _prefactor(size_in, size_out):
+    # largest integer factor of size_in no greater than size_in / size_out
+    factor = max(size_in // size_out, 1)
+    while size_in % factor:
+        factor -= 1
+    return factor
+
+
+class _Plan(object):
+    # buffers and indices for one input geometry
+
+    def __init__(self, resizer, frame_format, width, height):
+        pixel_bytes, luma = RAW_LAYOUT[frame_format]
+        self.gray = resizer.gray
+        self.frame_format = frame_format
+        out_w, out_h = resizer.width, resizer.height
+        if self.gray:
+            in_w, channels = width, 1
+        elif pixel_bytes == 2:
+            # resample whole Y0 U Y1 V macropixels
+            if width % 2 or out_w % 2:
+                raise ValueError("YUYV and UYVY widths must be even")
+            in_w, channels, out_w = width // 2, 4, out_w // 2
+        else:
+            in_w, channels = width, pixel_bytes
+        self.pixel_bytes = pixel_bytes
+        self.luma = luma
+        self.in_w, self.in_h = in_w, height
+        self.channels = channels
+        self.shape = (out_h, out_w, channels)
+        self.out = numpy.empty(self.shape, dtype=numpy.uint8)
+
+        self.factor_y = self.factor_x = 1
+        self.weights_y = self.weights_x = None
+        if resizer.method == 'nearest':
+            if height % out_h == 0 and in_w % out_w == 0:
+                self.mode = 'slice'
+                self.factor_y, self.factor_x = height // out_h, in_w // out_w
+            else:
+                self.mode = 'take'
+                self.rows = (numpy.arange(out_h) * height // out_h).astype(numpy.intp)
+                self.cols = (numpy.arange(out_w) * in_w // out_w).astype(numpy.intp)
+                self.row_buf = numpy.empty((out_h, in_w, channels), dtype=numpy.uint8)
+        else:
+            # integer box filter first, then resample what remains
+            self.factor_y = _prefactor(height, out_h)
+            self.factor_x = _prefactor(in_w, out_w)
+            mid_h, mid_w = height // self.factor_y, in_w // self.factor_x
+            self.sum_buf = numpy.empty((mid_h, mid_w, channels), dtype=numpy.uint32)
+            if mid_h != out_h:
+                self.weights_y = _area_weights(mid_h, out_h)
+            if mid_w != out_w:
+                self.weights_x = _area_weights(mid_w, out_w)
+            if self.weights_y is None and self.weights_x is None:
+                self.mode = 'box'
+            else:
+                self.mode = 'resample'
+                self.float_buf = numpy.empty((mid_h, mid_w, channels), dtype=numpy.float32)
+        if self.gray and luma is None:
+            self.luma_buf = numpy.empty((height, width), dtype=numpy.uint16)
+            self.luma_out = numpy.empty((height, width), dtype=numpy.uint8)
+
+    def source(self, rows):
+        # (height, width, channels) view of the frame rows
+        width = self.in_w * (2 if self.channels == 4 else 1)
+        if self.gray:
+            if self.luma is not None:
+                step = self.pixel_bytes
+                luma = rows[:, self.luma:self.luma + width * step:step]
+                return luma[:, :, None]
+            # weighted RGB luma, computed in place in a reusable buffer
+            pixels = rows[:, :width * 3].reshape(rows.shape[0], width, 3)
+            weights = _LUMA_WEIGHTS
+            if self.frame_format == _fmt.UVC_FRAME_FORMAT_BGR.value:
+                weights = weights[::-1]
+            buf = self.luma_buf
+            numpy.multiply(pixels[:, :, 0], weights[0], out=buf, dtype=numpy.uint16)
+            buf += pixels[:, :, 1].astype(numpy.uint16) * weights[1]
+            buf += pixels[:, :, 2].astype(numpy.uint16) * weights[2]
+            buf >>= 8
+            numpy.copyto(self.luma_out, buf, casting='unsafe')
+            return self.luma_out[:, :, None]
+        row_bytes = self.in_w * self.channels
+        return rows[:, :row_bytes].reshape(rows.shape[0], self.in_w, self.channels)
+
+    def run(self, src, out):
+        if self.mode == 'take':
+            numpy.take(src, self.rows, axis=0, out=self.row_buf)
+            numpy.take(self.row_buf, self.cols, axis=1, out=out)
+            return out
+        fy, fx = self.factor_y, self.factor_x
+        area = fy * fx
+        if self.mode == 'slice' or area == 1 and self.mode == 'box':
+            numpy.copyto(out, src[::fy, ::fx])
+            return out
+
+        mid_h, mid_w, channels = self.sum_buf.shape
+        blocks = src.reshape(mid_h, fy, mid_w, fx, channels)
+        if self.mode == 'box':
+            blocks.sum(axis=(1, 3), dtype=numpy.uint32, out=self.sum_buf)
+            self.sum_buf += area // 2
+            self.sum_buf //= area
+            numpy.copyto(out, self.sum_buf, casting='unsafe')
+            return out
+
+        if area > 1:
+            blocks.sum(axis=(1, 3), dtype=numpy.uint32, out=self.sum_buf)
+            numpy.multiply(self.sum_buf, 1.0 / area, out=self.float_buf,
+                           casting='unsafe')
+        else:
+            numpy.copyto(self.float_buf, src, casting='unsafe')
+        result = self.float_buf
+        if self.weights_y is not None:
+            result = numpy.matmul(self.weights_y,
+                                  result.reshape(mid_h, -1)).reshape(-1, mid_w, channels)
+        if self.weights_x is not None:
+            result = numpy.matmul(self.weights_x, result)
+        numpy.add(result, 0.5, out=result)
+        numpy.copyto(out, result, casting='unsafe')
+        return out
+
+
+class Resizer(object):
+    """
+    Downscales raw frames (GRAY8, BY8, YUYV, UYVY, RGB and BGR) to a
+    fixed size with NumPy.
+
+    The area method averages the source pixels each output pixel
+    covers.  Where the size ratio has an integer factor it is applied
+    as a box sum over a reshaped view, and any remaining fractional
+    ratio is resampled with small weight matrices.  This is exact for
+    integer ratios, otherwise pixels straddling an output edge are
+    weighted by their box rather than individually, which is within a
+    level of exact averaging on natural images.  The nearest method
+    picks one source pixel per output pixel, with integer ratios taken
+    as a plain strided slice.
+
+    Intermediate buffers are allocated once per input geometry and
+    reused.  Unless out is passed to resize(), the returned array is
+    also reused, so it is overwritten by the next call.
+
+    Params:
+    width, height - output size in pixels
+    method        - 'area' or 'nearest'
+    gray          - output luma only, shaped (height, width).  Otherwise
+                    the output keeps the input layout, shaped
+                    (height, width // 2, 4) for YUYV and UYVY and
+                    (height, width, 3) for RGB and BGR.
+
+    Usage:
+
+    resizer = Resizer(320, 240)
+    frame = dev.get_frame()
+    thumb = resizer.resize(frame)
+    """
+    def __init__(self, width, height, method='area', gray=True):
+        if numpy is None:
+            raise ImportError("Resizer requires NumPy")
+        if method not in ('area', 'nearest'):
+            raise ValueError("Unknown resize method %r" % method)
+        self.width = width
+        self.height = height
+        self.method = method
+        self.gray = gray
+        self._plans = {}
+
+    def output_shape(self, frame_format, width, height):
+        """
+        Returns the shape of the output for the given input.
+        """
+        shape = self._plan(getattr(frame_format, 'value', frame_format),
+                           width, height).shape
+        return shape[:2] if self.gray else shape
+
+    def _plan(self, frame_format, width, height):
+        key = (frame_format, width, height)
+        plan = self._plans.get(key)
+        if plan is None:
+            if frame_format not in RAW_LAYOUT:
+                raise ValueError("Cannot resize frame format %d" % frame_format)
+            plan = self._plans[key] = _Plan(self, frame_format, width, height)
+        return plan
+
+    def resize(self, frame, out=None):
+        """
+        Resizes a UVCFrame or uvc_frame struct and returns the output
+        array.  out may be a uint8 array of output_shape() to write to.
+        """
+        struct = getattr(frame, 'frame', frame)
+        plan = self._plan(struct.frame_format, struct.width, struct.height)
+        if out is None:
+            out = plan.out
+        elif self.gray:
+            out = out[:, :, None]
+        plan.run(plan.source(frame_array(frame)), out)
+        return out[:, :, 0] if self.gray else out
+
+
+def resize_stage(width, height, method='area', gray=True):
+    """
+    Returns a function for Pipeline.add_stage() that resizes each
+    UVCFrame into a new array.  Each worker thread uses its own
+    Resizer, so the stage may have several workers.
+    """
+    local = threading.local()
+
+    def _stage(frame):
+        resizer = getattr(local, 'resizer', None)
+        if resizer is None:
+            resizer = local.resizer = Resizer(width, height, method, gray)
+        return resizer.resize(frame).copy()
+    return _stage
+
+
+def _synthetic_frame(frame_format, width, height, padding=64):
+    # a uvc_frame over random data, rows padded to exercise the stride
+    pixel_bytes = RAW_LAYOUT[frame_format.value][0]
+    step = width * pixel_bytes + padding
+    buf = (c_char * (step * height))()
+    data = numpy.frombuffer(buf, dtype=numpy.uint8)
+    data[:] = numpy.random.randint(0, 256, data.size)
+    frame = libuvc.uvc_frame(addressof(buf), step * height, width, height,
+                             frame_format.value, step, 0)
+    frame._buf = buf    # pylint: disable=protected-access
+    return frame
+
+
+def benchmark(resolutions=((640, 480), (1280, 720), (1920, 1080)), target=(320, 240),
+              formats=(_fmt.UVC_FRAME_FORMAT_YUYV, _fmt.UVC_FRAME_FORMAT_GRAY8),
+              methods=('area', 'nearest'), gray=True, repeat=50):
+    """
+    Times Resizer.resize() on synthetic frames.  Returns a list of
+    dicts with the input resolution, format, method and the mean
+    and best time per frame in milliseconds.
+    """
+    results = []
+    for width, height in resolutions:
+        for frame_format in formats:
+            frame = _synthetic_frame(frame_format, width, height)
+            for method in methods:
+                resizer = Resizer(target[0], target[1], method, gray)
+                resizer.resize(frame)
+                times = []
+                for _ in range(repeat):
+                    start = _monotonic()
+                    resizer.resize(frame)
+                    times.append(_monotonic() - start)
+                results.append({
+                    'width': width,
+                    'height': height,
+                    'format': frame_format.name,
+                    'method': method,
+                    'mean_ms': sum(times) / len(times) * 1000.0,
+                    'best_ms': min(times) * 1000.0
+                })
+    return results
+
+
+if __name__ == '__main__':
+    for result in benchmark():
+        print('%(width)4dx%(height)-4d %(format)-24s %(method)-8s '
+              'mean %(mean_ms)7.3f ms  best %(best_ms)7.3f ms' % result)
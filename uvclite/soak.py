@@ -0,0 +1,311 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Soak test for memory, handle and reference leaks
+
+Repeats the device life cycle, device list refreshes and find, open,
+stream, stop and close, for as many cycles as asked, and samples the
+process every so often: RSS, memory traced by tracemalloc, open file
+descriptors, threads and live ctypes callbacks.  When libuvc is
+replaced by an object that counts what it holds, such as the stand-in
+the tests use (tests/standin.py), the libuvc objects still held are
+sampled too.  The first sample after the warmup is the baseline, and
+the run fails if a later sample has grown past the limits.
+
+Usage:
+
+    python -m uvclite.soak --cycles 1000000
+"""
+
+import argparse
+from collections import namedtuple
+import ctypes
+import gc
+import json
+import os
+import sys
+import threading
+import tracemalloc
+
+from . import libuvc, UVCContext, UVCFrameFormat
+from .clock import monotonic as _monotonic
+
+__author__ = 'Eric Callahan'
+
+Sample = namedtuple('Sample', ['cycle', 'elapsed', 'rss', 'traced', 'fds', 'threads',
+                               'callbacks', 'libuvc'])
+
+# counts of a counting libuvc that must return to their baseline
+HELD_COUNTS = ('contexts', 'device_refs', 'device_lists', 'handles', 'streams',
+               'running', 'descriptors')
+
+
+def _rss():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError):
+        import resource
+        # peak rather than current, but still shows growth
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _open_fds():
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return 0
+
+
+def _live_callbacks():
+    return sum(1 for obj in gc.get_objects()
+               if isinstance(obj, ctypes._CFuncPtr))   # pylint: disable=protected-access
+
+
+class SoakReport(object):
+    """
+    The result of a soak run.
+
+    samples  - Samples taken, the baseline first
+    failures - descriptions of every limit exceeded
+    growth   - tracemalloc's largest allocation increases since the
+               baseline, as strings
+    """
+    def __init__(self, samples, failures, growth, cycles, elapsed):
+        self.samples = samples
+        self.failures = failures
+        self.growth = growth
+        self.cycles = cycles
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return not self.failures
+
+    def as_dict(self):
+        return {
+            'ok': self.ok,
+            'cycles': self.cycles,
+            'elapsed': self.elapsed,
+            'failures': self.failures,
+            'growth': self.growth,
+            'samples': [s._asdict() for s in self.samples]
+        }
+
+
+class SoakHarness(object):
+    """
+    Runs the soak.  Each cycle refreshes the device list, reading and
+    freeing every descriptor, then finds a device and opens it.  Every
+    stream_every cycles the device streams until it delivers a frame.
+    The device is then closed, and the context itself is replaced
+    every context_every cycles.
+
+    If the loaded libuvc has get_counts(), returning the HELD_COUNTS of
+    objects held along with a count of 'violations', and a
+    violation_log, those are sampled and must not change.
+
+    Params:
+    cycles         - cycles to run
+    sample_every   - cycles between samples
+    warmup         - cycles before the baseline sample, default one
+                     sample interval
+    stream_every   - cycles between streaming runs
+    context_every  - cycles between context replacements
+    mode           - (frame_format, width, height, frame_rate) to stream
+    rss_limit      - allowed RSS growth in bytes
+    traced_limit   - allowed growth of memory traced by tracemalloc,
+                     None to run without tracemalloc
+    fd_limit       - allowed growth of open file descriptors
+    thread_limit   - allowed growth of threads
+    callback_limit - allowed growth of live ctypes callbacks
+    frame_timeout  - seconds to wait for a frame when streaming
+    fail_fast      - stop at the first sample exceeding a limit
+    """
+    def __init__(self, cycles=1000000, sample_every=10000, warmup=None, stream_every=100,
+                 context_every=1000,
+                 mode=(UVCFrameFormat.UVC_FRAME_FORMAT_YUYV, 320, 240, 30),
+                 rss_limit=16 * 1024 * 1024, traced_limit=1024 * 1024, fd_limit=4,
+                 thread_limit=2, callback_limit=16, frame_timeout=2.0, fail_fast=True):
+        self.cycles = cycles
+        self.sample_every = sample_every
+        self.warmup = sample_every if warmup is None else warmup
+        self.stream_every = stream_every
+        self.context_every = context_every
+        self.mode = mode
+        self.rss_limit = rss_limit
+        self.traced_limit = traced_limit
+        self.fd_limit = fd_limit
+        self.thread_limit = thread_limit
+        self.callback_limit = callback_limit
+        self.frame_timeout = frame_timeout
+        self.fail_fast = fail_fast
+        # a libuvc with get_counts() and violation_log, as the stand-in has
+        self._counting = libuvc._libuvc if hasattr(libuvc._libuvc, 'get_counts') else None
+        self._frames = 0
+
+    def _on_frame(self, frame, user):   # pylint: disable=unused-argument
+        self._frames += 1
+
+    def cycle(self, context, index):
+        """
+        Runs one cycle on context.
+        """
+        for device in context.get_device_list():
+            device.get_bus_number()
+            device.get_device_address()
+            device.get_device_descriptor()
+            device.free_device_descriptor()
+
+        device = context.find_device()
+        device.open()
+        try:
+            device.get_device_descriptor()
+            if self.stream_every and index % self.stream_every == 0:
+                device.set_stream_format(*self.mode)
+                device.set_callback(self._on_frame)
+                device.start_streaming()
+                if not device.wait_for_frame(self.frame_timeout):
+                    raise RuntimeError("No frame within %.1f seconds at cycle %d"
+                                       % (self.frame_timeout, index))
+                device.stop_streaming()
+        finally:
+            device.close()
+
+    def sample(self, cycle, start):
+        """
+        Collects garbage and returns a Sample.
+        """
+        gc.collect()
+        traced = tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        return Sample(cycle, _monotonic() - start, _rss(), traced, _open_fds(),
+                      threading.active_count(), _live_callbacks(),
+                      self._counting.get_counts() if self._counting is not None else None)
+
+    def check(self, baseline, sample):
+        """
+        Returns a list of the limits sample exceeds over baseline.
+        """
+        failures = []
+        limits = (('rss', self.rss_limit), ('traced', self.traced_limit),
+                  ('fds', self.fd_limit), ('threads', self.thread_limit),
+                  ('callbacks', self.callback_limit))
+        for field, limit in limits:
+            before, after = getattr(baseline, field), getattr(sample, field)
+            if limit is None or before is None:
+                continue
+            if after - before > limit:
+                failures.append("%s grew by %d (limit %d) at cycle %d"
+                                % (field, after - before, limit, sample.cycle))
+        if sample.libuvc is not None:
+            for field in HELD_COUNTS:
+                before, after = baseline.libuvc[field], sample.libuvc[field]
+                if after != before:
+                    failures.append("libuvc %s went from %d to %d at cycle %d"
+                                    % (field, before, after, sample.cycle))
+            violations = sample.libuvc['violations'] - baseline.libuvc['violations']
+            if violations:
+                failures.append("%d libuvc reference violations by cycle %d, last: %s"
+                                % (violations, sample.cycle,
+                                   self._counting.violation_log[-1]))
+        return failures
+
+    def run(self, progress=None):
+        """
+        Runs the soak and returns a SoakReport.  progress, if given, is
+        called with every Sample.
+        """
+        if self.traced_limit is not None and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        start = _monotonic()
+        samples = []
+        failures = []
+        snapshot = None
+        context = UVCContext()
+        cycle = 0
+        try:
+            while cycle < self.cycles:
+                if cycle and self.context_every and cycle % self.context_every == 0:
+                    context.close()
+                    context = UVCContext()
+                self.cycle(context, cycle)
+                cycle += 1
+                if cycle == self.warmup or (cycle > self.warmup and
+                                            (cycle - self.warmup) % self.sample_every == 0):
+                    sample = self.sample(cycle, start)
+                    samples.append(sample)
+                    if progress is not None:
+                        progress(sample)
+                    if len(samples) == 1:
+                        if tracemalloc.is_tracing():
+                            snapshot = tracemalloc.take_snapshot()
+                        continue
+                    failures = self.check(samples[0], sample)
+                    if failures and self.fail_fast:
+                        break
+        finally:
+            context.close()
+
+        growth = []
+        if snapshot is not None:
+            stats = tracemalloc.take_snapshot().compare_to(snapshot, 'lineno')
+            growth = [str(stat) for stat in stats[:10] if stat.size_diff > 0]
+            tracemalloc.stop()
+        return SoakReport(samples, failures, growth, cycle, _monotonic() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m uvclite.soak',
+                                     description="Soak test uvclite for leaks")
+    parser.add_argument('--cycles', type=int, default=1000000)
+    parser.add_argument('--sample-every', type=int, default=10000)
+    parser.add_argument('--warmup', type=int, default=None)
+    parser.add_argument('--stream-every', type=int, default=100)
+    parser.add_argument('--context-every', type=int, default=1000)
+    parser.add_argument('--rss-limit', type=int, default=16 * 1024 * 1024)
+    parser.add_argument('--traced-limit', type=int, default=1024 * 1024,
+                        help="0 runs without tracemalloc")
+    parser.add_argument('--json', action='store_true', help="print the report as JSON")
+    args = parser.parse_args(argv)
+
+    harness = SoakHarness(cycles=args.cycles, sample_every=args.sample_every,
+                          warmup=args.warmup, stream_every=args.stream_every,
+                          context_every=args.context_every, rss_limit=args.rss_limit,
+                          traced_limit=args.traced_limit or None)
+
+    def _progress(sample):
+        if not args.json:
+            print("cycle %9d  %8.1fs  rss %6.1f MiB  traced %s  fds %d  threads %d  "
+                  "callbacks %d" % (sample.cycle, sample.elapsed, sample.rss / 1048576.0,
+                                    '-' if sample.traced is None else
+                                    '%.1f KiB' % (sample.traced / 1024.0),
+                                    sample.fds, sample.threads, sample.callbacks))
+
+    report = harness.run(_progress)
+    if args.json:
+        print(json.dumps(report.as_dict(), indent=2))
+    else:
+        for failure in report.failures:
+            print("FAIL: %s" % failure)
+        for line in report.growth if report.failures else []:
+            print("  %s" % line)
+        print("%s after %d cycles in %.1fs" % ('OK' if report.ok else 'FAILED',
+                                              report.cycles, report.elapsed))
+    return 0 if report.ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,345 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" One capture process per camera, under a supervisor
+
+Frame callbacks and UVCFrame construction hold the GIL, so a single
+process stops scaling after a few high resolution cameras.  The
+Supervisor runs each camera in a worker process of its own, which
+streams into a FramePublisher (see uvclite.ipc).  The parent, or any
+other process, reads the frames with a FrameSubscriber of the same
+name.  Workers that exit are restarted after a backoff delay, and
+subscribers follow them to the new ring.
+
+Usage:
+
+    supervisor = Supervisor([
+        CameraSpec('front', serial='A1B2C3', mode=(UVCFrameFormat.UVC_FRAME_FORMAT_YUYV,
+                                                  1920, 1080, 30)),
+        CameraSpec('rear', bus=1, address=7)])
+    supervisor.start()
+    front = supervisor.subscribe('front')
+    frame = front.get(timeout=1.0)
+"""
+
+from collections import namedtuple
+import errno
+import logging
+import multiprocessing
+import threading
+import time
+
+from . import ipc, UVCContext, UVCError
+from .clock import monotonic as _monotonic
+
+__author__ = 'Eric Callahan'
+
+_logger = logging.getLogger(__name__)
+
+_MSG_STOP = 'stop'
+_MSG_READY = 'ready'
+_MSG_STATS = 'stats'
+_MSG_ERROR = 'error'
+
+
+class CameraSpec(namedtuple('CameraSpec', ['name', 'serial', 'bus', 'address', 'mode'])):
+    """
+    Selects a camera and the mode it streams in.
+
+    name    - publisher name, also used to subscribe to its frames
+    serial  - serial number of the device
+    bus     - USB bus number, with address
+    address - USB device address, with bus
+    mode    - (frame_format, width, height, frame_rate), or a UVCMode.
+              Defaults to the device's default format.
+
+    A camera selected by serial number is found again wherever it is
+    plugged in, one selected by bus and address is not.
+    """
+    __slots__ = ()
+
+    def __new__(cls, name, serial=None, bus=None, address=None, mode=None):
+        if serial is None and (bus is None or address is None):
+            raise ValueError("Camera %s needs a serial number or a bus and address" % name)
+        return super(CameraSpec, cls).__new__(cls, name, serial, bus, address, mode)
+
+
+def select_device(context, camera):
+    """
+    Returns the UVCDevice of context matching a CameraSpec.  Raises
+    UVCError if it is not connected.
+    """
+    if camera.serial is not None:
+        return context.find_device(serial_number=camera.serial)
+    for device in context.get_device_list():
+        if (device.get_bus_number() == camera.bus and
+                device.get_device_address() == camera.address):
+            return device
+    raise UVCError("No device at bus %d address %d" % (camera.bus, camera.address),
+                   errno.ENODEV)
+
+
+def _capture_main(camera, conn, slots, stats_interval, stall_timeout):
+    # runs in the worker process
+    try:
+        _capture(camera, conn, slots, stats_interval, stall_timeout)
+    except Exception as err:     # pylint: disable=broad-except
+        try:
+            conn.send((_MSG_ERROR, '%s: %s' % (type(err).__name__, err)))
+        except OSError:
+            pass
+        raise SystemExit(1)
+
+
+def _capture(camera, conn, slots, stats_interval, stall_timeout):
+    with UVCContext() as context:
+        device = select_device(context, camera)
+        device.open()
+        publisher = None
+        try:
+            if camera.mode is not None:
+                device.set_stream_format(*tuple(camera.mode)[:4])
+            else:
+                device.set_stream_format()
+            publisher = ipc.FramePublisher(
+                camera.name, device._stream_ctrl.dwMaxVideoFrameSize, slots)
+            publisher.start()
+            device.set_raw_callback(publisher.raw_callback)
+            device.start_streaming()
+            conn.send((_MSG_READY, None))
+
+            last_frames = 0
+            last_progress = _monotonic()
+            while not conn.poll(stats_interval) or conn.recv() != _MSG_STOP:
+                device_stats = device.get_stats()
+                now = _monotonic()
+                if device_stats['frames'] != last_frames:
+                    last_frames = device_stats['frames']
+                    last_progress = now
+                elif now - last_progress > stall_timeout:
+                    raise UVCError("No frames for %.1f seconds" % (now - last_progress),
+                                   errno.ETIMEDOUT)
+                conn.send((_MSG_STATS, {'device': device_stats,
+                                        'publisher': publisher.get_stats()}))
+            device.stop_streaming()
+        finally:
+            # stop the stream before closing the ring its callback writes to
+            try:
+                device.close()
+            finally:
+                if publisher is not None:
+                    publisher.close()
+
+
+class _Worker(object):
+    def __init__(self, camera):
+        self.camera = camera
+        self.process = None
+        self.conn = None
+        self.state = 'stopped'
+        self.started = None
+        self.restart_at = None
+        self.backoff = None
+        self.restarts = 0
+        self.last_error = None
+        self.stats = {}
+
+
+class Supervisor(object):
+    """
+    Runs one capture process per camera and restarts them when they
+    exit.  A worker exits when its camera cannot be opened, streaming
+    fails, or no frame arrives for stall_timeout seconds.
+
+    The first restart waits backoff seconds and every further one twice
+    as long as the last, up to max_backoff.  A worker that ran for
+    stable_after seconds goes back to the initial delay.
+
+    Params:
+    cameras        - CameraSpecs
+    slots          - length of each camera's FramePublisher ring
+    backoff        - initial restart delay in seconds
+    max_backoff    - maximum restart delay
+    stable_after   - seconds a worker must run to reset the delay
+    stats_interval - seconds between stats reports from the workers
+    stall_timeout  - seconds without frames before a worker gives up
+    start_method   - multiprocessing start method.  'spawn' keeps the
+                     workers clear of libusb state in the parent.
+    """
+    def __init__(self, cameras, slots=8, backoff=1.0, max_backoff=60.0,
+                 stable_after=30.0, stats_interval=1.0, stall_timeout=5.0,
+                 start_method='spawn'):
+        self.slots = slots
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after
+        self.stats_interval = stats_interval
+        self.stall_timeout = stall_timeout
+        self._mp = multiprocessing.get_context(start_method)
+        self._workers = {}
+        for camera in cameras:
+            if camera.name in self._workers:
+                raise ValueError("Duplicate camera name %s" % camera.name)
+            self._workers[camera.name] = _Worker(camera)
+        self._lock = threading.Lock()
+        self._running = False
+        self._thread = None
+
+    def start(self):
+        """
+        Starts every worker and the monitor thread.
+        """
+        self._running = True
+        with self._lock:
+            for worker in self._workers.values():
+                self._launch(worker)
+        self._thread = threading.Thread(target=self._monitor, name='uvclite-supervisor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _launch(self, worker):
+        parent_conn, child_conn = self._mp.Pipe()
+        worker.process = self._mp.Process(
+            target=_capture_main, name='uvclite-capture-%s' % worker.camera.name,
+            args=(worker.camera, child_conn, self.slots, self.stats_interval,
+                  self.stall_timeout))
+        worker.process.daemon = True
+        worker.process.start()
+        child_conn.close()
+        worker.conn = parent_conn
+        worker.state = 'starting'
+        worker.started = _monotonic()
+        worker.restart_at = None
+
+    def _receive(self, worker):
+        try:
+            while worker.conn.poll():
+                kind, payload = worker.conn.recv()
+                if kind == _MSG_STATS:
+                    worker.stats = payload
+                elif kind == _MSG_READY:
+                    worker.state = 'running'
+                elif kind == _MSG_ERROR:
+                    worker.last_error = payload
+        except (EOFError, OSError):
+            pass
+
+    def _monitor(self):
+        while self._running:
+            now = _monotonic()
+            with self._lock:
+                for worker in self._workers.values():
+                    if worker.conn is not None:
+                        self._receive(worker)
+                    if worker.state in ('starting', 'running') and not worker.process.is_alive():
+                        self._exited(worker, now)
+                    elif worker.state == 'waiting' and now >= worker.restart_at:
+                        worker.restarts += 1
+                        _logger.info("Restarting capture of %s", worker.camera.name)
+                        self._launch(worker)
+            time.sleep(0.1)
+
+    def _exited(self, worker, now):
+        self._receive(worker)
+        worker.conn.close()
+        worker.conn = None
+        if worker.backoff is None or now - worker.started >= self.stable_after:
+            worker.backoff = self.backoff
+        else:
+            worker.backoff = min(worker.backoff * 2, self.max_backoff)
+        worker.state = 'waiting'
+        worker.restart_at = now + worker.backoff
+        _logger.warning("Capture of %s exited with code %s (%s), restarting in %.1fs",
+                        worker.camera.name, worker.process.exitcode,
+                        worker.last_error, worker.backoff)
+
+    def subscribe(self, name, retry_interval=0.5):
+        """
+        Returns a FrameSubscriber for the named camera.  Processes other
+        than the supervisor's subscribe with ipc.FrameSubscriber(name).
+        """
+        if name not in self._workers:
+            raise KeyError(name)
+        return ipc.FrameSubscriber(name, retry_interval=retry_interval)
+
+    def stop(self, timeout=5.0):
+        """
+        Stops the monitor thread and every worker.
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            for worker in self._workers.values():
+                if worker.conn is not None:
+                    try:
+                        worker.conn.send(_MSG_STOP)
+                    except OSError:
+                        pass
+            for worker in self._workers.values():
+                if worker.process is None:
+                    continue
+                worker.process.join(timeout)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+                    worker.process.join()
+                if worker.conn is not None:
+                    self._receive(worker)
+                    worker.conn.close()
+                    worker.conn = None
+                worker.state = 'stopped'
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def get_stats(self):
+        """
+        Returns a dict with an entry per camera name holding its state
+        ('starting', 'running', 'waiting' for a restart or 'stopped'),
+        pid, restarts, last_error and the latest 'device' and
+        'publisher' stats reported by its worker.  The 'total' entry
+        sums the device and publisher counters of every camera, taking
+        the largest of the *_max values and leaving out the *_last ones.
+        """
+        stats = {}
+        total = {'device': {}, 'publisher': {}, 'restarts': 0}
+        with self._lock:
+            for name, worker in self._workers.items():
+                stats[name] = {
+                    'state': worker.state,
+                    'pid': worker.process.pid if worker.process is not None else None,
+                    'restarts': worker.restarts,
+                    'last_error': worker.last_error,
+                    'device': dict(worker.stats.get('device', {})),
+                    'publisher': dict(worker.stats.get('publisher', {}))
+                }
+                total['restarts'] += worker.restarts
+                for group in ('device', 'publisher'):
+                    merged = total[group]
+                    for key, value in worker.stats.get(group, {}).items():
+                        if not isinstance(value, (int, float)) or isinstance(value, bool):
+                            continue
+                        if key.endswith('_max'):
+                            merged[key] = max(merged.get(key, value), value)
+                        elif not key.endswith('_last'):
+                            merged[key] = merged.get(key, 0) + value
+        stats['total'] = total
+        return stats
@@ -0,0 +1,221 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Timestamp based frame set assembly across several cameras
+
+"""
+
+from collections import deque
+import queue
+import threading
+
+__author__ = 'Eric Callahan'
+
+
+def frame_timestamp(frame):
+    """
+    Default timestamp of a UVCFrame: the capture time mapped to the
+    host monotonic clock, falling back to the arrival time.  Raises
+    ValueError if the frame has neither.
+    """
+    if frame.host_time is not None:
+        return frame.host_time
+    if frame.arrival_time is None:
+        raise ValueError("Frame %r has neither a host time nor an arrival time"
+                         % (frame.sequence,))
+    return frame.arrival_time
+
+
+class FrameSet(object):
+    """
+    Frames from every camera that were captured within the tolerance
+    of each other.
+
+    frames    - dict of camera name to frame
+    timestamp - mean timestamp of the frames
+    skew      - spread between the earliest and latest timestamp
+    """
+    __slots__ = ('frames', 'timestamp', 'skew')
+
+    def __init__(self, frames, timestamp, skew):
+        self.frames = frames
+        self.timestamp = timestamp
+        self.skew = skew
+
+    def __getitem__(self, camera):
+        return self.frames[camera]
+
+
+class FrameSynchronizer(object):
+    """
+    Matches frames from several streaming devices into FrameSets whose
+    timestamps lie within tolerance seconds of each other.
+
+    Each camera has a buffer sorted by timestamp holding at most
+    max_buffer frames.  Whenever a frame is pushed, the oldest frame of
+    every camera is compared: if they are within tolerance they are
+    emitted as a set, otherwise frames too old to match the newest of
+    them are discarded as stale.  Each step looks at one frame per
+    camera, so the cost grows linearly with the number of cameras.
+
+    Matched sets are passed to callback if one is given, otherwise
+    they are placed in a bounded queue read with get().  Frames whose
+    timestamp function raises ValueError or returns None are skipped
+    and counted as untimed.
+
+    Usage:
+
+    sync = FrameSynchronizer(['left', 'right'], tolerance=0.004)
+    left.set_callback(sync.callback_for('left'))
+    right.set_callback(sync.callback_for('right'))
+    ...
+    frame_set = sync.get(timeout=1.0)
+    """
+    def __init__(self, cameras, tolerance=0.005, max_buffer=8, callback=None,
+                 queue_size=8, timestamp=frame_timestamp):
+        self.cameras = list(cameras)
+        self.tolerance = tolerance
+        self.max_buffer = max_buffer
+        self.callback = callback
+        self.timestamp = timestamp
+        self.output = queue.Queue(queue_size)
+        self._buffers = dict((camera, deque()) for camera in self.cameras)
+        self._lock = threading.Lock()
+        self._stats = {
+            'pushed': 0,
+            'matched': 0,
+            'stale': 0,
+            'overflow': 0,
+            'untimed': 0,
+            'output_dropped': 0
+        }
+        self._stale_by_camera = dict((camera, 0) for camera in self.cameras)
+
+    def callback_for(self, camera):
+        """
+        Returns a frame callback for UVCDevice.set_callback() that
+        pushes frames for the named camera.
+        """
+        def _callback(frame, user):
+            self.push(camera, frame)
+        return _callback
+
+    def push(self, camera, frame, timestamp=None):
+        """
+        Adds a frame from the named camera and emits any frame sets
+        that can now be matched.  Returns the number of sets emitted.
+        """
+        if timestamp is None:
+            try:
+                timestamp = self.timestamp(frame)
+            except ValueError:
+                timestamp = None
+            if timestamp is None:
+                # usually called from a frame callback, so not raised
+                with self._lock:
+                    self._stats['pushed'] += 1
+                    self._stats['untimed'] += 1
+                return 0
+
+        with self._lock:
+            self._stats['pushed'] += 1
+            buf = self._buffers[camera]
+            if not buf or buf[-1][0] <= timestamp:
+                buf.append((timestamp, frame))
+            else:
+                # late frame, keep the buffer sorted
+                index = len(buf) - 1
+                while index > 0 and buf[index - 1][0] > timestamp:
+                    index -= 1
+                buf.insert(index, (timestamp, frame))
+            if len(buf) > self.max_buffer:
+                buf.popleft()
+                self._stats['overflow'] += 1
+            matched = self._match()
+
+        for frame_set in matched:
+            self._emit(frame_set)
+        return len(matched)
+
+    def _match(self):
+        buffers = self._buffers
+        matched = []
+        while True:
+            lowest = highest = None
+            for buf in buffers.values():
+                if not buf:
+                    return matched
+                head = buf[0][0]
+                if lowest is None or head < lowest:
+                    lowest = head
+                if highest is None or head > highest:
+                    highest = head
+
+            if highest - lowest <= self.tolerance:
+                frames = {}
+                total = 0.0
+                for camera, buf in buffers.items():
+                    stamp, frame = buf.popleft()
+                    frames[camera] = frame
+                    total += stamp
+                matched.append(FrameSet(frames, total / len(frames),
+                                        highest - lowest))
+                self._stats['matched'] += 1
+                continue
+
+            # nothing older than this can match the newest head
+            limit = highest - self.tolerance
+            for camera, buf in buffers.items():
+                while buf and buf[0][0] < limit:
+                    buf.popleft()
+                    self._stats['stale'] += 1
+                    self._stale_by_camera[camera] += 1
+
+    def _emit(self, frame_set):
+        if self.callback is not None:
+            self.callback(frame_set)
+            return
+        try:
+            self.output.put_nowait(frame_set)
+        except queue.Full:
+            self._stats['output_dropped'] += 1
+
+    def get(self, timeout=None):
+        """
+        Returns the next FrameSet, blocking for up to timeout seconds.
+        Raises queue.Empty if none arrives.
+        """
+        return self.output.get(timeout=timeout)
+
+    def get_stats(self):
+        """
+        Returns a dict of counters:
+
+        pushed          - frames pushed
+        matched         - frame sets emitted
+        stale           - frames discarded without a match
+        stale_by_camera - stale frames per camera
+        overflow        - frames discarded because a buffer was full
+        untimed         - frames skipped without a timestamp
+        output_dropped  - sets discarded because the output queue was full
+        buffered        - frames currently buffered per camera
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['stale_by_camera'] = dict(self._stale_by_camera)
+            stats['buffered'] = dict((camera, len(buf))
+                                     for camera, buf in self._buffers.items())
+        return stats
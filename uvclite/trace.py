@@ -0,0 +1,285 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Tracing of libuvc calls and frame callbacks
+
+Tracing is disabled by default and costs nothing for libuvc calls
+while disabled: enable() replaces the function attributes of the
+libuvc module with timing wrappers, and disable() puts the original
+ctypes functions back.  Frame callbacks only check the module level
+enabled flag.
+
+Usage:
+
+    from uvclite import trace
+
+    ring = trace.SpanRing(1000)
+    metrics = trace.PrometheusMetrics()
+    trace.add_hook(ring)
+    trace.add_hook(metrics)
+    trace.enable()
+    ...
+    print(metrics.render())
+"""
+
+from collections import deque
+import threading
+
+from . import libuvc
+from .clock import monotonic as _monotonic
+
+__author__ = 'Eric Callahan'
+
+__all__ = [
+    'Span', 'TraceHook', 'SpanRing', 'PrometheusMetrics', 'enable',
+    'disable', 'add_hook', 'remove_hook', 'span'
+]
+
+enabled = False
+
+# replaced rather than changed, so spans iterate it without the lock
+_hooks = ()
+_originals = {}
+_lock = threading.Lock()
+
+
+class Span(object):
+    """
+    A timed operation.
+
+    name     - the libuvc function name, or 'frame_callback' for
+               user frame callbacks
+    start    - host monotonic time at the start of the operation
+    duration - duration in seconds
+    error    - the negative uvc_error code returned by the call, the
+               name of the exception raised by the call or within a
+               span, or None if it succeeded or returns no error code
+    """
+    __slots__ = ('name', 'start', 'duration', 'error')
+
+    def __init__(self, name, start, duration, error=None):
+        self.name = name
+        self.start = start
+        self.duration = duration
+        self.error = error
+
+    def __repr__(self):
+        return 'Span(%r, duration=%.6f, error=%r)' % (self.name, self.duration,
+                                                     self.error)
+
+
+class TraceHook(object):
+    """
+    Base class for trace hooks.  Hooks are called on the thread that
+    made the call, so they should be quick and thread safe.
+    """
+    def span_started(self, name, start):
+        pass
+
+    def span_finished(self, span):
+        pass
+
+
+class SpanRing(TraceHook):
+    """
+    Keeps the most recent spans in memory.
+    """
+    def __init__(self, size=1024):
+        self._spans = deque(maxlen=size)
+
+    def span_finished(self, span):
+        # deque.append is atomic
+        self._spans.append(span)
+
+    def recent(self, count=None, name=None):
+        """
+        Returns up to count of the most recent spans, oldest first,
+        optionally only those with the given name.
+        """
+        spans = list(self._spans)
+        if name is not None:
+            spans = [s for s in spans if s.name == name]
+        if count is not None:
+            spans = spans[-count:]
+        return spans
+
+    def clear(self):
+        self._spans.clear()
+
+
+class PrometheusMetrics(TraceHook):
+    """
+    Aggregates spans into per-call duration histograms and error
+    counters, rendered in the Prometheus text exposition format.
+    """
+    default_buckets = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1,
+                       0.25, 0.5, 1.0, 2.5, 5.0)
+
+    def __init__(self, buckets=None, prefix='uvclite'):
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._errors = {}
+
+    def span_finished(self, span):
+        with self._lock:
+            entry = self._calls.get(span.name)
+            if entry is None:
+                entry = self._calls[span.name] = [0, 0.0, [0] * len(self.buckets)]
+            entry[0] += 1
+            entry[1] += span.duration
+            counts = entry[2]
+            for i, bound in enumerate(self.buckets):
+                if span.duration <= bound:
+                    counts[i] += 1
+                    break
+            if span.error is not None:
+                key = (span.name, span.error)
+                self._errors[key] = self._errors.get(key, 0) + 1
+
+    def render(self):
+        """
+        Returns the metrics as Prometheus text.
+        """
+        name = self.prefix + '_call_duration_seconds'
+        errors = self.prefix + '_call_errors_total'
+        lines = ['# HELP %s Duration of libuvc calls and frame callbacks.' % name,
+                 '# TYPE %s histogram' % name]
+        with self._lock:
+            for call in sorted(self._calls):
+                count, total, counts = self._calls[call]
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket{call="%s",le="%s"} %d' %
+                                 (name, call, repr(bound), cumulative))
+                lines.append('%s_bucket{call="%s",le="+Inf"} %d' % (name, call, count))
+                lines.append('%s_sum{call="%s"} %r' % (name, call, total))
+                lines.append('%s_count{call="%s"} %d' % (name, call, count))
+
+            lines.append('# HELP %s Calls that returned an error or raised.' % errors)
+            lines.append('# TYPE %s counter' % errors)
+            # codes are uvc_error values, or exception names for spans
+            for (call, code) in sorted(self._errors, key=lambda k: (k[0], str(k[1]))):
+                lines.append('%s{call="%s",code="%s"} %d' %
+                             (errors, call, code, self._errors[(call, code)]))
+        return '\n'.join(lines) + '\n'
+
+
+def add_hook(hook):
+    """
+    Registers a TraceHook.
+    """
+    global _hooks
+    with _lock:
+        if hook not in _hooks:
+            _hooks = _hooks + (hook,)
+
+
+def remove_hook(hook):
+    """
+    Unregisters a TraceHook.
+    """
+    global _hooks
+    with _lock:
+        if hook in _hooks:
+            _hooks = tuple(h for h in _hooks if h is not hook)
+
+
+class span(object):     # pylint: disable=invalid-name
+    """
+    Context manager that reports a span to the registered hooks.
+    May also be used to trace application code:
+
+    with trace.span('encode'):
+        encode(frame)
+    """
+    __slots__ = ('name', 'start', 'error')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.error = None
+
+    def __enter__(self):
+        self.start = _monotonic()
+        for hook in _hooks:
+            hook.span_started(self.name, self.start)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None and self.error is None:
+            self.error = exc_type.__name__
+        finished = Span(self.name, self.start, _monotonic() - self.start,
+                        self.error)
+        for hook in _hooks:
+            hook.span_finished(finished)
+
+
+def _wrap(name, func):
+    def _traced(*args):
+        start = _monotonic()
+        for hook in _hooks:
+            hook.span_started(name, start)
+        error = None
+        try:
+            result = func(*args)
+        except BaseException as err:
+            error = type(err).__name__
+            raise
+        else:
+            if isinstance(result, int) and result < 0:
+                error = result
+        finally:
+            finished = Span(name, start, _monotonic() - start, error)
+            for hook in _hooks:
+                hook.span_finished(finished)
+        return result
+    _traced.__name__ = name
+    return _traced
+
+
+def enable():
+    """
+    Starts tracing every libuvc function called through the libuvc
+    module, and every frame callback.
+    """
+    global enabled
+    with _lock:
+        if enabled:
+            return
+        for name, func in list(vars(libuvc).items()):
+            # skip callback types and pointers such as uvc_null_frame_callback
+            if (name.startswith('uvc_') and hasattr(func, 'argtypes') and
+                    not isinstance(func, (type, libuvc.uvc_frame_callback))):
+                _originals[name] = func
+                setattr(libuvc, name, _wrap(name, func))
+        enabled = True
+
+
+def disable():
+    """
+    Stops tracing and restores the original libuvc functions.
+    """
+    global enabled
+    with _lock:
+        if not enabled:
+            return
+        for name, func in _originals.items():
+            setattr(libuvc, name, func)
+        _originals.clear()
+        enabled = False
@@ -0,0 +1,503 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Batched binary frame forwarding over TCP
+
+A FrameSender queues frames and sends them to a FrameReceiver in
+batches.  Small frames are coalesced until a batch reaches batch_bytes
+or batch_frames, or the oldest frame has waited linger seconds.  Each
+batch goes out with a single sendmsg() whose buffers are the headers
+and the frame data themselves, so frames are never concatenated.
+
+Protocol, little endian.  A connection starts with the magic 'UVCT'
+and the protocol version (u32), followed by batches:
+
+    batch  body size (u32), frame count (u16), reserved (u16)
+    frame  device id (u16), frame format (u16), width, height,
+           sequence (u32 each), capture time (f64), host time (f64),
+           data size (u32), then the data
+
+The capture time is libuvc's, a wall clock time of the sending host.
+The host time is the same instant on the sender's monotonic clock (see
+UVCFrame.host_time), NaN if unknown.  It is only comparable between
+frames from the same sender.
+
+Usage, on the camera host:
+
+    sender = FrameSender('aggregator.local', 5800, device_id=3)
+    sender.start()
+    dev.set_callback(lambda frame, user: sender.send(frame))
+
+and on the aggregator:
+
+    receiver = FrameReceiver(port=5800)
+    receiver.start()
+    frame = receiver.get(timeout=1.0)
+"""
+
+from collections import deque
+from ctypes import string_at
+import errno
+import logging
+import math
+import queue
+import socket
+import struct
+import threading
+import time
+
+from . import libuvc, UVCError
+from .clock import monotonic as _monotonic
+
+__author__ = 'Eric Callahan'
+
+_logger = logging.getLogger(__name__)
+
+MAGIC = b'UVCT'
+VERSION = 2
+
+_HELLO = struct.Struct('<4sI')
+_BATCH = struct.Struct('<IHH')
+_FRAME = struct.Struct('<HHIIIddI')
+
+_NAN = float('nan')
+
+# two buffers per frame must stay under the usual IOV_MAX of 1024
+MAX_BATCH_FRAMES = 500
+
+
+def _sendmsg_all(sock, buffers):
+    # sendmsg() until every buffer has gone, resuming mid buffer
+    buffers = [memoryview(b).cast('B') for b in buffers]
+    while buffers:
+        sent = sock.sendmsg(buffers)
+        while sent:
+            if sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            else:
+                buffers[0] = buffers[0][sent:]
+                sent = 0
+
+
+def _recv_exact(sock, size):
+    # returns size bytes as a bytearray, or None if the peer closed
+    data = bytearray(size)
+    view = memoryview(data)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:])
+        if not count:
+            return None
+        received += count
+    return data
+
+
+class FrameSender(object):
+    """
+    Sends frames to a FrameReceiver.  send() and raw_callback() only
+    queue the frame, a thread batches and sends them, reconnecting if
+    the connection is lost.  Frames arriving while the queue is full
+    are dropped.  There are no acknowledgements, batches the kernel
+    accepted just before a connection broke are lost with it.
+
+    Params:
+    host, port     - the receiver's address
+    device_id      - id sent with every frame, to tell the senders of
+                     one receiver apart (0-65535)
+    batch_bytes    - frame bytes after which a batch is sent
+    batch_frames   - frames after which a batch is sent
+    linger         - seconds a frame may wait for a batch to fill
+    queue_size     - frames that may wait to be sent
+    retry_interval - seconds between connection attempts
+    """
+    def __init__(self, host, port, device_id=0, batch_bytes=256 * 1024, batch_frames=64,
+                 linger=0.005, queue_size=64, retry_interval=1.0):
+        self.address = (host, port)
+        self.device_id = device_id
+        self.batch_bytes = batch_bytes
+        self.batch_frames = min(batch_frames, MAX_BATCH_FRAMES)
+        self.linger = linger
+        self.retry_interval = retry_interval
+        self._queue = queue.Queue(queue_size)
+        self._sock = None
+        self._thread = None
+        self._running = False
+        self._stats = {
+            'queued': 0,
+            'sent': 0,
+            'batches': 0,
+            'bytes': 0,
+            'dropped': 0,
+            'lost': 0,
+            'connects': 0
+        }
+
+    @property
+    def connected(self):
+        return self._sock is not None
+
+    def start(self):
+        """
+        Starts the sending thread.  It connects on its own, so this
+        does not fail if the receiver is not up yet.
+        """
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='uvclite-sender')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _enqueue(self, item):
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self._stats['dropped'] += 1
+            return False
+        self._stats['queued'] += 1
+        return True
+
+    def send(self, frame, device_id=None):
+        """
+        Queues a UVCFrame.  Its data is sent as is, without a copy.
+        Returns False if the frame was dropped.
+        """
+        host_time = frame.host_time if frame.host_time is not None else _NAN
+        return self._enqueue((
+            _FRAME.pack(self.device_id if device_id is None else device_id,
+                        frame.frame.frame_format, frame.width, frame.height,
+                        frame.sequence, frame.capture_time, host_time, len(frame.data)),
+            frame.data))
+
+    def raw_callback(self, frame, timestamp, user=None):   # pylint: disable=unused-argument
+        """
+        A callback for UVCDevice.set_raw_callback().  The libuvc buffer
+        does not outlive the callback, so the data is copied once.
+        """
+        capture_time = frame.capture_time.tv_sec + frame.capture_time.tv_usec / 1000000.0
+        self._enqueue((
+            _FRAME.pack(self.device_id, frame.frame_format, frame.width, frame.height,
+                        frame.sequence, capture_time,
+                        _NAN if timestamp is None else timestamp, frame.data_bytes),
+            string_at(frame.data, frame.data_bytes)))
+
+    def _connect(self):
+        try:
+            sock = socket.create_connection(self.address, timeout=self.retry_interval)
+            sock.settimeout(None)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            sock.sendall(_HELLO.pack(MAGIC, VERSION))
+        except OSError as err:
+            _logger.debug("Connecting to %s:%d failed: %s", self.address[0],
+                          self.address[1], err)
+            return False
+        self._sock = sock
+        self._stats['connects'] += 1
+        return True
+
+    def _collect(self):
+        # blocks for the first frame, then fills the batch until a limit
+        # is reached or the linger time runs out
+        try:
+            first = self._queue.get(timeout=0.2)
+        except queue.Empty:
+            return None
+        batch = [first]
+        size = len(first[1])
+        deadline = _monotonic() + self.linger
+        while len(batch) < self.batch_frames and size < self.batch_bytes:
+            remaining = deadline - _monotonic()
+            try:
+                item = self._queue.get(timeout=remaining) if remaining > 0 else \
+                    self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(item)
+            size += len(item[1])
+        return batch
+
+    def _run(self):
+        pending = None
+        while self._running or pending or not self._queue.empty():
+            if self._sock is None and not self._connect():
+                if not self._running:
+                    break
+                time.sleep(self.retry_interval)
+                continue
+            if pending is None:
+                pending = self._collect()
+                if pending is None:
+                    continue
+            body = sum(_FRAME.size + len(data) for _, data in pending)
+            buffers = [_BATCH.pack(body, len(pending), 0)]
+            for header, data in pending:
+                buffers.append(header)
+                buffers.append(data)
+            try:
+                _sendmsg_all(self._sock, buffers)
+            except OSError as err:
+                _logger.warning("Sending to %s:%d failed: %s", self.address[0],
+                                self.address[1], err)
+                self._sock.close()
+                self._sock = None
+                # the receiver drops partial batches, so resend it whole
+                continue
+            self._stats['sent'] += len(pending)
+            self._stats['batches'] += 1
+            self._stats['bytes'] += _BATCH.size + body
+            pending = None
+        self._stats['lost'] += len(pending or ())
+
+    def stop(self, timeout=5.0):
+        """
+        Sends the frames still queued, waiting up to timeout seconds,
+        and closes the connection.
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def get_stats(self):
+        """
+        Returns a dict of counters: frames queued, sent and dropped
+        with the queue full, frames lost in a batch still unsent at
+        stop(), batches and bytes sent, and connects.
+        """
+        stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        return stats
+
+
+class ReceivedFrame(object):
+    """
+    A frame received by a FrameReceiver.
+
+    data         - memoryview of the frame bytes
+    device_id    - the sender's device id
+    sequence     - libuvc sequence number
+    capture_time - libuvc's capture time, the sender's wall clock
+    host_time    - the capture time on the sender's monotonic clock, or
+                   None if the sender did not know it
+    frame_format - UVCFrameFormat
+    width, height
+    peer         - the sender's address
+    """
+    __slots__ = ('data', 'device_id', 'sequence', 'capture_time', 'host_time',
+                 'frame_format', 'width', 'height', 'peer')
+
+    def __init__(self, data, device_id, sequence, capture_time, host_time, frame_format,
+                 width, height, peer):
+        self.data = data
+        self.device_id = device_id
+        self.sequence = sequence
+        self.capture_time = capture_time
+        self.host_time = host_time
+        self.frame_format = frame_format
+        self.width = width
+        self.height = height
+        self.peer = peer
+
+
+def parse_batch(body, count, peer=None):
+    """
+    Returns the ReceivedFrames of a batch body.  Their data are views of
+    body, no frame is copied.
+    """
+    frames = []
+    view = memoryview(body)
+    offset = 0
+    for _ in range(count):
+        device_id, frame_format, width, height, sequence, capture_time, host_time, size = \
+            _FRAME.unpack_from(body, offset)
+        offset += _FRAME.size
+        if offset + size > len(body):
+            raise UVCError("Truncated frame in batch", errno.EPROTO)
+        try:
+            frame_format = libuvc.uvc_frame_format(frame_format)
+        except ValueError:
+            pass
+        if math.isnan(host_time):
+            host_time = None
+        frames.append(ReceivedFrame(view[offset:offset + size], device_id, sequence,
+                                    capture_time, host_time, frame_format, width, height,
+                                    peer))
+        offset += size
+    return frames
+
+
+class FrameReceiver(object):
+    """
+    Accepts connections from FrameSenders and receives their frames,
+    which are passed to callback, or queued for get() when there is no
+    callback.  Each connection is read by a thread of its own.
+
+    Frames keep the sender's clocks: capture_time is the sender's wall
+    clock, and host_time its monotonic clock, which means nothing on
+    the receiving host.  Compare frames from different senders by
+    capture_time, with the hosts' wall clocks kept in sync.
+
+    Params:
+    host       - address to listen on
+    port       - port to listen on, 0 for any free port (see address)
+    callback   - called as callback(received_frame)
+    queue_size - frames queued for get(), the oldest are dropped when
+                 it is full
+    """
+    def __init__(self, host='0.0.0.0', port=5800, callback=None, queue_size=256):
+        self.callback = callback
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._frames = deque(maxlen=queue_size)
+        self._ready = threading.Condition()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self._stats = {
+            'frames': 0,
+            'batches': 0,
+            'bytes': 0,
+            'dropped': 0,
+            'connections': 0,
+            'protocol_errors': 0
+        }
+
+    @property
+    def address(self):
+        """
+        The (host, port) the receiver listens on
+        """
+        return self._listener.getsockname()
+
+    def start(self):
+        """
+        Starts listening.
+        """
+        self._listener.listen(16)
+        self._listener.settimeout(0.5)
+        self._running = True
+        self._thread = threading.Thread(target=self._accept_loop, name='uvclite-receiver')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _accept_loop(self):
+        while self._running:
+            try:
+                sock, peer = self._listener.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            sock.settimeout(None)
+            with self._lock:
+                self._connections.append(sock)
+                self._stats['connections'] += 1
+            thread = threading.Thread(target=self._read_loop, args=(sock, peer),
+                                      name='uvclite-receiver-%s:%d' % peer[:2])
+            thread.daemon = True
+            thread.start()
+
+    def _read_loop(self, sock, peer):
+        try:
+            hello = _recv_exact(sock, _HELLO.size)
+            if hello is None or _HELLO.unpack(hello) != (MAGIC, VERSION):
+                self._stats['protocol_errors'] += 1
+                _logger.warning("Rejected connection from %s:%d", peer[0], peer[1])
+                return
+            while self._running:
+                header = _recv_exact(sock, _BATCH.size)
+                if header is None:
+                    break
+                size, count, _ = _BATCH.unpack(header)
+                body = _recv_exact(sock, size)
+                if body is None:
+                    break
+                frames = parse_batch(body, count, peer)
+                self._stats['batches'] += 1
+                self._stats['bytes'] += _BATCH.size + size
+                self._stats['frames'] += len(frames)
+                self._deliver(frames)
+        except UVCError as err:
+            self._stats['protocol_errors'] += 1
+            _logger.warning("Closing connection from %s:%d: %s", peer[0], peer[1], err)
+        except OSError:
+            pass
+        finally:
+            with self._lock:
+                if sock in self._connections:
+                    self._connections.remove(sock)
+            sock.close()
+
+    def _deliver(self, frames):
+        if self.callback is not None:
+            for frame in frames:
+                self.callback(frame)
+            return
+        with self._ready:
+            overflow = len(self._frames) + len(frames) - self._frames.maxlen
+            if overflow > 0:
+                self._stats['dropped'] += overflow
+            self._frames.extend(frames)
+            self._ready.notify_all()
+
+    def get(self, timeout=None):
+        """
+        Returns the oldest queued ReceivedFrame, or None if none
+        arrives within timeout seconds.
+        """
+        with self._ready:
+            if not self._frames:
+                self._ready.wait(timeout)
+            if not self._frames:
+                return None
+            return self._frames.popleft()
+
+    def close(self):
+        """
+        Stops listening and closes every connection.
+        """
+        self._running = False
+        self._listener.close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        with self._lock:
+            for sock in self._connections:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_stats(self):
+        """
+        Returns a dict of counters: frames, batches and bytes received,
+        frames dropped from a full queue, connections accepted, the
+        number currently open and protocol errors.
+        """
+        stats = dict(self._stats)
+        stats['open_connections'] = len(self._connections)
+        return stats
@@ -0,0 +1,227 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" A libusb context shared between UVCContexts
+
+When uvc_init is given no libusb context, libuvc creates one for each
+UVCContext along with its own event handling thread.  A USBContext is
+a single libusb context, with a single event thread, that any number
+of UVCContexts can be built on.  libuvc does not handle events for a
+context it does not own, so the USBContext's event thread (or calls
+to handle_events()) must be running while devices stream.
+
+Usage:
+
+    with UVCContext(shared_usb=True) as first, UVCContext(shared_usb=True) as second:
+        ...
+"""
+
+from ctypes import byref, c_char_p, c_int, c_void_p, CDLL, POINTER
+from ctypes.util import find_library
+import errno
+import logging
+import threading
+
+from . import libuvc, UVCError
+
+__author__ = 'Eric Callahan'
+
+_logger = logging.getLogger(__name__)
+
+_libusb = None
+_load_lock = threading.Lock()
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def _load_libusb():
+    global _libusb
+    with _load_lock:
+        if _libusb is None:
+            lib = CDLL(find_library('usb-1.0') or 'libusb-1.0.so.0')
+            lib.libusb_init.argtypes = [POINTER(c_void_p)]
+            lib.libusb_exit.argtypes = [c_void_p]
+            lib.libusb_exit.restype = None
+            lib.libusb_handle_events_timeout_completed.argtypes = [
+                c_void_p, POINTER(libuvc._timeval), POINTER(c_int)]
+            lib.libusb_error_name.argtypes = [c_int]
+            lib.libusb_error_name.restype = c_char_p
+            # libusb 1.0.21 and later can wake the event thread directly
+            if hasattr(lib, 'libusb_interrupt_event_handler'):
+                lib.libusb_interrupt_event_handler.argtypes = [c_void_p]
+                lib.libusb_interrupt_event_handler.restype = None
+            _libusb = lib
+    return _libusb
+
+
+class USBContext(object):
+    """
+    A reference counted libusb context.  The creator holds the first
+    reference, UVCContexts built on it acquire their own, and libusb
+    is shut down when the last one is released.
+
+    Params:
+    event_thread  - start the event handling thread immediately
+    event_timeout - seconds the event thread waits for events before
+                    checking whether it should stop.  Only used when
+                    libusb cannot interrupt the wait itself.
+    """
+    def __init__(self, event_thread=True, event_timeout=0.5):
+        self._lib = _load_libusb()
+        self._ctx = c_void_p()
+        ret = self._lib.libusb_init(byref(self._ctx))
+        if ret < 0:
+            raise UVCError("libusb_init failed: %s" % self._error_name(ret), errno.EIO)
+        self.event_timeout = event_timeout
+        self._lock = threading.Lock()
+        self._refs = 1
+        self._thread = None
+        self._running = False
+        self._stats = {
+            'event_loops': 0,
+            'event_errors': 0
+        }
+        if event_thread:
+            self.start_event_thread()
+
+    @property
+    def handle(self):
+        """
+        The libusb_context pointer, as passed to uvc_init
+        """
+        return self._ctx
+
+    @property
+    def refs(self):
+        return self._refs
+
+    @property
+    def is_closed(self):
+        return not self._ctx
+
+    def _error_name(self, code):
+        return self._lib.libusb_error_name(code).decode('utf8')
+
+    def acquire(self):
+        """
+        Adds a reference and returns the context.
+        """
+        with self._lock:
+            if not self._ctx:
+                raise UVCError("USB context is closed", errno.EBADF)
+            self._refs += 1
+        return self
+
+    def release(self):
+        """
+        Drops a reference, closing the context when none remain.
+        """
+        with self._lock:
+            self._refs -= 1
+            last = self._refs <= 0
+        if last:
+            self._close()
+
+    def handle_events(self, timeout=0.0):
+        """
+        Handles pending USB events, waiting up to timeout seconds for
+        some to arrive.  For applications that run their own event loop
+        instead of the event thread.
+        """
+        tv = libuvc._timeval(int(timeout), int((timeout % 1) * 1000000))
+        ret = self._lib.libusb_handle_events_timeout_completed(self._ctx, byref(tv), None)
+        self._stats['event_loops'] += 1
+        if ret < 0:
+            self._stats['event_errors'] += 1
+        return ret
+
+    def _event_loop(self):
+        while self._running:
+            ret = self.handle_events(self.event_timeout)
+            if ret < 0 and ret != -4:     # LIBUSB_ERROR_INTERRUPTED
+                _logger.warning("libusb event handling failed: %s",
+                                self._error_name(ret))
+
+    @property
+    def event_thread_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start_event_thread(self):
+        """
+        Starts the event handling thread if it is not running.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._event_loop,
+                                            name='uvclite-usb-events')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop_event_thread(self):
+        """
+        Stops the event handling thread.  Streams on this context
+        receive no frames until it is started again, or events are
+        handled with handle_events().
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+            self._running = False
+        if thread is None:
+            return
+        interrupt = getattr(self._lib, 'libusb_interrupt_event_handler', None)
+        if interrupt is not None:
+            interrupt(self._ctx)
+        thread.join()
+
+    def _close(self):
+        global _shared
+        self.stop_event_thread()
+        if self._ctx:
+            self._lib.libusb_exit(self._ctx)
+            self._ctx = c_void_p()
+        with _shared_lock:
+            if _shared is self:
+                _shared = None
+
+    def get_stats(self):
+        """
+        Returns a dict with the number of references, whether the event
+        thread is running, and the event_loops and event_errors counts.
+        """
+        stats = dict(self._stats)
+        stats['refs'] = self._refs
+        stats['event_thread'] = self.event_thread_running
+        return stats
+
+
+def shared_context(event_timeout=0.5):
+    """
+    Returns the process wide USBContext with a reference acquired for
+    the caller, creating it with a running event thread if needed.
+    Release the reference with USBContext.release().
+    """
+    global _shared
+    with _shared_lock:
+        if _shared is not None:
+            try:
+                return _shared.acquire()
+            except UVCError:
+                pass
+        _shared = USBContext(event_timeout=event_timeout)
+        return _shared
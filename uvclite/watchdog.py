@@ -0,0 +1,104 @@
+#!/usr/bin/python
+
+# Copyright 2017 Eric Callahan
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Stall detection for streaming UVC devices
+
+"""
+
+import logging
+import threading
+
+from .clock import monotonic as _monotonic
+
+__author__ = 'Eric Callahan'
+
+_logger = logging.getLogger(__name__)
+
+
+class StreamWatchdog(object):
+    """
+    Watches the gap between frames delivered by a streaming UVCDevice
+    and triggers a recovery when no frame has arrived for longer than
+    stall_timeout seconds.
+
+    In callback mode the recovery is performed from the watchdog thread.
+    In polling mode the recovery is only requested, and is performed by
+    the next call to get_frame() so that the stream handle is never torn
+    down underneath a blocked uvc_stream_get_frame().  Polling users
+    should therefore call get_frame() with a finite timeout.
+
+    Usually created through UVCDevice.start_watchdog() rather than
+    directly.
+    """
+    def __init__(self, device, stall_timeout=2.0, check_interval=None):
+        self._device = device
+        self.stall_timeout = stall_timeout
+        if check_interval is None:
+            check_interval = stall_timeout / 4.0
+        self.check_interval = check_interval
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the watchdog thread.
+        """
+        if self._thread is None:
+            self._stop_event.clear()
+            self._thread = threading.Thread(target=self._run,
+                                            name='uvclite-watchdog')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """
+        Stops the watchdog thread and waits for it to exit.
+        """
+        if self._thread is not None:
+            self._stop_event.set()
+            if self._thread is not threading.current_thread():
+                self._thread.join()
+            self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def _run(self):
+        device = self._device
+        while not self._stop_event.wait(self.check_interval):
+            last_frame = device._last_frame_time
+            if last_frame is None or not device.is_streaming:
+                continue
+
+            gap = _monotonic() - last_frame
+            if gap < self.stall_timeout:
+                continue
+
+            _logger.warning("Stream stalled, no frame for %.3f seconds", gap)
+            device._stats['stalls'] += 1
+            if device.is_polling:
+                device._recovery_pending = True
+                # don't flag the same stall on every check
+                device._last_frame_time = _monotonic()
+            else:
+                try:
+                    device.recover()
+                except Exception:     # pylint: disable=broad-except
+                    _logger.exception("Stream recovery failed")
+                    # try again after another stall_timeout, not on the
+                    # next check
+                    device._last_frame_time = _monotonic()